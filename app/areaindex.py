@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+'''
+A summed-area table index of the data archives, used to compute area means quickly.
+
+For every day, the index holds the cumulative sum of each variable over all pixels
+above and to the left of each grid point (along with the number of valid pixels).
+The sum over any rectangular box can then be computed from only the four corners
+of the box, so the area mean over a box costs the same for every box size.
+
+The index is stored as a Zarr store for each dataset, built and updated in the same
+way as the time-series-optimised store (see the tsstore module), and days which
+have arrived since it was built are indexed as they are read.  It can be built
+with the build_area_index Celery task, or by running this module as a script.
+'''
+
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+from config import config
+import tsstore
+
+_SUM_SUFFIX = '_sum'
+_COUNT_SUFFIX = '_count'
+
+
+def _indexes():
+    '''
+    :return: A dict mapping dataset glob expressions to their area index store
+    '''
+    return {config['Data']['tamsat_path']: config['Data']['tamsat_area_index'],
+            config['Data']['met_fc_temp_path']: config['Data']['met_fc_temp_area_index']}
+
+def _summed_area_table(ds):
+    '''
+    Transforms a dataset into its summed-area table.  This is applied to each
+    block of days as the index is built.
+
+    The tables have one more row and column than the data, so that the first row
+    and column are zero.  The original axes are kept, so that boxes can be
+    located in the table.
+    '''
+    table = xr.Dataset(coords={'time': ds['time']})
+    for name, var in ds.data_vars.items():
+        if 'lat' not in var.dims or 'lon' not in var.dims:
+            continue
+        valid = var.notnull()
+        for values, suffix, dtype in ((var.fillna(0), _SUM_SUFFIX, 'float64'),
+                                      (valid, _COUNT_SUFFIX, 'int32')):
+            summed = values.astype(dtype).cumsum('lat').cumsum('lon').astype(dtype) \
+                .pad(lat=(1, 0), lon=(1, 0), constant_values=0) \
+                .drop_vars(['lat', 'lon']) \
+                .rename({'lat': 'y', 'lon': 'x'})
+            table[name + suffix] = summed.transpose('time', 'y', 'x')
+    table['lat_axis'] = ('lat', ds['lat'].values)
+    table['lon_axis'] = ('lon', ds['lon'].values)
+    return table
+
+def open_index(path):
+    '''
+    Opens the area index for a dataset.  Days which have been added to the
+    dataset since the index was built are read from the daily files, and indexed
+    as they are read (see tsstore.open_with_tail).
+
+    :param path:    A glob expression defining the location of the data
+    :return:        An xarray Dataset, or None if there is no usable index
+                    for the given dataset
+    '''
+    store = _indexes().get(path)
+    if not store:
+        return None
+    return tsstore.open_with_tail(store, path, transform=_summed_area_table)
+
+def box_indices(index, minlon, maxlon, minlat, maxlat):
+    '''
+    Finds the range of rows and columns covered by a bounding box
+
+    :param index:   The index, as returned by open_index
+    :param minlon:  The western edge of the bounding box
+    :param maxlon:  The eastern edge of the bounding box
+    :param minlat:  The southern edge of the bounding box
+    :param maxlat:  The northern edge of the bounding box
+    :return:        A tuple of (first row, last row + 1, first column, last column + 1),
+                    or None if the box contains no grid points
+    '''
+    lats = index['lat_axis'].values
+    lons = index['lon_axis'].values
+    rows = np.nonzero((lats >= minlat) & (lats <= maxlat))[0]
+    cols = np.nonzero((lons >= minlon) & (lons <= maxlon))[0]
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+def extract_area_mean_timeseries(index, minlon, maxlon, minlat, maxlat):
+    '''
+    Extracts a timeseries of the spatial mean of all variables over a bounding box
+
+    :param index:   The index, as returned by open_index
+    :param minlon:  The western edge of the bounding box
+    :param maxlon:  The eastern edge of the bounding box
+    :param minlat:  The southern edge of the bounding box
+    :param maxlat:  The northern edge of the bounding box
+    :return:        A pandas DataFrame containing all variables present in the index
+    '''
+    box = box_indices(index, minlon, maxlon, minlat, maxlat)
+    if box is None:
+        raise ValueError('No data points within the bounding box')
+    y0, y1, x0, x1 = box
+
+    # Only the four corners of the box are read
+    corners = index.isel(y=[y0, y1], x=[x0, x1]).load()
+
+    def box_total(var):
+        c = corners[var].values
+        return c[:, 1, 1] - c[:, 0, 1] - c[:, 1, 0] + c[:, 0, 0]
+
+    columns = {}
+    for name in corners.data_vars:
+        if name.endswith(_SUM_SUFFIX):
+            var = name[:-len(_SUM_SUFFIX)]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                columns[var] = box_total(name) / box_total(var + _COUNT_SUFFIX)
+    return pd.DataFrame(columns, index=pd.Index(corners['time'].values, name='time'))
+
+def build_all():
+    '''
+    Builds or updates all configured area indexes
+
+    :return:    A dict mapping each index to the number of days appended to it
+    '''
+    time_chunk = int(config['Data']['area_index_time_chunk'])
+    return {store: tsstore.build_store(path, store,
+                                       transform=_summed_area_table,
+                                       time_chunk=time_chunk)
+            for path, store in _indexes().items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build or update the summed-area table indexes of the data archives')
+    parser.parse_args()
+    for store, n_days in build_all().items():
+        print('Appended {} days to {}'.format(n_days, store))
@@ -0,0 +1,181 @@
+'''
+A persistent, on-disk cache for data extracted from the TAMSAT and NCEP archives.
+
+Each entry is a pandas DataFrame indexed by time, stored as a directory containing
+one memory-mappable NumPy file per column.  Entries are keyed by an opaque string
+(see make_key), and are shared between all of the processes which use the same
+cache directory:
+
+* Entries are written to a temporary directory and then renamed into place, so
+  readers never see a partially written entry
+* Reading an entry updates its modification time, which is used for LRU eviction
+* Eviction is serialised between processes with a lock file
+
+The cache is configured in the [Cache] section of the config file.
+'''
+
+import os
+import os.path
+import json
+import shutil
+import fcntl
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from config import config
+
+_META_FILE = 'meta.json'
+_LOCK_FILE = '.lock'
+
+
+def _cache_dir():
+    path = config['Cache']['path']
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _entry_dir(key):
+    return os.path.join(_cache_dir(), key[:2], key)
+
+def make_key(*parts):
+    '''
+    Creates a cache key from a number of parts
+
+    :param parts:   Any number of values with a stable string representation
+    :return:        A string suitable for use as a cache key
+    '''
+    return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+def dataset_version(path):
+    '''
+    Gets a token which changes whenever files are added to or removed from a dataset.
+
+    This is used as part of cache keys, so that entries are invalidated when new
+    daily files arrive.  Stale entries are never read again, and are eventually
+    evicted.
+
+    Only the directories of the dataset which have been modified are listed again
+    (see manifest.list_files), along with checking whether its last file has been
+    modified.
+
+    :param path:    A glob expression defining the location of the data
+    :return:        A string which identifies the current state of the dataset
+    '''
+    # Imported here, since the manifest uses the versions of datasets
+    import manifest
+    files = manifest.list_files(path)
+    if not files:
+        raise ValueError('No data files found at ' + path)
+    last = files[-1]
+    return make_key(len(files), last, os.path.getmtime(last))
+
+def get(key):
+    '''
+    Retrieves an entry from the cache
+
+    :param key: The key of the entry
+    :return:    A pandas DataFrame, or None if the entry is not in the cache
+    '''
+    entry = _entry_dir(key)
+    meta_file = os.path.join(entry, _META_FILE)
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        index = np.load(os.path.join(entry, 'index.npy'), mmap_mode='r')
+        columns = {}
+        for i, name in enumerate(meta['columns']):
+            columns[name] = np.load(os.path.join(entry, 'c{}.npy'.format(i)),
+                                    mmap_mode='r')
+        # Mark the entry as recently used
+        os.utime(meta_file)
+    except (OSError, ValueError):
+        # Either a miss, or the entry was evicted while we were reading it
+        return None
+
+    return pd.DataFrame(columns,
+                        index=pd.Index(index, name=meta['index_name']),
+                        columns=meta['columns'])
+
+def put(key, df):
+    '''
+    Stores a DataFrame in the cache.  If the entry already exists, it is left
+    unchanged.  Only DataFrames with numeric (or datetime) columns can be stored.
+
+    :param key: The key of the entry
+    :param df:  The pandas DataFrame to store
+    '''
+    entry = _entry_dir(key)
+    if os.path.exists(entry):
+        return
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+    tmp = tempfile.mkdtemp(dir=_cache_dir(), prefix='.tmp-')
+    try:
+        np.save(os.path.join(tmp, 'index.npy'), df.index.values, allow_pickle=False)
+        for i, name in enumerate(df.columns):
+            np.save(os.path.join(tmp, 'c{}.npy'.format(i)),
+                    df[name].values, allow_pickle=False)
+        size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+        with open(os.path.join(tmp, _META_FILE), 'w') as f:
+            json.dump({
+                'columns': [str(c) for c in df.columns],
+                'index_name': df.index.name,
+                'size': size
+            }, f)
+        os.rename(tmp, entry)
+    except OSError:
+        # Another process has stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(entry):
+            raise
+    except ValueError:
+        # The DataFrame contains data which can't be stored without pickling
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    _evict()
+
+def remove(key):
+    '''
+    Removes an entry from the cache, if it exists
+
+    :param key: The key of the entry
+    '''
+    shutil.rmtree(_entry_dir(key), ignore_errors=True)
+
+def _evict():
+    '''
+    Removes the least recently used entries until the cache is under its size limit
+    '''
+    max_size = int(config['Cache']['max_size_mb']) * 1024 * 1024
+    cache_dir = _cache_dir()
+
+    with open(os.path.join(cache_dir, _LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        entries = []
+        total = 0
+        for prefix in os.scandir(cache_dir):
+            if not prefix.is_dir() or prefix.name.startswith('.'):
+                continue
+            for entry in os.scandir(prefix.path):
+                meta_file = os.path.join(entry.path, _META_FILE)
+                try:
+                    with open(meta_file) as f:
+                        size = json.load(f)['size']
+                    mtime = os.path.getmtime(meta_file)
+                except (OSError, ValueError):
+                    continue
+                entries.append((mtime, size, entry.path))
+                total += size
+
+        if total <= max_size:
+            return
+
+        # Evict down to 90% of the limit, so we don't evict on every write
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= 0.9 * max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,274 @@
+'''
+The Celery client, used to submit jobs from the web application.
+
+This only needs Celery and the config, not the scientific libraries used to run
+the jobs, so that the web application starts quickly and stays small.  Tasks
+are sent by name, and are defined in the tasks module, which is only imported
+by the Celery workers.
+'''
+
+import time
+from celery import Celery, chain, group
+from celery.exceptions import TimeoutError
+from config import config
+import jobevents
+import jobspec
+import scheduler
+
+# Setup the celery app
+celery_app = Celery('tasks',
+                    backend=config['Celery']['backend'],
+                    broker=config['Celery']['broker'])
+
+# Jobs are sent as JobSpecs, which are encoded as compact JSON (see the jobspec
+# module).  Pickle is not accepted, so that the web application and the workers
+# only need to agree on the job schema, not on the versions of their libraries.
+jobspec.register_serializer()
+celery_app.conf.update(task_serializer=jobspec.SERIALIZER,
+                       accept_content=['json', jobspec.SERIALIZER])
+
+# Stop runaway tasks (the soft limit raises SoftTimeLimitExceeded in the task, so
+# that it fails the job cleanly, and the hard limit kills the worker process),
+# and replace worker processes whose memory has grown too large after a task
+# (the limit is in KiB).  Limits of 0 mean no limit.
+celery_app.conf.update(task_soft_time_limit=int(config['Tasks']['task_soft_time_limit']) or None,
+                       task_time_limit=int(config['Tasks']['task_time_limit']) or None,
+                       worker_max_memory_per_child=int(config['Tasks']['max_memory_per_child_mb']) * 1024 or None)
+
+# Each stage of a job runs on a queue suited to the work it does, so that e.g.
+# a slow SMTP server does not hold up the CPU-bound model runs.  The model runs
+# of heavy jobs go to the 'heavy' queue instead of 'cpu' (see estimate_cost).
+# Anything not listed here (i.e. maintenance tasks) goes to the default queue.
+celery_app.conf.task_routes = {
+    'tasks.prefetch_inputs': {'queue': 'io'},
+    'tasks.extract_inputs': {'queue': 'io'},
+    'tasks.run_model': {'queue': 'cpu'},
+    'tasks.run_region_tile': {'queue': 'cpu'},
+    'tasks.merge_region_tiles': {'queue': 'io'},
+    'tasks.package_output': {'queue': 'io'},
+    'tasks.notify_user': {'queue': 'notifications'},
+    'tasks.notify_result_ready': {'queue': 'notifications'},
+    'tasks.send_outbox': {'queue': 'notifications'},
+    'tasks.sweep_outbox': {'queue': 'notifications'},
+    'tasks.run_quick': {'queue': 'quick'}
+}
+
+# Run the cleanup every hour
+celery_app.conf.beat_schedule = {
+    'cleanup-files': {
+        'task': 'tasks.cleanup_files',
+        'schedule': 3600.0
+    },
+    # Emails are normally sent by a task scheduled when they are added to the
+    # outbox, so this only recovers from tasks which were lost
+    'sweep-outbox': {
+        'task': 'tasks.sweep_outbox',
+        'schedule': 600.0
+    },
+    'update-file-manifest': {
+        'task': 'tasks.update_file_manifest',
+        'schedule': 3600.0
+    },
+    'update-timeseries-store': {
+        'task': 'tasks.build_timeseries_store',
+        'schedule': 86400.0
+    },
+    'update-area-index': {
+        'task': 'tasks.build_area_index',
+        'schedule': 86400.0
+    },
+    # Jobs are normally dispatched as soon as there is room, so this only
+    # recovers from jobs which were lost, e.g. by a worker being killed
+    'dispatch-jobs': {
+        'task': 'tasks.dispatch_jobs',
+        'schedule': 60.0
+    }
+}
+
+
+def estimate_cost(job):
+    '''
+    Estimates the cost of running a job from its parameters, in "pixel-years":
+    the number of pixels, times the number of years of data, times the number of
+    forecast dates.  Soil moisture jobs are weighted by soil_moisture_cost, since
+    they run a model rather than summing rainfall.
+
+    :param job: The parameters of the job (see submit_job)
+    :return:    The estimated cost
+    '''
+    data_config = config['Data']
+    n_years = len(set(range(int(data_config['climatology_start_year']),
+                            int(data_config['climatology_end_year']) + 1)) |
+                  set(range(int(data_config['period_of_interest_start_year']),
+                            int(data_config['period_of_interest_end_year']) + 1)))
+    cost = float(n_years * len(job.get('cast_dates') or [None]))
+    if len(job['location']) == 4:
+        # Only needed for regions, and imported here so that the web application
+        # only loads the scientific libraries if it is sent a region
+        import extraction
+        minlon, maxlon, minlat, maxlat = job['location']
+        lons, lats = extraction.grid_axes(config['Data']['tamsat_path'])
+        cost *= ((lons >= minlon) & (lons <= maxlon)).sum() * ((lats >= minlat) & (lats <= maxlat)).sum()
+    if job['metric'] == 'soilmoisture':
+        cost *= float(config['Tasks']['soil_moisture_cost'])
+    return cost
+
+def is_heavy(job):
+    '''
+    :return: Whether a job is expensive enough to run on the 'heavy' queue
+    '''
+    return estimate_cost(job) >= float(config['Tasks']['heavy_job_cost'])
+
+
+def _task(name, *args):
+    '''
+    :return: The signature of a task in the tasks module, called with the given arguments
+    '''
+    return celery_app.signature('tasks.' + name, args=args, immutable=True)
+
+def submit_job(job):
+    '''
+    Submits a job to the queue.  The job runs as a chain of tasks, each of which
+    is routed to a queue suited to the work it does:
+
+    extract_inputs (io) -> run_model (cpu) -> package_output (io) -> notify_user (notifications)
+
+    DataFrames are passed between the tasks through the shared on-disk cache,
+    rather than through the broker.
+
+    If max_running_jobs is set, the job waits in the scheduler until it is its
+    turn to run (see the scheduler module), rather than being sent straight to Celery.
+
+    :param job: A JobSpec containing the parameters of the job (see the jobspec
+                module), which has been validated.  The fields are:
+                'job_id' - the job ID, which corresponds to where the results are
+                'db_key' - the primary key of the job in the database
+                'email' - the email address of the user running the job
+                'userhash' - the userhash of the user running the job, used to share
+                             the workers fairly between users
+                'location' - a tuple containing the (longitude, latitude) value of the
+                             location at which to run the code, or the (minLon, maxLon,
+                             minLat, maxLat) values of a region.  NOTE the X-Y order.
+                             Regions can only be run with the 'cumrain' metric, and
+                             produce gridded output.
+                'fc_location' - a tuple containing the (minLon, maxLon, minLat, maxLat)
+                                values of the bounding box over which to extract
+                                the met forecast data.  NOTE the X-Y order
+                'fc_var' - either "temperature" or "precipitation", passed to
+                           TAMSAT_ALERT code as met_ts_variable
+                'metric' - the name of the metric to run.
+                           Acceptable values are 'cumrain' and 'soilmoisture'
+                'cast_dates' - a list of forecast dates to run as a hindcast (see the
+                               hindcast module), or None.  Only for the 'cumrain'
+                               metric at a point.
+                'fingerprint' - the fingerprint of the job's parameters, or None.  If
+                                supplied, the output is kept in the result store so
+                                that it can be reused, and any identical jobs waiting
+                                for this one are completed with the same output.
+                'heavy' - whether the model runs of the job go to the 'heavy' queue
+                          (see is_heavy)
+                'quick' - whether the job is a quick query (see the quick module), which
+                          outputs its results as JSON rather than running the
+                          TAMSAT ALERT code.  Only for the 'cumrain' metric at a point.
+                'data_time' - the last time in the input data when the job was submitted,
+                              or None.  This is part of the fingerprint, so that
+                              results are not reused once there is newer data.
+                'submitted_time' - the time the job was submitted, which is set here
+                'cast_date', 'poi_start_day', 'poi_start_month', 'poi_end_day',
+                'poi_end_month', 'fc_start_day', 'fc_start_month', 'fc_end_day',
+                'fc_end_month', 'stat_type', 'tercile_weights', 'soil_type' - passed
+                directly to the TAMSAT ALERT code, and documented there.
+    '''
+    # Used to measure how long the job waits in the queue
+    job.submitted_time = time.time()
+    if not scheduler.enabled():
+        _job_chain(job).apply_async()
+        return
+    with scheduler.lock():
+        scheduler.add([job])
+    dispatch()
+
+def run_quick(job, budget_seconds):
+    '''
+    Runs a quick query (see the quick module) on the 'quick' queue, and waits for
+    its results.  The query is abandoned if it does not complete within its budget.
+
+    :param job:             A JobSpec containing the parameters of the query (see
+                            submit_job), which has been validated
+    :param budget_seconds:  The time allowed for the query, in seconds
+    :return:                A dict of the results of the query, or None if it
+                            could not be run within the budget
+    '''
+    result = _task('run_quick', job, budget_seconds).apply_async(expires=budget_seconds)
+    try:
+        results = result.get(timeout=budget_seconds, propagate=False)
+        # Failed queries are run as jobs instead, which report the failure to the user
+        return results if result.successful() else None
+    except TimeoutError:
+        return None
+    finally:
+        # The results are only read here, so they do not need to be kept
+        result.forget()
+
+def submit_jobs(jobs):
+    '''
+    Submits a batch of jobs to the queue.  The data needed by all of the jobs is
+    extracted together first (see prefetch_inputs), and then the jobs run in parallel.
+
+    :param jobs:    A list of JobSpecs containing the parameters of each job (see submit_job)
+    '''
+    submitted_time = time.time()
+    for job in jobs:
+        job.submitted_time = submitted_time
+    if not scheduler.enabled():
+        chain(_task('prefetch_inputs', jobs),
+              group(_job_chain(job) for job in jobs)).apply_async()
+        return
+    chain(_task('prefetch_inputs', jobs), _task('schedule_jobs', jobs)).apply_async()
+
+def dispatch():
+    '''
+    Sends as many waiting jobs to Celery as the scheduler allows
+    '''
+    with scheduler.lock():
+        jobs = scheduler.take()
+    for job in jobs:
+        _job_chain(job).apply_async()
+    if jobs:
+        # The positions of all other waiting jobs have changed
+        jobevents.jobs_changed(scheduler.waiting_userhashes())
+
+def notify_result_ready(email, job_id):
+    '''
+    Emails a user to tell them that the results of their job are ready, when
+    they were reused from an identical job rather than being computed
+
+    :param email:   The email address of the user
+    :param job_id:  The ID of the job
+    '''
+    _task('notify_result_ready', email, job_id).apply_async()
+
+def job_finished(job, succeeded):
+    '''
+    Frees a job's place in the scheduler for the next job
+    '''
+    if scheduler.enabled():
+        scheduler.finished(job['job_id'], succeeded)
+        dispatch()
+
+def _job_chain(job):
+    '''
+    :return: The chain of tasks which runs a job
+    '''
+    return chain(_task('extract_inputs', job),
+                 route_model_task(_task('run_model', job), job),
+                 _task('package_output', job),
+                 _task('notify_user', job))
+
+def route_model_task(signature, job):
+    '''
+    Routes a task which runs the model for a job to the 'heavy' queue, if the job is heavy
+    '''
+    if job.get('heavy'):
+        return signature.set(queue='heavy')
+    return signature
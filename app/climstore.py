@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+'''
+A store of precomputed per-pixel climatologies of cumulative rainfall.
+
+The total rainfall over a period of interest in each historical year depends only
+on the data and the period of interest, not on any other parameter of a job.  For
+each period of interest, this store holds these totals for every pixel in every
+complete year (covering both the climatology and ensemble years), along with the
+climatological tercile boundaries from both the empirical distribution and a
+fitted normal distribution.
+
+With the store, a region job or a quick query (see the quick module) only needs
+to read the days from the start of each year's period of interest up to the
+forecast date, rather than the whole archive.  Point jobs do not use the store,
+since they run the TAMSAT ALERT code, which reads the whole history itself.
+
+Each period of interest is a separate Zarr store, built from the time-series store
+(see the tsstore module).  Periods listed in the climatology_windows config value
+are built in advance, and any other period which is used by a job is built the
+next time the store is updated.  The stores are updated by the build_climatology_store
+Celery task, which runs after each daily update of the time-series store, or can be
+built by running this module as a script.
+
+A climatology only changes when another year's period of interest is complete, so
+it stays in use until the data reach the end of the next year's period, whether or
+not the time-series store has caught up with the daily files.
+'''
+
+import os
+import os.path
+import glob
+import fcntl
+import shutil
+import argparse
+import pandas as pd
+import xarray as xr
+from config import config
+import cache
+import ensemble
+import manifest
+import tsstore
+
+_YEARS_ATTR = 'tamsat_alert_years'
+_REQUEST_SUFFIX = '.requested'
+
+# The last time in each dataset, by glob expression, along with the version of
+# the dataset it was found in
+_last_times = {}
+
+
+def _years():
+    '''
+    :return: All years used for either the climatology or the ensemble members
+    '''
+    return sorted(set(range(int(config['Data']['climatology_start_year']),
+                            int(config['Data']['climatology_end_year']) + 1)) |
+                  set(range(int(config['Data']['period_of_interest_start_year']),
+                            int(config['Data']['period_of_interest_end_year']) + 1)))
+
+def _store_path(poi_start_day, poi_start_month, poi_end_day, poi_end_month):
+    return os.path.join(config['Data']['climatology_store'],
+                        'poi_{:02d}{:02d}_{:02d}{:02d}.zarr'.format(poi_start_day, poi_start_month,
+                                                                   poi_end_day, poi_end_month))
+
+def _complete_years(last_time, poi_start_day, poi_start_month, poi_end_day, poi_end_month):
+    '''
+    :return: The years whose period of interest ends on or before the given time
+    '''
+    return [year for year in _years()
+            if ensemble.season_bounds(year, poi_start_day, poi_start_month,
+                                      poi_end_day, poi_end_month)[1] <= last_time]
+
+def _last_time(path):
+    '''
+    Gets the last time in a dataset.  This relies on the lexical order of files
+    matching their temporal order, so only the last file is opened.
+
+    :param path:    A glob expression defining the location of the data
+    :return:        A pandas Timestamp, or None if there are no files
+    '''
+    version = cache.dataset_version(path)
+    if _last_times.get(path, (None,))[0] != version:
+        files = manifest.list_files(path)
+        if not files:
+            return None
+        with xr.open_dataset(files[-1]) as ds:
+            _last_times[path] = (version, pd.Timestamp(ds['time'].values.max()))
+    return _last_times[path][1]
+
+def configured_windows():
+    '''
+    Gets the periods of interest which should always be in the store.
+
+    These are given by the climatology_windows config value, as a comma-separated
+    list of periods in the form DD-MM:DD-MM (e.g. 01-10:31-12)
+
+    :return: A list of (poi_start_day, poi_start_month, poi_end_day, poi_end_month) tuples
+    '''
+    windows = []
+    for window in config['Data']['climatology_windows'].split(','):
+        if window.strip():
+            start, end = window.strip().split(':')
+            windows.append(tuple(int(part) for part in start.split('-') + end.split('-')))
+    return windows
+
+def request(poi_start_day, poi_start_month, poi_end_day, poi_end_month):
+    '''
+    Records that a period of interest has been used, so that it is added to
+    the store the next time it is updated
+    '''
+    store = _store_path(poi_start_day, poi_start_month, poi_end_day, poi_end_month)
+    if not os.path.exists(store):
+        os.makedirs(os.path.dirname(store), exist_ok=True)
+        open(store + _REQUEST_SUFFIX, 'a').close()
+
+def open_climatology(poi_start_day, poi_start_month, poi_end_day, poi_end_month):
+    '''
+    Opens the climatology for a period of interest, if it holds every year whose
+    period of interest is complete in the daily data
+
+    :return:    An xarray Dataset, or None if there is no up-to-date climatology
+                for the period of interest.  This contains the variables:
+                'season_total' - the total rainfall in each year, with the
+                                 dimensions (year, lat, lon)
+                'clim_mean', 'clim_std' - the mean and standard deviation of the
+                                          total rainfall in the climatology years
+                'clim_lower_ecdf', 'clim_upper_ecdf' - the empirical tercile
+                                                       boundaries of the climatology
+                'clim_lower_normal', 'clim_upper_normal' - the tercile boundaries
+                                                           of a fitted normal distribution
+    '''
+    store = _store_path(poi_start_day, poi_start_month, poi_end_day, poi_end_month)
+    if not os.path.exists(store):
+        return None
+    last_time = _last_time(config['Data']['tamsat_path'])
+    if last_time is None:
+        return None
+
+    ds = xr.open_zarr(store)
+    # The store only changes when another year's period of interest is complete
+    if list(ds.attrs.get(_YEARS_ATTR, [])) != \
+            _complete_years(last_time, poi_start_day, poi_start_month, poi_end_day, poi_end_month):
+        ds.close()
+        return None
+    return ds
+
+def build_window(poi_start_day, poi_start_month, poi_end_day, poi_end_month):
+    '''
+    Builds or rebuilds the climatology for a period of interest, if it is out of date
+
+    :return:    True if the climatology was built
+    '''
+    store = _store_path(poi_start_day, poi_start_month, poi_end_day, poi_end_month)
+    source = tsstore.open_store(config['Data']['tamsat_path'])
+    if source is None:
+        # The store is built from the time-series store, so wait for that to be updated
+        return False
+
+    os.makedirs(os.path.dirname(store), exist_ok=True)
+    with source, open(store + '.lock', 'w') as lock:
+        # Only one build can run at a time
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        years = _complete_years(pd.Timestamp(source['time'].values[-1]),
+                                poi_start_day, poi_start_month, poi_end_day, poi_end_month)
+        if os.path.exists(store):
+            with xr.open_zarr(store) as existing:
+                if list(existing.attrs.get(_YEARS_ATTR, [])) == years:
+                    return False
+        if not years:
+            return False
+
+        # Sum in double precision, as the ensemble module does
+        rainfall = source[config['Data']['precip_str']].astype('float64')
+        totals = []
+        for year in years:
+            start, end = ensemble.season_bounds(year, poi_start_day, poi_start_month,
+                                                poi_end_day, poi_end_month)
+            # Pixels with no data at all (e.g. over the sea) are missing, not zero
+            totals.append(rainfall.sel(time=slice(start, end)).sum('time', min_count=1))
+        season_total = xr.concat(totals, dim=pd.Index(years, name='year')) \
+            .transpose('year', 'lat', 'lon')
+
+        climatology = season_total.sel(year=[year for year in years
+                                             if int(config['Data']['climatology_start_year']) <= year
+                                             <= int(config['Data']['climatology_end_year'])]) \
+            .chunk({'year': -1})
+        output = xr.Dataset({'season_total': season_total})
+        output['clim_mean'] = climatology.mean('year')
+        output['clim_std'] = climatology.std('year', ddof=1)
+        output['clim_lower_ecdf'] = climatology.quantile(1.0 / 3, 'year').drop_vars('quantile')
+        output['clim_upper_ecdf'] = climatology.quantile(2.0 / 3, 'year').drop_vars('quantile')
+        # The terciles of a normal distribution are 0.4307 standard deviations from the mean
+        output['clim_lower_normal'] = output['clim_mean'] - 0.4307 * output['clim_std']
+        output['clim_upper_normal'] = output['clim_mean'] + 0.4307 * output['clim_std']
+        output.attrs[_YEARS_ATTR] = years
+
+        space_chunk = int(config['Data']['store_space_chunk']) * 4
+        output = output.chunk({'year': -1, 'lat': space_chunk, 'lon': space_chunk})
+        for var in output.variables.values():
+            var.encoding.pop('chunks', None)
+        # Write alongside the existing store, so readers never see a partial store
+        tmp_store = store + '.tmp'
+        output.to_zarr(tmp_store, mode='w', consolidated=True)
+        if os.path.exists(store):
+            old_store = store + '.old'
+            os.rename(store, old_store)
+            os.rename(tmp_store, store)
+            shutil.rmtree(old_store, ignore_errors=True)
+        else:
+            os.rename(tmp_store, store)
+
+    if os.path.exists(store + _REQUEST_SUFFIX):
+        os.remove(store + _REQUEST_SUFFIX)
+    return True
+
+def _requested_windows():
+    '''
+    :return: The periods of interest which are already in the store, or have been requested
+    '''
+    windows = []
+    for path in glob.glob(os.path.join(config['Data']['climatology_store'], 'poi_*.zarr*')):
+        name = os.path.basename(path)
+        if not (name.endswith('.zarr') or name.endswith('.zarr' + _REQUEST_SUFFIX)):
+            continue
+        start, end = name[len('poi_'):name.index('.zarr')].split('_')
+        windows.append((int(start[:2]), int(start[2:]), int(end[:2]), int(end[2:])))
+    return windows
+
+def build_all():
+    '''
+    Builds or updates the climatologies of all configured and requested periods of interest
+
+    :return:    A list of the periods of interest which were built
+    '''
+    built = []
+    for window in sorted(set(configured_windows()) | set(_requested_windows())):
+        if build_window(*window):
+            built.append(window)
+    return built
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build or update the precomputed climatologies of cumulative rainfall')
+    parser.parse_args()
+    for window in build_all():
+        print('Built climatology for {:02d}-{:02d} to {:02d}-{:02d}'.format(*window))
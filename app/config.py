@@ -1,24 +1,51 @@
 '''
 Configuration for the TAMSAT ALERT webapp.
 
-This defines default values, overrides them with the tamsat-alert.cfg
-file, and exports that object for use with other modules
+This defines default values, overrides them with the tamsat-alert.cfg file
+(or the file named by the TAMSAT_ALERT_CONFIG environment variable), and
+exports that object for use with other modules
 '''
 
+import os
 import configparser
 
 config = configparser.ConfigParser()
 # Set up default options, in case they are missing from the file
 config['Tasks'] = {'workdir': '/tmp/tamsat-alert',
                    'dbfile': '/tmp/tamsat-alert/ta-jobs.sqlite3',
+                   'db_busy_timeout': '30',
+                   'job_store': 'sqlite',
+                   'job_store_url': '',
                    'days_to_keep_completed': '7',
                    'hours_to_keep_downloaded': '24',
+                   'reuse_results_hours': '24',
+                   'waiter_expiry_hours': '24',
+                   'region_tile_size': '64',
+                   'max_batch_size': '1000',
+                   'quick_latency_budget': '2',
+                   'max_poll_seconds': '30',
+                   'events_timeout_seconds': '0.5',
+                   'max_running_jobs': '16',
+                   'point_job_weight': '4',
+                   'default_run_seconds': '60',
+                   'task_soft_time_limit': '3600',
+                   'task_time_limit': '3900',
+                   'max_memory_per_child_mb': '4096',
+                   'max_task_memory_mb': '0',
+                   'heavy_job_cost': '100000',
+                   'soil_moisture_cost': '50',
+                   'accel_redirect_prefix': '',
                    'download_link': 'www.tamsat.org.uk/alert/api/downloadResult'
                    }
 config['Email'] = {'server': 'smtp.reading.ac.uk',
                    'contact': 'tamsat@reading.ac.uk',
                    'username': 'CHANGEME',
-                   'password': 'CHANGEME'
+                   'password': 'CHANGEME',
+                   'ssl': 'true',
+                   'batch_seconds': '60',
+                   'rate_limit': '30/m',
+                   'max_retries': '5',
+                   'retry_seconds': '60'
                    }
 config['Data'] = {
 'tamsat_path': '/usr/local/tamsat-data/data/v3/daily/**/**/*.nc',
@@ -34,14 +61,33 @@ config['Data'] = {
                   'wind_v_comp_str': 'vwnd',
                   'humidity_str': 'shum',
                   'sm_lead_time': '5',
+                  'sm_variables': '',
                   'climatology_start_year': '1983',
                   'climatology_end_year': '2010',
                   'period_of_interest_start_year': '1983',
-                  'period_of_interest_end_year': '2010'
+                  'period_of_interest_end_year': '2010',
+                  'tamsat_store': '/usr/local/tamsat-data/data/v3/tamsat-ts.zarr',
+                  'store_time_chunk': '365',
+                  'store_space_chunk': '16',
+                  'store_max_tail_days': '31',
+                  'tamsat_area_index': '/usr/local/tamsat-data/data/v3/tamsat-area-index.zarr',
+                  'met_fc_temp_area_index': '/usr/local/tamsat-data/data/NCEP_data/air-area-index.zarr',
+                  'area_index_time_chunk': '64',
+                  'climatology_store': '/usr/local/tamsat-data/data/v3/climatology',
+                  'climatology_windows': '',
+                  'manifest_file': '/usr/local/tamsat-data/data/manifest.sqlite3'
                   }
+config['Cache'] = {'path': '/tmp/tamsat-alert/cache',
+                   'max_size_mb': '2048'
+                   }
 config['Celery'] = {'backend': 'redis://',
                     'broker': 'redis://'}
+config['Metrics'] = {'enabled': 'true',
+                     'flush_seconds': '10',
+                     'timeout_seconds': '0.5',
+                     'profile_jobs': 'false'}
 
 
-# Read the config file.  This will overwrite any defaults
-config.read('tamsat-alert.cfg')
+# Read the config file.  This will overwrite any defaults.  Another file can be
+# used by setting the TAMSAT_ALERT_CONFIG environment variable (e.g. for benchmarks)
+config.read(os.environ.get('TAMSAT_ALERT_CONFIG', 'tamsat-alert.cfg'))
@@ -1,69 +1,161 @@
 '''
-Factors out code dealing with the SQLite database.
+Factors out code dealing with the database of jobs.
+
+The state of jobs is kept in a job store, which is selected with the job_store
+config value:
+
+* 'sqlite' - a local SQLite file (see the jobstore_sqlite module).  The web
+  application and all Celery workers must share the filesystem containing it.
+* 'redis' - a Redis server (see the jobstore_redis module), which allows
+  workers to run on other nodes.
+
+Every job store provides all of the functions in this module, which simply pass
+their arguments on to the configured job store, timing each call (see the metrics
+module).  Functions which change the status of a job also return the job's
+userhash from the job store, so that changes to each user's jobs can be
+announced (see the jobevents module) once they have been committed.
 '''
 
-import sqlite3
+import threading
+import importlib
+from contextlib import contextmanager
 from config import config
-from datetime import timedelta, datetime as dt
-
-def _run_sql(command, values=(), expect_results=False, return_id=False):
-    '''
-    A convenience method for opening the database, running some SQL,
-    committing the result, and closing it again.
-
-    :param command:         The SQL to run
-    :param values:          A tuple of values to insert into the SQL statement
-    :param expect_results:  Whether the SQL command should return results.
-                            Optional, defaults to False
-    :param return_id:       Whether the SQL command should return the ID of inserted code.
-                            This is mutually exclusive with expect_results, with the
-                            former taking precedence.
-                            Optional, defaults to False
-    :return: A pandas DataFrame containing all variables present in the NetCDF dataset
-    '''
-    ret = None
-
-    db = sqlite3.connect(config['Tasks']['dbfile'])
-    # 'with' takes care of the commit, but doesn't close the DB
-    with db:
-        db.row_factory = sqlite3.Row
-        c = db.cursor()
-        c.execute(command, values)
-        if expect_results:
-            ret = c.fetchall()
-        elif return_id:
-            ret = c.lastrowid
-    db.close()
-
-    return ret
+import jobevents
+import metrics
+
+# The module implementing each job store
+_JOB_STORES = {
+    'sqlite': 'jobstore_sqlite',
+    'redis': 'jobstore_redis'
+}
+
+# The userhashes whose jobs have changed within the current thread's batch
+_local = threading.local()
+
+
+def _job_store():
+    '''
+    :return: The module implementing the configured job store
+    '''
+    name = config['Tasks']['job_store']
+    if name not in _JOB_STORES:
+        raise ValueError('Unknown job store: ' + name)
+    return importlib.import_module(_JOB_STORES[name])
+
+def _call(operation, *args):
+    '''
+    Calls a function of the configured job store, and records how long it took
+    '''
+    with metrics.timer('tamsat_alert_db_seconds', operation):
+        return getattr(_job_store(), operation)(*args)
+
+def _jobs_changed(userhash):
+    '''
+    Announces that a user's jobs have changed, or if within a batch, once the batch has been committed
+    '''
+    changed = getattr(_local, 'changed', None)
+    if changed is not None:
+        changed.add(userhash)
+    else:
+        jobevents.jobs_changed([userhash])
 
 def init():
     '''
-    Setup the job list database on first run, if necessary
+    Setup the job store on first run, if necessary
+    '''
+    _job_store().init()
+
+@contextmanager
+def batch():
+    '''
+    Groups all writes made by the current thread within a 'with' block, so that
+    they are made together, e.g. when updating the status of many jobs at once.
+
+    :return:    A context manager
     '''
-    _run_sql('''
-        CREATE TABLE IF NOT EXISTS jobs(id INTEGER PRIMARY KEY AUTOINCREMENT,
-            userhash TEXT,
-            status TEXT,
-            error_message TEXT,
-            time INTEGER,
-            description TEXT,
-            job_id TEXT)
-    ''')
+    if getattr(_local, 'changed', None) is not None:
+        # Nested batches join the outermost batch
+        with _job_store().batch():
+            yield
+        return
 
-def add_job(userhash, description):
+    _local.changed = set()
+    try:
+        with _job_store().batch():
+            yield
+        changed = _local.changed
+    finally:
+        _local.changed = None
+    jobevents.jobs_changed(changed)
+
+def add_job(userhash, description, fingerprint=None, job_id=None, status='QUEUED'):
     '''
-    Adds a new job to the database.  It will be in the state "QUEUED"
+    Adds a new job to the database.
 
     :param userhash:    A key to retrieve jobs by.  Designed to
                         be a hash of the email address + job ref
     :param description: A description of the job
+    :param fingerprint: The fingerprint of the job's parameters (see jobspec.JobSpec.make_fingerprint).
+                        Optional, defaults to None
+    :param job_id:      The job ID, if known at submission time.
+                        Optional, defaults to None
+    :param status:      The initial state of the job.
+                        Optional, defaults to "QUEUED"
     :return:            The primary ID of the job in the database
     '''
-    return _run_sql('''
-        INSERT INTO jobs(userhash, status, time, description) VALUES(?,?,?,?)
-    ''',
-    (userhash, 'QUEUED', int(dt.now().timestamp()), description), return_id=True)
+    db_key = _call('add_job', userhash, description, fingerprint, job_id, status)
+    _jobs_changed(userhash)
+    return db_key
+
+def find_job_by_fingerprint(fingerprint):
+    '''
+    Finds the most recent job which has run (or is running) with identical parameters.
+    Jobs which failed, or which are waiting for another job, are ignored.
+
+    :param fingerprint: The fingerprint of the job's parameters
+    :return:            An object containing the keys 'db_key', 'status', 'time'
+                        and 'job_id', or None if there is no such job
+    '''
+    return _call('find_job_by_fingerprint', fingerprint)
+
+def add_waiter(db_key, fingerprint, email):
+    '''
+    Records that a job is waiting for the result of an identical job
+
+    :param db_key:      The primary key of the waiting job
+    :param fingerprint: The fingerprint of the job's parameters
+    :param email:       The email address to notify when the result is ready
+    '''
+    _call('add_waiter', db_key, fingerprint, email)
+
+def claim_waiters(fingerprint):
+    '''
+    Removes and returns all jobs waiting for a result.  Each waiting job is only
+    returned to a single caller, even if called concurrently.
+
+    :param fingerprint: The fingerprint of the job's parameters
+    :return:            A list of (db_key, job_id, email) tuples
+    '''
+    return _call('claim_waiters', fingerprint)
+
+def claim_waiter(db_key):
+    '''
+    Removes a job from the list of waiting jobs
+
+    :param db_key:  The primary key of the waiting job
+    :return:        True if the job was waiting, and has now been claimed by the caller
+    '''
+    return _call('claim_waiter', db_key)
+
+def claim_expired_waiters(before):
+    '''
+    Removes and returns all jobs which have been waiting for a result since before
+    a given time, e.g. because the job they were waiting for was lost
+
+    :param before:  A datetime
+    :return:        A list of (db_key, job_id, email) tuples
+    '''
+    return _call('claim_expired_waiters', before)
 
 def set_job_running(db_key, job_id):
     '''
@@ -72,11 +164,7 @@ def set_job_running(db_key, job_id):
     :param db_key:  The primary key of the job to alter
     :param job_id:  The required job ID
     '''
-    _run_sql('''
-        UPDATE jobs SET status=?, time=?, job_id=?
-        WHERE id=?
-    ''',
-    ('RUNNING', int(dt.now().timestamp()), job_id, db_key))
+    _jobs_changed(_call('set_job_running', db_key, job_id))
 
 def set_job_completed(db_key):
     '''
@@ -84,11 +172,17 @@ def set_job_completed(db_key):
 
     :param db_key:  The primary key of the job to alter
     '''
-    _run_sql('''
-        UPDATE jobs SET status=?, time=?
-        WHERE id=?
-    ''',
-    ('COMPLETED', int(dt.now().timestamp()), db_key))
+    _jobs_changed(_call('set_job_completed', db_key))
+
+def add_job_resources(db_key, usage):
+    '''
+    Adds the resources used by one of a job's tasks to the job.  The peak memory
+    is the maximum over all of the job's tasks, and the other resources are totals.
+
+    :param db_key:  The primary key of the job to alter
+    :param usage:   A dict of the resources used, as returned by resources.finish
+    '''
+    _call('add_job_resources', db_key, usage)
 
 def get_jobs(userhash):
     '''
@@ -101,25 +195,9 @@ def get_jobs(userhash):
                         'status' - string representation of the job status
                         'time' - when the status was last updated (datetime.datetime)
                         'job_id' - the job ID, which corresponds to where the results are
+                        'error' - the error message, if the job failed
     '''
-    rows = _run_sql('''
-        SELECT description, status, time, job_id, error_message
-        FROM jobs
-        WHERE userhash=?
-    ''',
-    (userhash,),
-    True)
-
-    jobs = []
-    for row in rows:
-        jobs.append({
-            'description': row['description'],
-            'status': row['status'],
-            'time': dt.fromtimestamp(int(row['time'])),
-            'job_id': row['job_id'],
-            'error': row['error_message'],
-        })
-    return jobs
+    return _call('get_jobs', userhash)
 
 def set_downloaded(job_id):
     '''
@@ -127,64 +205,38 @@ def set_downloaded(job_id):
 
     :param job_id:  The job ID of the job to alter
     '''
-    _run_sql('''
-                UPDATE jobs SET status=?, time=?
-                WHERE job_id=?
-            ''',
-            ('DOWNLOADED', int(dt.now().timestamp()), job_id))
+    _jobs_changed(_call('set_downloaded', job_id))
 
 def set_error(job_id, message):
     '''
     Sets a job's state to "ERROR"
 
     :param job_id:  The job ID of the job to alter
+    :param message: The error message
     '''
-    _run_sql('''
-                UPDATE jobs SET status=?, error_message=?, time=?
-                WHERE job_id=?
-            ''',
-            ('ERROR', message, int(dt.now().timestamp()), job_id))
+    _jobs_changed(_call('set_error', job_id, message))
 
 def remove_expired_jobs():
     '''
     Removes expired jobs from the database.
 
-    This uses the expiry times from the config module
+    This uses the expiry times from the config module.  Job stores which expire
+    jobs themselves (i.e. Redis) have nothing to do here.
 
     :return:    A list of job IDs which were removed
     '''
-    removed_job_ids=[]
-
-    db = sqlite3.connect(config['Tasks']['dbfile'])
-    # 'with' takes care of the commit, but doesn't close the DB
-    # Read all of the jobs
-    with db:
-        db.row_factory = sqlite3.Row
-        c = db.cursor()
-        c.execute('''
-            SELECT id, status, time, job_id
-            FROM jobs
-            ''')
-        rows = c.fetchall()
-
-        # Find which jobs are expired
-        for row in rows:
-            time = dt.fromtimestamp(int(row['time']))
-            expiry_time_completed = time + \
-                timedelta(days=int(config['Tasks']['days_to_keep_completed']))
-            expiry_time_downloaded = time + \
-                timedelta(hours=int(config['Tasks']['hours_to_keep_downloaded']))
-            if ((row['status'] == 'COMPLETED' or row['status'] == 'ERROR') \
-                        and dt.now() > expiry_time_completed) or \
-                    (row['status'] == 'DOWNLOADED' and dt.now() > expiry_time_downloaded):
-                removed_job_ids.append(row['job_id'])
-
-                # Remove the entry from the database
-                c.execute('''
-                    DELETE from jobs WHERE id=?
-                ''', (row['id'],))
-    db.close()
+    removed_job_ids = _call('remove_expired_jobs')
+    jobevents.jobs_expired()
     return removed_job_ids
 
+def find_existing_job_ids(job_ids):
+    '''
+    Finds which of a number of job IDs belong to jobs in the database
+
+    :param job_ids: An iterable of job IDs
+    :return:        A set of the job IDs which are in the database
+    '''
+    return _call('find_existing_job_ids', job_ids)
+
 # Init database when this module is imported
 init()
@@ -0,0 +1,140 @@
+'''
+A registry of open multiple-file datasets, held by each process.
+
+Opening a multiple-file dataset means expanding its glob, opening every file and
+decoding its metadata, which can take much longer than the extraction itself.
+Instead, each dataset is opened once per process, when it is first used, and
+kept open between tasks.
+
+Changes to the files of a dataset are detected from its version (see
+cache.dataset_version), which only lists the files again when one of the
+directories containing them has been modified, so checking is cheap.  When files
+containing later times have been added, only those files are opened, and appended
+to the open dataset.  Otherwise the dataset is opened again.  Either way, the
+dataset which was open before is left open, since another thread may still be
+reading it, and its files are closed when it is no longer used.
+
+Where the file manifest of a dataset is up to date (see the manifest module),
+it is used to list the files in temporal order, and a process which has not
+opened a dataset only opens the files covering the period it needs.
+'''
+
+import threading
+from contextlib import contextmanager
+import xarray as xr
+from config import config
+import cache
+import manifest
+
+# The open dataset for each glob expression, along with its version and files
+_datasets = {}
+_lock = threading.Lock()
+# The number of files opened by this process (see the resources module)
+files_opened = 0
+
+
+def configured_paths():
+    '''
+    :return: The glob expressions of all datasets used by jobs, from the config
+    '''
+    return [config['Data']['tamsat_path'],
+            config['Data']['met_fc_temp_path'],
+            config['Data']['met_fc_path']]
+
+def _count_files(files):
+    global files_opened
+    files_opened += len(files)
+
+def _open(files):
+    _count_files(files)
+    return xr.open_mfdataset(files, combine='by_coords')
+
+def _append(ds, files):
+    '''
+    Appends the times in a number of files which are later than the end of a dataset
+
+    :return:    The combined dataset, which closes both parts
+    '''
+    new = _open(files)
+    new = new.sel(time=new['time'] > ds['time'].values[-1])
+    combined = xr.concat([ds, new], dim='time', data_vars='minimal',
+                         coords='minimal', compat='override')
+
+    def close():
+        ds.close()
+        new.close()
+    combined.set_close(close)
+    return combined
+
+def _get(path):
+    '''
+    Gets the open dataset for a glob expression, opening it or appending new files
+    to it if necessary
+    '''
+    version = cache.dataset_version(path)
+    with _lock:
+        if path in _datasets and _datasets[path][0] == version:
+            return _datasets[path][2]
+        files = manifest.find_files(path) or manifest.list_files(path)
+        if path in _datasets:
+            opened_files, ds = _datasets[path][1:]
+            added = files[len(opened_files):]
+            if files[:len(opened_files)] == opened_files and added and \
+                    _file_start(added[0]) > ds['time'].values[-1]:
+                ds = _append(ds, added)
+            else:
+                ds = _open(files)
+        else:
+            ds = _open(files)
+        _datasets[path] = (version, files, ds)
+        return ds
+
+def _file_start(filename):
+    with xr.open_dataset(filename) as ds:
+        return ds['time'].values.min()
+
+def _select(ds, start, end, times):
+    '''
+    Selects the times in a period from a dataset
+    '''
+    if start is not None or end is not None:
+        ds = ds.sel(time=slice(start, end))
+    if times is not None:
+        ds = ds.sel(time=ds.indexes['time'].intersection(times))
+    return ds
+
+@contextmanager
+def open_dataset(path, start=None, end=None, times=None):
+    '''
+    Gets the open dataset for a glob expression.  Unlike xr.open_mfdataset, the
+    dataset stays open after the 'with' block, so that it can be reused.
+
+    If a period is given, only the times in that period are selected.  If the
+    dataset is not already open, only the files covering that period are opened
+    (if the manifest is up to date), and they are closed at the end of the 'with'
+    block.
+
+    :param path:    A glob expression defining the location of the data
+    :param start:   The first time needed.  Optional, defaults to the start of the data
+    :param end:     The last time needed.  Optional, defaults to the end of the data
+    :param times:   A list of the only times needed.  Optional, defaults to every time
+    :return:        A context manager giving an xarray Dataset
+    '''
+    with _lock:
+        is_open = path in _datasets
+    if not is_open and (start is not None or end is not None or times is not None):
+        files = manifest.find_files(path, start, end, times)
+        if files:
+            with _open(files) as ds:
+                yield _select(ds, start, end, times)
+            return
+    yield _select(_get(path), start, end, times)
+
+def close_all():
+    '''
+    Closes all open datasets
+    '''
+    with _lock:
+        for version, files, ds in _datasets.values():
+            ds.close()
+        _datasets.clear()
@@ -0,0 +1,369 @@
+'''
+Vectorised computation of the TAMSAT ALERT cumulative rainfall ensemble.
+
+This follows the same method as the cumulative rainfall code in TAMSAT ALERT, but
+works on arrays of rainfall with any number of trailing (spatial) dimensions, so that
+every pixel in a region is processed in a single pass of array operations:
+
+* Each ensemble member is the observed rainfall in the current period of interest
+  up to the forecast date, plus the rainfall over the remainder of the period of
+  interest in a historical year
+* Members are weighted according to which tercile the forecast driving variable
+  fell in for their year, using the tercile weights supplied by the user
+* The climatology is the total rainfall over the period of interest in each
+  climatological year
+* The probability of each climatological tercile is then calculated from the
+  weighted ensemble, either empirically or by fitting a normal distribution
+
+For hindcasts, the ensembles for many forecast dates are built together (see
+cumrain_hindcast), and can be scored against the observed rainfall with the
+ranked probability score.
+'''
+
+import calendar
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+
+
+def _date(year, month, day):
+    '''
+    Creates a date, clipping the day to the end of the month (e.g. for 29th Feb)
+    '''
+    return pd.Timestamp(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+def season_bounds(year, start_day, start_month, end_day, end_month):
+    '''
+    Gets the start and end of a seasonal window starting in a given year.
+    If the end is before the start, the window ends in the following year.
+
+    :return:    A tuple of (start, end) pandas Timestamps, both inclusive
+    '''
+    start = _date(year, start_month, start_day)
+    end = _date(year, end_month, end_day)
+    if end < start:
+        end = _date(year + 1, end_month, end_day)
+    return start, end
+
+def first_season_ending_after(date, start_day, start_month, end_day, end_month):
+    '''
+    Gets the first occurrence of a seasonal window which ends on or after a date
+
+    :return:    A tuple of (start, end) pandas Timestamps, both inclusive
+    '''
+    for year in (date.year - 1, date.year, date.year + 1):
+        start, end = season_bounds(year, start_day, start_month, end_day, end_month)
+        if end >= date:
+            return start, end
+
+def _period_sums(times, cumsum, starts, ends):
+    '''
+    Sums values over a number of periods, using their cumulative sum
+
+    :param times:   A pandas DatetimeIndex of the times of the values
+    :param cumsum:  The cumulative sum of the values along the first axis,
+                    with a leading zero
+    :param starts:  The (inclusive) start of each period
+    :param ends:    The (inclusive) end of each period
+    :return:        An array with one sum per period along the first axis
+    '''
+    i0 = times.searchsorted(pd.DatetimeIndex(starts), side='left')
+    i1 = times.searchsorted(pd.DatetimeIndex(ends), side='right')
+    return cumsum[i1] - cumsum[i0]
+
+def _cumsum(rainfall):
+    '''
+    :return: The cumulative sum of rainfall along the first axis, with a leading zero
+    '''
+    return np.concatenate([np.zeros((1,) + rainfall.shape[1:]),
+                           np.nancumsum(rainfall, axis=0, dtype=float)])
+
+def member_weights(fc_series, years, poi_start_day, poi_start_month,
+                   fc_start_day, fc_start_month, fc_end_day, fc_end_month,
+                   tercile_weights):
+    '''
+    Calculates the weight of each ensemble member from the forecast driving variable
+
+    :param fc_series:       A pandas Series of the forecast driving variable
+    :param years:           The year of each ensemble member
+    :param tercile_weights: A tuple of the weights of the lower, middle and upper
+                            terciles of the forecast driving variable
+    :return:                An array of weights, which sum to 1
+    '''
+    values = []
+    for year in years:
+        poi_start = _date(year, poi_start_month, poi_start_day)
+        start, end = first_season_ending_after(poi_start, fc_start_day, fc_start_month,
+                                               fc_end_day, fc_end_month)
+        values.append(fc_series[start:end].mean())
+    values = np.array(values)
+
+    if np.isnan(values).any():
+        # We can't categorise every year, so don't weight the ensemble
+        return np.full(len(years), 1.0 / len(years))
+
+    t1, t2 = np.percentile(values, [100.0 / 3, 200.0 / 3])
+    category = np.where(values <= t1, 0, np.where(values > t2, 2, 1))
+    counts = np.bincount(category, minlength=3)
+    weights = np.array(tercile_weights, dtype=float)[category] / counts[category]
+    return weights / weights.sum()
+
+def cumrain_ensemble(times, rainfall, fc_series, cast_date,
+                     poi_start_day, poi_start_month, poi_end_day, poi_end_month,
+                     fc_start_day, fc_start_month, fc_end_day, fc_end_month,
+                     tercile_weights, clim_years, ensemble_years, season_totals=None):
+    '''
+    Builds the cumulative rainfall ensemble and climatology
+
+    :param times:           A pandas DatetimeIndex of the (daily) rainfall times
+    :param rainfall:        A numpy array of rainfall, with time as its first axis,
+                            followed by any number of other axes
+    :param fc_series:       A pandas Series of the forecast driving variable
+    :param cast_date:       The forecast date
+    :param tercile_weights: A tuple of the weights of the lower, middle and upper
+                            terciles of the forecast driving variable
+    :param clim_years:      The years to use for the climatology
+    :param ensemble_years:  The years to use for the ensemble members.  Any
+                            year overlapping the current season is ignored, as
+                            are any years which are not complete.
+    :param season_totals:   A dict mapping each complete year to its total rainfall
+                            over the period of interest (see the climstore module).
+                            If given, the rainfall only needs to cover the current
+                            season up to the forecast date, and the same number of
+                            days from the start of each ensemble year's season.
+                            Optional, defaults to calculating the totals from the rainfall
+    :return:                A dict containing the arrays:
+                            'members' - the total rainfall of each ensemble member
+                            'years' - the year of each ensemble member
+                            'weights' - the weight of each ensemble member
+                            'climatology' - the total rainfall in each climatological year
+                            'observed' - the observed rainfall up to the forecast date
+    '''
+    cumsum = _cumsum(rainfall)
+
+    # Find the current season, and how far through it the forecast date is
+    season_start, season_end = first_season_ending_after(cast_date,
+                                                         poi_start_day, poi_start_month,
+                                                         poi_end_day, poi_end_month)
+    days_observed = max(0, (cast_date - season_start).days)
+    if days_observed > 0:
+        observed = _period_sums(times, cumsum,
+                                [season_start], [cast_date - pd.Timedelta(days=1)])[0]
+    else:
+        observed = np.zeros(rainfall.shape[1:])
+
+    # Only use complete years which don't overlap the current season
+    def complete(year):
+        if season_totals is not None:
+            return year in season_totals
+        return season_bounds(year, poi_start_day, poi_start_month,
+                             poi_end_day, poi_end_month)[1] <= times[-1]
+    ensemble_years = [year for year in ensemble_years
+                      if year != season_start.year and complete(year)]
+    clim_years = [year for year in clim_years if complete(year)]
+
+    member_starts = []
+    member_ends = []
+    for year in ensemble_years:
+        start, end = season_bounds(year, poi_start_day, poi_start_month,
+                                   poi_end_day, poi_end_month)
+        member_starts.append(start + pd.Timedelta(days=days_observed))
+        member_ends.append(end)
+
+    if season_totals is None:
+        remainders = _period_sums(times, cumsum, member_starts, member_ends)
+
+        clim_starts = []
+        clim_ends = []
+        for year in clim_years:
+            start, end = season_bounds(year, poi_start_day, poi_start_month,
+                                       poi_end_day, poi_end_month)
+            clim_starts.append(start)
+            clim_ends.append(end)
+        climatology = _period_sums(times, cumsum, clim_starts, clim_ends)
+    else:
+        # The remainder of each season is its total, less the rainfall before the forecast date
+        remainders = np.array([season_totals[year] for year in ensemble_years])
+        if days_observed > 0:
+            remainders = remainders - _period_sums(times, cumsum,
+                                                   [start - pd.Timedelta(days=days_observed)
+                                                    for start in member_starts],
+                                                   [start - pd.Timedelta(days=1)
+                                                    for start in member_starts])
+        climatology = np.array([season_totals[year] for year in clim_years])
+
+    return {
+        'members': observed + remainders,
+        'years': ensemble_years,
+        'weights': member_weights(fc_series, ensemble_years,
+                                  poi_start_day, poi_start_month,
+                                  fc_start_day, fc_start_month, fc_end_day, fc_end_month,
+                                  tercile_weights),
+        'climatology': climatology,
+        'observed': observed
+    }
+
+def cumrain_hindcast(times, rainfall, fc_series, cast_dates,
+                     poi_start_day, poi_start_month, poi_end_day, poi_end_month,
+                     fc_start_day, fc_start_month, fc_end_day, fc_end_month,
+                     tercile_weights, clim_years, ensemble_years):
+    '''
+    Builds the cumulative rainfall ensembles for a number of forecast dates at once.
+    This is equivalent to calling cumrain_ensemble for each date, but the
+    climatology and the historical rainfall are only computed once.
+
+    Every ensemble has the same members, but members which overlap the season
+    of a forecast date have zero weight for that date.
+
+    :param times:           A pandas DatetimeIndex of the (daily) rainfall times
+    :param rainfall:        A numpy array of rainfall, with time as its first axis,
+                            followed by any number of other axes
+    :param fc_series:       A pandas Series of the forecast driving variable
+    :param cast_dates:      The forecast dates
+    :param tercile_weights: A tuple of the weights of the lower, middle and upper
+                            terciles of the forecast driving variable
+    :param clim_years:      The years to use for the climatology
+    :param ensemble_years:  The years to use for the ensemble members.  Any
+                            years which are not complete are ignored.
+    :return:                A dict containing the arrays:
+                            'members' - the total rainfall of each ensemble member,
+                                        with members along the first axis and
+                                        forecast dates along the second
+                            'years' - the year of each ensemble member
+                            'weights' - the weight of each ensemble member for
+                                        each forecast date
+                            'climatology' - the total rainfall in each climatological year
+                            'observed' - the observed rainfall up to each forecast date
+                            'verification' - the total rainfall over the season of
+                                             each forecast date, or NaN if the
+                                             season is not complete
+    '''
+    cumsum = _cumsum(rainfall)
+
+    def complete(year):
+        return season_bounds(year, poi_start_day, poi_start_month,
+                             poi_end_day, poi_end_month)[1] <= times[-1]
+    ensemble_years = [year for year in ensemble_years if complete(year)]
+    clim_years = [year for year in clim_years if complete(year)]
+    member_seasons = [season_bounds(year, poi_start_day, poi_start_month,
+                                    poi_end_day, poi_end_month)
+                      for year in ensemble_years]
+    clim_seasons = [season_bounds(year, poi_start_day, poi_start_month,
+                                  poi_end_day, poi_end_month)
+                    for year in clim_years]
+
+    # Find the season of each forecast date, and how far through it the date is
+    seasons = [first_season_ending_after(cast_date, poi_start_day, poi_start_month,
+                                         poi_end_day, poi_end_month)
+               for cast_date in cast_dates]
+    days_observed = [max(0, (cast_date - start).days)
+                     for cast_date, (start, end) in zip(cast_dates, seasons)]
+    observed = _period_sums(times, cumsum,
+                            [start for start, end in seasons],
+                            [start + pd.Timedelta(days=days - 1)
+                             for (start, end), days in zip(seasons, days_observed)])
+    # Dates before the start of their season have observed nothing
+    not_started = np.array(days_observed) == 0
+    observed[not_started] = 0
+
+    # Sum the remainder of the season in every member year for every date at once
+    remainders = _period_sums(times, cumsum,
+                              [start + pd.Timedelta(days=days)
+                               for start, end in member_seasons for days in days_observed],
+                              [end for start, end in member_seasons for days in days_observed])
+    remainders = remainders.reshape((len(ensemble_years), len(cast_dates)) + rainfall.shape[1:])
+
+    # Members overlapping the season being forecast are excluded by giving them zero weight
+    weights = np.zeros((len(ensemble_years), len(cast_dates)))
+    for i, (start, end) in enumerate(seasons):
+        used = [j for j, year in enumerate(ensemble_years) if year != start.year]
+        weights[used, i] = member_weights(fc_series, [ensemble_years[j] for j in used],
+                                          poi_start_day, poi_start_month,
+                                          fc_start_day, fc_start_month,
+                                          fc_end_day, fc_end_month,
+                                          tercile_weights)
+
+    verification = _period_sums(times, cumsum,
+                                [start for start, end in seasons],
+                                [end for start, end in seasons])
+    verification[np.array([end > times[-1] for start, end in seasons])] = np.nan
+
+    return {
+        'members': observed + remainders,
+        'years': ensemble_years,
+        'weights': weights,
+        'climatology': _period_sums(times, cumsum,
+                                    [start for start, end in clim_seasons],
+                                    [end for start, end in clim_seasons]),
+        'observed': observed,
+        'verification': verification
+    }
+
+def ranked_probability_score(prob_lower, prob_middle, observed_tercile):
+    '''
+    Calculates the ranked probability score of tercile forecasts.  This is 0 for a
+    perfect forecast, and 1 for a forecast which put all probability in the wrong
+    extreme tercile.
+
+    :param prob_lower:          The forecast probability of the lower tercile
+    :param prob_middle:         The forecast probability of the middle tercile
+    :param observed_tercile:    The observed tercile (0, 1 or 2)
+    :return:                    The ranked probability score of each forecast
+    '''
+    cumulative_lower = prob_lower
+    cumulative_middle = prob_lower + prob_middle
+    return ((cumulative_lower - (observed_tercile <= 0)) ** 2 +
+            (cumulative_middle - (observed_tercile <= 1)) ** 2) / 2
+
+def tercile_probabilities(members, weights, climatology, stat_type, clim_bounds=None):
+    '''
+    Calculates the probability of each climatological tercile from a weighted ensemble
+
+    :param members:     The ensemble members, with members along the first axis
+    :param weights:     The weight of each ensemble member.  This is either 1D, or
+                        has the same leading dimensions as the members
+    :param climatology: The climatological values, with years along the first axis
+    :param stat_type:   The probability distribution to use.  'normal', or 'ecdf'
+    :param clim_bounds: A tuple of the (lower, upper) tercile boundaries of the
+                        climatology for the given distribution, if they have been
+                        precomputed (see the climstore module).  Optional, defaults
+                        to calculating them from the climatology
+    :return:            A dict containing the arrays:
+                        'prob_lower', 'prob_middle', 'prob_upper' - the probabilities of each tercile
+                        'ensemble_mean', 'ensemble_std' - the weighted ensemble statistics
+                        'clim_mean' - the climatological mean
+                        'clim_lower', 'clim_upper' - the climatological tercile boundaries
+    '''
+    weights = weights.reshape(weights.shape + (1,) * (members.ndim - weights.ndim))
+    ensemble_mean = (weights * members).sum(axis=0)
+    ensemble_std = np.sqrt((weights * (members - ensemble_mean) ** 2).sum(axis=0))
+    clim_mean = climatology.mean(axis=0)
+
+    if clim_bounds is not None:
+        clim_lower, clim_upper = clim_bounds
+    elif stat_type == 'normal':
+        clim_std = climatology.std(axis=0, ddof=1)
+        # The terciles of a normal distribution are 0.4307 standard deviations from the mean
+        clim_lower = clim_mean - 0.4307 * clim_std
+        clim_upper = clim_mean + 0.4307 * clim_std
+    else:
+        clim_lower, clim_upper = np.percentile(climatology, [100.0 / 3, 200.0 / 3], axis=0)
+
+    if stat_type == 'normal':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            prob_lower = ndtr((clim_lower - ensemble_mean) / ensemble_std)
+            prob_upper = 1 - ndtr((clim_upper - ensemble_mean) / ensemble_std)
+    else:
+        prob_lower = (weights * (members <= clim_lower)).sum(axis=0)
+        prob_upper = (weights * (members > clim_upper)).sum(axis=0)
+
+    return {
+        'prob_lower': prob_lower,
+        'prob_middle': 1 - prob_lower - prob_upper,
+        'prob_upper': prob_upper,
+        'ensemble_mean': ensemble_mean,
+        'ensemble_std': ensemble_std,
+        'clim_mean': clim_mean,
+        'clim_lower': clim_lower,
+        'clim_upper': clim_upper
+    }
@@ -0,0 +1,292 @@
+'''
+Extraction of timeseries from the TAMSAT and NCEP archives.
+
+This provides the same functions as tamsat_alert.extract_data, serving repeated
+requests from the on-disk cache (see the cache module) rather than re-opening the
+archive.  Where an up-to-date time-series store exists for a dataset (see the
+tsstore module), data is read from that rather than from the daily files.  Area
+means are computed from the summed-area table index (see the areaindex module)
+where possible.  Otherwise, data is read from the daily files, which are kept
+open between jobs (see the datasets module).
+'''
+
+import hashlib
+import numpy as np
+import pandas as pd
+import xarray as xr
+import areaindex
+import cache
+import datasets
+import manifest
+import tsstore
+
+# The time range is not present in the NCEP data, so it is calculated under this name
+TEMP_RANGE_STR = 'trange'
+
+
+def grid_axes(path, version=None):
+    '''
+    Gets the longitude and latitude axes of a dataset.  These are read from a
+    single file, and cached alongside the extracted data.
+
+    :param path:    A glob expression defining the location of the data
+    :param version: The current version of the dataset (see cache.dataset_version).
+                    Optional, and looked up if not provided
+    :return:        A tuple of (longitudes, latitudes) as numpy arrays
+    '''
+    if version is None:
+        version = cache.dataset_version(path)
+    axes = [cache.get(cache.make_key('grid', path, version, name))
+            for name in ('lon', 'lat')]
+    if any(axis is None for axis in axes):
+        first_file = manifest.list_files(path)[0]
+        with xr.open_dataset(first_file) as ds:
+            axes = [pd.DataFrame({name: ds[name].values})
+                    for name in ('lon', 'lat')]
+        for name, axis in zip(('lon', 'lat'), axes):
+            cache.put(cache.make_key('grid', path, version, name), axis)
+    return axes[0]['lon'].values, axes[1]['lat'].values
+
+def snap_to_grid(path, lon, lat, version=None):
+    '''
+    Finds the grid cell of a dataset containing a location
+
+    :param path:    A glob expression defining the location of the data
+    :param lon:     The longitude
+    :param lat:     The latitude
+    :param version: The current version of the dataset.  Optional, and looked up
+                    if not provided
+    :return:        A tuple of (x index, y index) of the nearest grid cell
+    '''
+    if version is None:
+        version = cache.dataset_version(path)
+    lons, lats = grid_axes(path, version)
+    return int(np.abs(lons - lon).argmin()), int(np.abs(lats - lat).argmin())
+
+def extract_point_timeseries(path, lon, lat, fast_only=False):
+    '''
+    Extracts a timeseries of all variables at the grid cell nearest to a location.
+
+    This is equivalent to tamsat_alert.extract_data.extract_point_timeseries, but
+    results are cached by grid cell, so any location within the same cell is
+    served from the cache until new data files arrive.
+
+    :param path:        A glob expression defining the location of the data
+    :param lon:         The longitude
+    :param lat:         The latitude
+    :param fast_only:   If True, only read from the cache or the time-series store,
+                        rather than from the daily files.  Optional, defaults to False
+    :return:            A pandas DataFrame containing all variables present in the NetCDF
+                        dataset, or None if fast_only is True and the data is not
+                        available from a fast source
+    '''
+    version = cache.dataset_version(path)
+    cell = snap_to_grid(path, lon, lat, version)
+    key = cache.make_key('point', path, version, cell, 'all')
+
+    data = cache.get(key)
+    if data is None:
+        store = tsstore.open_store(path)
+        if store is not None:
+            with store:
+                data = tsstore.extract_point_timeseries(store, lon, lat)
+        elif fast_only:
+            return None
+        else:
+            with datasets.open_dataset(path) as ds:
+                data = tsstore.extract_point_timeseries(ds, lon, lat)
+        cache.put(key, data)
+    return data
+
+def prefetch_point_timeseries(path, locations):
+    '''
+    Extracts timeseries at a number of locations into the cache, so that later
+    calls to extract_point_timeseries at those locations are served from the cache.
+
+    Rather than reading each location separately, all grid cells which are not
+    already cached are read in a single pass over the data.
+
+    :param path:        A glob expression defining the location of the data
+    :param locations:   A list of (lon, lat) tuples
+    :return:            The number of grid cells which were read
+    '''
+    version = cache.dataset_version(path)
+    keys = {}
+    for lon, lat in locations:
+        cell = snap_to_grid(path, lon, lat, version)
+        key = cache.make_key('point', path, version, cell, 'all')
+        if cell not in keys and cache.get(key) is None:
+            keys[cell] = key
+    if not keys:
+        return 0
+
+    cells = list(keys)
+    store = tsstore.open_store(path)
+    with store if store is not None else datasets.open_dataset(path) as ds:
+        # Select every cell at once, along a new 'cell' dimension
+        points = ds.isel(lon=xr.DataArray([x for x, y in cells], dims='cell'),
+                         lat=xr.DataArray([y for x, y in cells], dims='cell')) \
+            .reset_coords(drop=True).load()
+    for i, cell in enumerate(cells):
+        cache.put(keys[cell], points.isel(cell=i).to_dataframe())
+    return len(cells)
+
+def _read_drivers(path, cells, variables, start, times):
+    '''
+    Reads the meteorological drivers of the soil moisture code at a number of grid cells.
+
+    Only the requested variables from the start time onwards, at the requested
+    times, are selected (lazily), and the daily temperature range is added to the
+    same dask graph, so that all of the data is read and computed in a single pass.
+
+    :return: A list of pandas DataFrames, one per cell
+    '''
+    with datasets.open_dataset(path, start=start) as ds:
+        if variables:
+            # The temperature range is calculated from the daily extremes
+            ds = ds[sorted(set(variables) | {'tmax', 'tmin'})]
+        points = ds.sel(time=slice(start, None)) \
+            .isel(lon=xr.DataArray([x for x, y in cells], dims='cell'),
+                  lat=xr.DataArray([y for x, y in cells], dims='cell')) \
+            .reset_coords(drop=True)
+        if times is not None:
+            points = points.sel(time=points.indexes['time'].intersection(times))
+        points[TEMP_RANGE_STR] = points['tmax'] - points['tmin']
+        points = points.load()
+    return [points.isel(cell=i).to_dataframe() for i in range(len(cells))]
+
+def _drivers_key(path, version, cell, variables, start, times):
+    # The times are hashed, since their representation is large and slow to make
+    times = None if times is None else \
+        hashlib.md5(pd.DatetimeIndex(times).asi8.tobytes()).hexdigest()
+    return cache.make_key('drivers', path, version, cell,
+                          tuple(sorted(variables or ())), str(start), times)
+
+def extract_point_drivers(path, lon, lat, variables=None, start=None, times=None):
+    '''
+    Extracts a timeseries of the meteorological drivers of the soil moisture code
+    at the grid cell nearest to a location, along with the daily temperature
+    range (as TEMP_RANGE_STR).  Results are cached by grid cell.
+
+    :param path:        A glob expression defining the location of the data
+    :param lon:         The longitude
+    :param lat:         The latitude
+    :param variables:   A list of the variables to extract.  Optional, defaults to all variables
+    :param start:       The first time to extract.  Optional, defaults to the start of the data
+    :param times:       The times to extract, e.g. the index of the TAMSAT data at
+                        the location, so that the result can be joined to it
+                        directly.  Times which are not in the data are left out.
+                        Optional, defaults to every time from start onwards
+    :return:            A pandas DataFrame
+    '''
+    version = cache.dataset_version(path)
+    cell = snap_to_grid(path, lon, lat, version)
+    key = _drivers_key(path, version, cell, variables, start, times)
+
+    data = cache.get(key)
+    if data is None:
+        data = _read_drivers(path, [cell], variables, start, times)[0]
+        cache.put(key, data)
+    return data
+
+def prefetch_point_drivers(path, locations, variables=None, start=None, times=None):
+    '''
+    Extracts the meteorological drivers at a number of locations into the cache,
+    so that later calls to extract_point_drivers with the same parameters are
+    served from the cache.  All grid cells which are not already cached are read
+    in a single pass over the data.
+
+    :param path:        A glob expression defining the location of the data
+    :param locations:   A list of (lon, lat) tuples
+    :param variables:   A list of the variables to extract.  Optional, defaults to all variables
+    :param start:       The first time to extract.  Optional, defaults to the start of the data
+    :param times:       The times to extract, e.g. the index of the TAMSAT data at
+                        the location, so that the result can be joined to it
+                        directly.  Times which are not in the data are left out.
+                        Optional, defaults to every time from start onwards
+    :return:            The number of grid cells which were read
+    '''
+    version = cache.dataset_version(path)
+    keys = {}
+    for lon, lat in locations:
+        cell = snap_to_grid(path, lon, lat, version)
+        key = _drivers_key(path, version, cell, variables, start, times)
+        if cell not in keys and cache.get(key) is None:
+            keys[cell] = key
+    if not keys:
+        return 0
+
+    cells = list(keys)
+    for cell, data in zip(cells, _read_drivers(path, cells, variables, start, times)):
+        cache.put(keys[cell], data)
+    return len(cells)
+
+def extract_area_mean_timeseries(path, minlon, maxlon, minlat, maxlat, fast_only=False):
+    '''
+    Extracts a timeseries of the spatial mean of all variables over a bounding box.
+
+    This is equivalent to tamsat_alert.extract_data.extract_area_mean_timeseries,
+    but results are cached, so that commonly used boxes (e.g. the presets offered
+    by the frontend) are served from the cache until new data files arrive.
+
+    :param path:        A glob expression defining the location of the data
+    :param minlon:      The western edge of the bounding box
+    :param maxlon:      The eastern edge of the bounding box
+    :param minlat:      The southern edge of the bounding box
+    :param maxlat:      The northern edge of the bounding box
+    :param fast_only:   If True, only read from the cache, the summed-area table index
+                        or the time-series store, rather than from the daily files.
+                        Optional, defaults to False
+    :return:            A pandas DataFrame containing all variables present in the NetCDF
+                        dataset, or None if fast_only is True and the data is not
+                        available from a fast source
+    '''
+    version = cache.dataset_version(path)
+    key = cache.make_key('area', path, version, (minlon, maxlon, minlat, maxlat))
+
+    data = cache.get(key)
+    if data is None:
+        data = _extract_area_mean_timeseries(path, minlon, maxlon, minlat, maxlat, fast_only)
+        if data is None:
+            return None
+        cache.put(key, data)
+    return data
+
+def _extract_area_mean_timeseries(path, minlon, maxlon, minlat, maxlat, fast_only=False):
+    '''
+    Extracts an area mean from the fastest up-to-date source
+    '''
+    index = areaindex.open_index(path)
+    if index is not None:
+        with index:
+            return areaindex.extract_area_mean_timeseries(index, minlon, maxlon, minlat, maxlat)
+    store = tsstore.open_store(path)
+    if store is not None:
+        with store:
+            return tsstore.extract_area_mean_timeseries(store, minlon, maxlon, minlat, maxlat)
+    if fast_only:
+        return None
+    with datasets.open_dataset(path) as ds:
+        return tsstore.extract_area_mean_timeseries(ds, minlon, maxlon, minlat, maxlat)
+
+def extract_region(path, minlon, maxlon, minlat, maxlat, start=None, end=None, times=None):
+    '''
+    Extracts all variables over a bounding box
+
+    :param path:    A glob expression defining the location of the data
+    :param minlon:  The western edge of the bounding box
+    :param maxlon:  The eastern edge of the bounding box
+    :param minlat:  The southern edge of the bounding box
+    :param maxlat:  The northern edge of the bounding box
+    :param start:   The first time to extract.  Optional, defaults to the start of the data
+    :param end:     The last time to extract.  Optional, defaults to the end of the data
+    :param times:   A list of the only times to extract, within start and end.
+                    Optional, defaults to every time
+    :return:        An xarray Dataset with the dimensions (time, lat, lon)
+    '''
+    store = tsstore.open_store(path)
+    with store if store is not None else datasets.open_dataset(path, start, end, times) as ds:
+        ds = tsstore.select_box(ds, minlon, maxlon, minlat, maxlat).sel(time=slice(start, end))
+        if times is not None:
+            ds = ds.sel(time=ds['time'].isin(pd.DatetimeIndex(times)))
+        return ds.load()
@@ -0,0 +1,124 @@
+'''
+Running the TAMSAT ALERT cumulative rainfall metric as a hindcast.
+
+A hindcast runs the metric at a single location for many forecast dates.  Rather
+than running a job per date, the data is extracted once and the ensembles for all
+dates are built together (see ensemble.cumrain_hindcast).  Where the season of a
+forecast date is complete, the forecast is scored against the observed rainfall.
+
+The output is a CSV file with a row per forecast date, and a JSON summary of the
+skill of the forecasts over all dates.
+'''
+
+import os.path
+import json
+import numpy as np
+import pandas as pd
+from config import config
+import ensemble
+import region
+
+HINDCAST_FILE = 'tamsat_alert_hindcast.csv'
+SUMMARY_FILE = 'tamsat_alert_hindcast_summary.json'
+
+
+def cast_date_range(start, end, step_days):
+    '''
+    Gets a regular range of forecast dates
+
+    :param start:       The first forecast date
+    :param end:         The last possible forecast date
+    :param step_days:   The number of days between forecast dates
+    :return:            A list of pandas Timestamps
+    '''
+    return list(pd.date_range(start, end, freq=pd.Timedelta(days=step_days)))
+
+def run_cumrain(data, fc_data, fc_var, cast_dates,
+                poi_start_day, poi_start_month, poi_end_day, poi_end_month,
+                fc_start_day, fc_start_month, fc_end_day, fc_end_month,
+                stat_type, tercile_weights, output_path, location_name=None):
+    '''
+    Runs the cumulative rainfall metric for a number of forecast dates, and
+    writes the results and their skill to the output directory
+
+    :param data:            A pandas DataFrame of the data at the location, as
+                            returned by extract_point_timeseries
+    :param fc_data:         A pandas DataFrame of the forecast driving data, as
+                            returned by extract_area_mean_timeseries
+    :param fc_var:          Either "temperature" or "precipitation"
+    :param cast_dates:      A list of the forecast dates
+    :param output_path:     The directory to write the output to
+    :param location_name:   A description of the location, written to the summary.
+                            Optional, defaults to None
+
+    All other parameters are the same as for region.run_cumrain
+    '''
+    cast_dates = sorted(pd.Timestamp(cast_date) for cast_date in cast_dates)
+    rainfall = data[config['Data']['precip_str']]
+
+    members = ensemble.cumrain_hindcast(pd.DatetimeIndex(rainfall.index),
+                                        rainfall.values,
+                                        region.fc_series(fc_data, fc_var),
+                                        cast_dates,
+                                        poi_start_day, poi_start_month,
+                                        poi_end_day, poi_end_month,
+                                        fc_start_day, fc_start_month,
+                                        fc_end_day, fc_end_month,
+                                        tercile_weights,
+                                        region.climatology_years(),
+                                        region.ensemble_years())
+    results = ensemble.tercile_probabilities(members['members'],
+                                             members['weights'],
+                                             members['climatology'],
+                                             stat_type)
+
+    # Score the forecasts whose season has been observed
+    verification = members['verification']
+    verified = np.isfinite(verification)
+    observed_tercile = np.where(verification <= results['clim_lower'], 0,
+                                np.where(verification > results['clim_upper'], 2, 1))
+    rps = np.where(verified,
+                   ensemble.ranked_probability_score(results['prob_lower'],
+                                                     results['prob_middle'],
+                                                     observed_tercile),
+                   np.nan)
+    # The score of always forecasting the climatological probabilities
+    clim_rps = np.where(verified,
+                        ensemble.ranked_probability_score(1.0 / 3, 1.0 / 3, observed_tercile),
+                        np.nan)
+
+    output = pd.DataFrame({
+        'forecast_date': [cast_date.date() for cast_date in cast_dates],
+        'prob_lower': results['prob_lower'],
+        'prob_middle': results['prob_middle'],
+        'prob_upper': results['prob_upper'],
+        'ensemble_mean': results['ensemble_mean'],
+        'ensemble_std': results['ensemble_std'],
+        'observed_to_date': members['observed'],
+        'observed_total': verification,
+        'observed_tercile': np.where(verified, observed_tercile + 1, np.nan),
+        'rps': rps
+    })
+    output.to_csv(os.path.join(output_path, HINDCAST_FILE), index=False)
+
+    n_verified = int(verified.sum())
+    summary = {
+        'location': location_name,
+        'probability_distribution': stat_type,
+        'n_forecasts': len(cast_dates),
+        'n_verified': n_verified,
+        'clim_mean': float(results['clim_mean']),
+        'clim_lower': float(results['clim_lower']),
+        'clim_upper': float(results['clim_upper']),
+        'mean_rps': None,
+        'mean_clim_rps': None,
+        'rpss': None
+    }
+    if n_verified > 0:
+        summary['mean_rps'] = float(np.nanmean(rps))
+        summary['mean_clim_rps'] = float(np.nanmean(clim_rps))
+        if summary['mean_clim_rps'] > 0:
+            # The ranked probability skill score, relative to climatology
+            summary['rpss'] = 1 - summary['mean_rps'] / summary['mean_clim_rps']
+    with open(os.path.join(output_path, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=2)
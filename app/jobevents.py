@@ -0,0 +1,130 @@
+'''
+Notifications of changes to users' jobs, kept in the Celery broker's Redis server.
+
+Each user (i.e. userhash) has a version number, which is incremented whenever
+one of their jobs is added or changes status (see the database module), and
+published to a channel so that waiting requests are woken straight away.  The
+version is used as the ETag of /api/jobs, so that a user's list of jobs only
+needs to be read from the database when it has changed.
+
+Removing expired jobs changes many users' lists at once, so this increments a
+single global version instead, which is part of every user's version.  Every
+version also starts with a random epoch, which is chosen when Redis has none, so
+that if the counters are lost (e.g. Redis restarts without persistence), old
+ETags cannot match the new versions.
+
+If Redis is unavailable, versions cannot be read, so /api/jobs is served
+without an ETag rather than failing.
+'''
+
+import time
+import uuid
+import logging
+import redis
+from config import config
+
+log = logging.getLogger(__name__)
+
+_PREFIX = 'tamsat-alert:jobs-version:'
+_CHANNEL_PREFIX = 'tamsat-alert:jobs-changed:'
+_GLOBAL = 'all'
+_EPOCH = 'epoch'
+
+_clients = {}
+
+
+def _client():
+    url = config['Celery']['broker']
+    if url not in _clients:
+        # Requests to the web application wait for Redis, so give up quickly
+        timeout = float(config['Tasks']['events_timeout_seconds'])
+        _clients[url] = redis.Redis.from_url(url, decode_responses=True,
+                                             socket_timeout=timeout,
+                                             socket_connect_timeout=timeout)
+    return _clients[url]
+
+def jobs_changed(userhashes):
+    '''
+    Records that the jobs of a number of users have changed.  Problems are
+    logged rather than raised, since the change has already been made.
+
+    :param userhashes:  An iterable of the userhashes of the users
+    '''
+    userhashes = [userhash for userhash in userhashes if userhash is not None]
+    if not userhashes:
+        return
+    # Versions are kept for as long as the jobs which they describe
+    ttl = int(config['Tasks']['days_to_keep_completed']) * 86400
+    try:
+        pipe = _client().pipeline(transaction=False)
+        for userhash in userhashes:
+            pipe.incr(_PREFIX + userhash)
+            pipe.expire(_PREFIX + userhash, ttl)
+            pipe.publish(_CHANNEL_PREFIX + userhash, 'changed')
+        pipe.execute()
+    except Exception as e:
+        log.error('Problem recording changes to jobs: ' + str(e))
+
+def jobs_expired():
+    '''
+    Records that expired jobs have been removed, which may change the jobs of any user
+    '''
+    try:
+        _client().incr(_PREFIX + _GLOBAL)
+    except Exception as e:
+        log.error('Problem recording removal of jobs: ' + str(e))
+
+def version(userhash):
+    '''
+    Gets the current version of a user's jobs.  This must be read before the jobs
+    themselves, so that the jobs are never older than the version.  Problems
+    reading it are logged rather than raised.
+
+    :param userhash:    The userhash of the user
+    :return:            The version, as a string, or None if it could not be read
+    '''
+    try:
+        client = _client()
+        epoch, global_version, user_version = client.mget(
+            _PREFIX + _EPOCH, _PREFIX + _GLOBAL, _PREFIX + userhash)
+        if epoch is None:
+            # Whichever request sets the epoch first, all use the same one
+            client.setnx(_PREFIX + _EPOCH, uuid.uuid4().hex[:8])
+            epoch = client.get(_PREFIX + _EPOCH)
+    except Exception as e:
+        log.error('Problem reading the version of jobs: ' + str(e))
+        return None
+    return '{}-{}-{}'.format(epoch, global_version or 0, user_version or 0)
+
+def wait(userhash, known_version, timeout):
+    '''
+    Waits until a user's jobs change
+
+    :param userhash:        The userhash of the user
+    :param known_version:   The version the caller already has
+    :param timeout:         The maximum time to wait, in seconds
+    :return:                The new version, known_version if the jobs did not
+                            change within the timeout, or None if the version
+                            could not be read
+    '''
+    deadline = time.monotonic() + timeout
+    try:
+        pubsub = _client().pubsub(ignore_subscribe_messages=True)
+        try:
+            # Subscribe before checking the version, so that no change is missed
+            pubsub.subscribe(_CHANNEL_PREFIX + userhash)
+            current = version(userhash)
+            while current == known_version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Check again after each message, or each second, since the
+                # global version changes without a message
+                pubsub.get_message(timeout=min(remaining, 1.0))
+                current = version(userhash)
+            return current
+        finally:
+            pubsub.close()
+    except Exception as e:
+        log.error('Problem waiting for changes to jobs: ' + str(e))
+        return None
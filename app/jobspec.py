@@ -0,0 +1,266 @@
+'''
+The parameters of a job, and their encoding in Celery messages and the scheduler.
+
+Jobs are passed between the web application, the scheduler and the Celery
+workers as JobSpec objects, which are encoded as compact JSON rather than pickled.
+Each job is encoded as a JSON array of the schema version followed by the value
+of each field, in the order of FIELDS, with dates as integers.  So the
+messages are small and quick to decode, and do not depend on the versions of
+Python or pandas on either side.
+
+When the fields change, SCHEMA_VERSION must be incremented, and a function which
+converts the values of the previous version added to _UPGRADES, so that jobs
+which were queued before the upgrade can still be run.  Jobs with an unknown
+version are rejected rather than misread.
+
+The encoding of the fields which affect the output of a job is also used as its
+fingerprint (see make_fingerprint), so that identical jobs can share their results.
+'''
+
+import json
+import hashlib
+
+SCHEMA_VERSION = 3
+
+# The name of the Celery serializer (see register_serializer)
+SERIALIZER = 'tamsat-job'
+CONTENT_TYPE = 'application/x-tamsat-job'
+
+# The fields of a job, in the order in which they are encoded.  See
+# client.submit_job for their meanings.
+FIELDS = ('job_id', 'db_key', 'email', 'userhash', 'location', 'fc_location', 'fc_var',
+          'metric', 'cast_date', 'cast_dates', 'fingerprint', 'poi_start_day',
+          'poi_start_month', 'poi_end_day', 'poi_end_month', 'fc_start_day',
+          'fc_start_month', 'fc_end_day', 'fc_end_month', 'stat_type', 'tercile_weights',
+          'soil_type', 'heavy', 'submitted_time', 'quick', 'data_time')
+
+# The fields which affect the output of a job, and so make up its fingerprint
+OUTPUT_FIELDS = ('location', 'fc_location', 'fc_var', 'metric', 'cast_date', 'cast_dates',
+                 'poi_start_day', 'poi_start_month', 'poi_end_day', 'poi_end_month',
+                 'fc_start_day', 'fc_start_month', 'fc_end_day', 'fc_end_month',
+                 'stat_type', 'tercile_weights', 'soil_type', 'quick', 'data_time')
+
+# The database key is not required, since jobs are validated before they are added
+_REQUIRED_FIELDS = ('job_id', 'email', 'location', 'fc_location', 'fc_var',
+                    'metric', 'cast_date', 'poi_start_day', 'poi_start_month',
+                    'poi_end_day', 'poi_end_month', 'fc_start_day', 'fc_start_month',
+                    'fc_end_day', 'fc_end_month', 'stat_type', 'tercile_weights')
+_TUPLE_FIELDS = ('location', 'fc_location', 'tercile_weights')
+_DATE_FIELDS = ('cast_date', 'cast_dates', 'data_time')
+_DAY_FIELDS = ('poi_start_day', 'poi_end_day', 'fc_start_day', 'fc_end_day')
+_MONTH_FIELDS = ('poi_start_month', 'poi_end_month', 'fc_start_month', 'fc_end_month')
+
+METRICS = ('cumrain', 'wrsi', 'soilmoisture')
+FC_VARS = ('temperature', 'precipitation')
+STAT_TYPES = ('normal', 'ecdf')
+
+# Functions which convert the encoded values of each earlier schema version to
+# those of the next version
+_UPGRADES = {
+    # Version 2 added 'quick'
+    1: lambda values: values + [False],
+    # Version 3 added 'data_time'
+    2: lambda values: values + [None],
+}
+
+
+class JobSpec(object):
+    '''
+    The parameters of a job.  Fields can be read as attributes or, like the
+    dicts which were used for jobs before, with job['field'] and job.get('field').
+    '''
+    __slots__ = FIELDS
+
+    def __init__(self, **fields):
+        '''
+        :param fields:  The value of each field.  Fields which are not given are None,
+                        except for 'heavy' and 'quick', which are False.
+        '''
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise TypeError('Unknown job fields: ' + ', '.join(sorted(unknown)))
+        for name in FIELDS:
+            setattr(self, name, fields.get(name))
+        self.heavy = bool(self.heavy)
+        self.quick = bool(self.quick)
+
+    def __getitem__(self, name):
+        if name not in FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in FIELDS:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None) if name in FIELDS else None
+        return default if value is None else value
+
+    def __eq__(self, other):
+        return isinstance(other, JobSpec) and self.encode() == other.encode()
+
+    def __repr__(self):
+        return 'JobSpec({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name))
+                                              for name in FIELDS))
+
+    def validate(self):
+        '''
+        Checks that the fields have valid values.  This is done once, when the job
+        is submitted, so jobs are not checked again when they are decoded.
+
+        :raises ValueError: If any field is invalid
+        '''
+        missing = [name for name in _REQUIRED_FIELDS if getattr(self, name) is None]
+        if missing:
+            raise ValueError('Missing job fields: ' + ', '.join(missing))
+        if len(self.location) not in (2, 4):
+            raise ValueError('The location must be a point or a region')
+        if len(self.fc_location) != 4:
+            raise ValueError('The forecast location must be a region')
+        if len(self.tercile_weights) != 3:
+            raise ValueError('There must be three tercile weights')
+        if self.metric not in METRICS:
+            raise ValueError('Unknown metric: ' + str(self.metric))
+        if self.fc_var not in FC_VARS:
+            raise ValueError('The forecast variable must be one of ' + ', '.join(FC_VARS))
+        if self.stat_type not in STAT_TYPES:
+            raise ValueError('The probability distribution must be one of ' + ', '.join(STAT_TYPES))
+        if self.metric == 'soilmoisture' and self.soil_type is None:
+            raise ValueError('Soil moisture jobs must have a soil type')
+        if self.quick and (self.metric != 'cumrain' or len(self.location) != 2
+                           or self.cast_dates is not None):
+            raise ValueError('Only cumulative rainfall forecasts at a point can be quick queries')
+        for name in _DAY_FIELDS:
+            if not 1 <= getattr(self, name) <= 31:
+                raise ValueError('Invalid day: ' + str(getattr(self, name)))
+        for name in _MONTH_FIELDS:
+            if not 1 <= getattr(self, name) <= 12:
+                raise ValueError('Invalid month: ' + str(getattr(self, name)))
+        # Imported here, so that the thin client (see the client module) does not
+        # load pandas unless it validates or decodes jobs
+        import pandas as pd
+        # Normalise the types, so that the job is unchanged by encoding and decoding it
+        for name in _TUPLE_FIELDS:
+            setattr(self, name, tuple(float(value) for value in getattr(self, name)))
+        self.cast_date = pd.Timestamp(self.cast_date)
+        if self.cast_dates is not None:
+            self.cast_dates = [pd.Timestamp(cast_date) for cast_date in self.cast_dates]
+        if self.data_time is not None:
+            self.data_time = pd.Timestamp(self.data_time)
+
+    def encode(self, fields=FIELDS):
+        '''
+        :param fields:  The fields to encode.  Optional, defaults to all fields
+        :return:        A list of the schema version followed by the encoded
+                        value of each field, which can be serialised as JSON
+        '''
+        values = [SCHEMA_VERSION]
+        for name in fields:
+            value = getattr(self, name)
+            if value is not None and name in _DATE_FIELDS:
+                value = _encode_dates(value)
+            values.append(value)
+        return values
+
+    @classmethod
+    def decode(cls, values):
+        '''
+        :param values:  A list of values, as returned by encode
+        :return:        A JobSpec
+        :raises ValueError: If the values have an unknown schema version
+        '''
+        version, values = values[0], values[1:]
+        while version != SCHEMA_VERSION:
+            if version not in _UPGRADES:
+                raise ValueError('Unknown job schema version: ' + str(version))
+            values = _UPGRADES[version](values)
+            version += 1
+        # Bypass __init__, since the values are known to be complete and valid
+        job = cls.__new__(cls)
+        for name, value in zip(FIELDS, values):
+            if value is not None:
+                if name in _TUPLE_FIELDS:
+                    value = tuple(value)
+                elif name in _DATE_FIELDS:
+                    value = _decode_dates(value)
+            setattr(job, name, value)
+        return job
+
+    def make_fingerprint(self):
+        '''
+        Gets a fingerprint of the parameters which affect the output of the job.
+        Jobs with identical parameters produce identical results, and so have
+        identical fingerprints.
+
+        :return:    The fingerprint, as a string
+        '''
+        return hashlib.sha256(dumps(self.encode(OUTPUT_FIELDS))).hexdigest()
+
+
+def _encode_dates(value):
+    # Dates are encoded as nanoseconds since 1970, as pandas stores them, which
+    # is much quicker to convert than ISO 8601
+    if isinstance(value, list):
+        return [date.value for date in value]
+    return value.value
+
+def _decode_dates(value):
+    import pandas as pd
+    if isinstance(value, list):
+        return [pd.Timestamp(date) for date in value]
+    return pd.Timestamp(value)
+
+def dumps(value):
+    '''
+    Encodes a value, which may contain jobs, as compact JSON.  Jobs are tagged,
+    so that they can be anywhere in the value, and a job which appears more
+    than once (e.g. in each task of a job's chain) is only encoded once.
+
+    :param value:   The value, e.g. the body of a task message
+    :return:        The encoded value, as UTF-8 bytes
+    '''
+    # The index of each job encoded so far, by id
+    indexes = {}
+
+    def default(obj):
+        if not isinstance(obj, JobSpec):
+            raise TypeError('Cannot encode ' + type(obj).__name__)
+        if id(obj) in indexes:
+            return {'__jobref__': indexes[id(obj)]}
+        indexes[id(obj)] = len(indexes)
+        return {'__job__': obj.encode()}
+
+    return json.dumps(value, default=default, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+def loads(data):
+    '''
+    Decodes a value encoded by dumps
+
+    :param data:    The encoded value, as bytes or a string
+    :return:        The value, with the jobs decoded into JobSpecs
+    '''
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    # The jobs decoded so far, which are in the same order as they were encoded
+    jobs = []
+
+    def object_hook(obj):
+        if len(obj) == 1:
+            if '__job__' in obj:
+                jobs.append(JobSpec.decode(obj['__job__']))
+                return jobs[-1]
+            if '__jobref__' in obj:
+                return jobs[obj['__jobref__']]
+        return obj
+
+    return json.loads(data, object_hook=object_hook)
+
+def register_serializer():
+    '''
+    Registers the encoding as a Celery (i.e. kombu) serializer, named SERIALIZER
+    '''
+    from kombu.serialization import register
+    register(SERIALIZER, dumps, loads, content_type=CONTENT_TYPE, content_encoding='binary')
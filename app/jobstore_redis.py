@@ -0,0 +1,400 @@
+'''
+The Redis job store (see the database module), which keeps the state of jobs in
+Redis, so that the web application and Celery workers do not need to share a
+filesystem.
+
+The data is laid out as follows (all keys are prefixed with _PREFIX):
+
+* job:<db_key> - a hash of the fields of each job, including the resources used
+  by its tasks (see the resources module)
+* job-id:<job_id> - the db_key of the job with each job ID
+* user:<userhash> - a sorted set of the db_keys of each user's jobs
+* fingerprint:<fingerprint> - a sorted set of the db_keys of jobs which have run
+  (or are running) with each set of parameters
+* waiter:<db_key> - a hash of the fingerprint and email of each waiting job
+* waiters:<fingerprint> - a set of the db_keys of jobs waiting for each set of parameters
+* waiting - a sorted set of the db_keys of all waiting jobs, by the time they started waiting
+
+Rather than being removed by remove_expired_jobs, completed jobs are given a
+time-to-live when their status changes, and Redis removes them when it expires.
+Sorted sets may briefly refer to expired jobs, which are removed when found.
+
+Within a batch, claiming waiting jobs and changing the status of jobs are sent
+together in a single MULTI/EXEC transaction at the end of the batch, so that a
+crash part way through never leaves a claimed job without its new status.
+'''
+
+import threading
+from contextlib import contextmanager
+from datetime import timedelta, datetime as dt
+import redis
+from config import config
+
+_PREFIX = 'tamsat-alert:'
+
+_clients = {}
+
+# The batch of the current thread, if any (see batch)
+_local = threading.local()
+
+
+def _client():
+    '''
+    Gets the Redis client for the configured server.  Clients are safe to
+    share between threads, and reconnect after a fork.
+    '''
+    url = config['Tasks']['job_store_url'] or config['Celery']['broker']
+    if url not in _clients:
+        _clients[url] = redis.Redis.from_url(url, decode_responses=True)
+    return _clients[url]
+
+def _key(*parts):
+    return _PREFIX + ':'.join(str(part) for part in parts)
+
+def _ttl(status):
+    '''
+    :return: How many seconds a job with the given status should be kept for,
+             or None if it should be kept indefinitely
+    '''
+    if status in ('COMPLETED', 'ERROR'):
+        return int(timedelta(days=int(config['Tasks']['days_to_keep_completed'])).total_seconds())
+    if status == 'DOWNLOADED':
+        return int(timedelta(hours=int(config['Tasks']['hours_to_keep_downloaded'])).total_seconds())
+    return None
+
+def _set_status(db_key, status, **fields):
+    '''
+    Updates the status of a job (along with any other fields), and sets how long
+    the job should be kept for
+
+    :return: The userhash of the job, or None if it has expired
+    '''
+    r = _client()
+    job_key = _key('job', db_key)
+    userhash, fingerprint, job_id = r.hmget(job_key, 'userhash', 'fingerprint', 'job_id')
+    if userhash is None:
+        # The job has expired
+        return None
+
+    fields['status'] = status
+    fields['time'] = int(dt.now().timestamp())
+    job_id = fields.get('job_id', job_id)
+    ttl = _ttl(status)
+
+    def write(pipe):
+        pipe.hset(job_key, mapping=fields)
+        keys = [job_key]
+        if job_id:
+            pipe.set(_key('job-id', job_id), db_key)
+            keys.append(_key('job-id', job_id))
+        for key in keys:
+            if ttl is None:
+                pipe.persist(key)
+            else:
+                pipe.expire(key, ttl)
+        # The user's list of jobs must last as long as their most recently changed job
+        user_key = _key('user', userhash)
+        if ttl is None:
+            pipe.persist(user_key)
+        else:
+            pipe.expire(user_key, _ttl('COMPLETED'))
+        if fingerprint:
+            pipe.expire(_key('fingerprint', fingerprint), _ttl('COMPLETED'))
+
+    _write(db_key, write)
+    return userhash
+
+def _write(db_key, write):
+    '''
+    Makes a number of writes about a job, straight away or at the end of the
+    current batch
+
+    :param db_key:  The job the writes are about
+    :param write:   A function which adds the writes to a pipeline
+    '''
+    current = getattr(_local, 'batch', None)
+    if current is not None:
+        current['writes'].append((str(db_key), write))
+        return
+    pipe = _client().pipeline()
+    write(pipe)
+    pipe.execute()
+
+def _commit(current):
+    '''
+    Sends the writes of a batch in a single transaction.  If another process
+    claims one of the jobs claimed in the batch first, the writes about that
+    job are dropped, since the other process now owns it.
+    '''
+    r = _client()
+    waiter_keys = [_key('waiter', db_key) for db_key in current['claimed']]
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                lost = set()
+                if waiter_keys:
+                    pipe.watch(*waiter_keys)
+                    lost = set(db_key for db_key in current['claimed']
+                               if not pipe.exists(_key('waiter', db_key)))
+                pipe.multi()
+                for db_key, write in current['writes']:
+                    if db_key not in lost:
+                        write(pipe)
+                pipe.execute()
+                return
+            except redis.WatchError:
+                # A claimed job changed, so check which are still waiting
+                continue
+
+def _job_key_from_id(job_id):
+    return _client().get(_key('job-id', job_id))
+
+def init():
+    '''
+    Nothing needs to be set up in Redis
+    '''
+    pass
+
+@contextmanager
+def batch():
+    '''
+    Groups the claims of waiting jobs and changes of status made by the current
+    thread within a 'with' block into a single transaction, which is sent at the
+    end of the block, or discarded if it raises an exception.  Nested batches
+    join the outermost batch.  Other writes are made straight away.
+    '''
+    if getattr(_local, 'batch', None) is not None:
+        yield
+        return
+
+    _local.batch = {'claimed': [], 'writes': []}
+    try:
+        yield
+        current = _local.batch
+    finally:
+        _local.batch = None
+    _commit(current)
+
+def add_job(userhash, description, fingerprint=None, job_id=None, status='QUEUED'):
+    '''
+    Adds a new job.  See database.add_job
+    '''
+    r = _client()
+    db_key = r.incr(_key('next-id'))
+    # Redis can't store None, so missing values are stored as empty strings
+    r.hset(_key('job', db_key), mapping={
+        'userhash': userhash,
+        'status': status,
+        'error_message': '',
+        'time': int(dt.now().timestamp()),
+        'description': description,
+        'job_id': job_id or '',
+        'fingerprint': fingerprint or ''
+    })
+    pipe = r.pipeline()
+    pipe.zadd(_key('user', userhash), {db_key: db_key})
+    if fingerprint:
+        pipe.zadd(_key('fingerprint', fingerprint), {db_key: db_key})
+    pipe.execute()
+    _set_status(db_key, status, job_id=job_id or '')
+    return db_key
+
+def find_job_by_fingerprint(fingerprint):
+    '''
+    Finds the most recent job with identical parameters.  See database.find_job_by_fingerprint
+    '''
+    r = _client()
+    fingerprint_key = _key('fingerprint', fingerprint)
+    for db_key in r.zrevrange(fingerprint_key, 0, -1):
+        status, time, job_id = r.hmget(_key('job', db_key), 'status', 'time', 'job_id')
+        if status is None:
+            r.zrem(fingerprint_key, db_key)
+        elif status != 'ERROR':
+            return {
+                'db_key': int(db_key),
+                'status': status,
+                'time': dt.fromtimestamp(int(time)),
+                'job_id': job_id or None
+            }
+    return None
+
+def add_waiter(db_key, fingerprint, email):
+    '''
+    Records that a job is waiting for an identical job.  See database.add_waiter
+    '''
+    pipe = _client().pipeline()
+    pipe.hset(_key('waiter', db_key), mapping={'fingerprint': fingerprint, 'email': email})
+    pipe.sadd(_key('waiters', fingerprint), db_key)
+    pipe.zadd(_key('waiting'), {db_key: int(dt.now().timestamp())})
+    # Waiting jobs are not found by find_job_by_fingerprint
+    pipe.zrem(_key('fingerprint', fingerprint), db_key)
+    pipe.execute()
+
+def _claim(db_key):
+    '''
+    Atomically removes a waiting job.  Within a batch, the job is removed when
+    the batch is sent, unless another process has claimed it by then.
+
+    :return: The waiter's fields, or None if the job was not waiting
+    '''
+    r = _client()
+    current = getattr(_local, 'batch', None)
+    if current is not None:
+        waiter = r.hgetall(_key('waiter', db_key))
+        if not waiter or str(db_key) in current['claimed']:
+            return None
+        current['claimed'].append(str(db_key))
+
+        def write(pipe):
+            pipe.delete(_key('waiter', db_key))
+            pipe.srem(_key('waiters', waiter['fingerprint']), db_key)
+            pipe.zrem(_key('waiting'), db_key)
+            pipe.zadd(_key('fingerprint', waiter['fingerprint']), {db_key: db_key})
+
+        current['writes'].append((str(db_key), write))
+        return waiter
+
+    pipe = r.pipeline()
+    pipe.hgetall(_key('waiter', db_key))
+    pipe.delete(_key('waiter', db_key))
+    waiter, n_deleted = pipe.execute()
+    if n_deleted != 1:
+        return None
+
+    # The job is no longer waiting, so can be found by find_job_by_fingerprint
+    pipe = r.pipeline()
+    pipe.srem(_key('waiters', waiter['fingerprint']), db_key)
+    pipe.zrem(_key('waiting'), db_key)
+    pipe.zadd(_key('fingerprint', waiter['fingerprint']), {db_key: db_key})
+    pipe.execute()
+    return waiter
+
+def claim_waiters(fingerprint):
+    '''
+    Removes and returns all jobs waiting for a result.  See database.claim_waiters
+    '''
+    r = _client()
+    claimed = []
+    for db_key in r.smembers(_key('waiters', fingerprint)):
+        waiter = _claim(db_key)
+        if waiter is not None:
+            claimed.append((int(db_key),
+                            r.hget(_key('job', db_key), 'job_id') or None,
+                            waiter['email']))
+    return claimed
+
+def claim_waiter(db_key):
+    '''
+    Removes a job from the list of waiting jobs.  See database.claim_waiter
+    '''
+    return _claim(db_key) is not None
+
+def claim_expired_waiters(before):
+    '''
+    Removes and returns all jobs which have been waiting since before a given time.
+    See database.claim_expired_waiters
+    '''
+    r = _client()
+    claimed = []
+    for db_key in r.zrangebyscore(_key('waiting'), 0, int(before.timestamp())):
+        waiter = _claim(db_key)
+        if waiter is None:
+            # The job was claimed by another process
+            r.zrem(_key('waiting'), db_key)
+        else:
+            claimed.append((int(db_key),
+                            r.hget(_key('job', db_key), 'job_id') or None,
+                            waiter['email']))
+    return claimed
+
+def set_job_running(db_key, job_id):
+    '''
+    Sets a job's state to "RUNNING".  See database.set_job_running
+    '''
+    return _set_status(db_key, 'RUNNING', job_id=job_id)
+
+def set_job_completed(db_key):
+    '''
+    Sets a job's state to "COMPLETED".  See database.set_job_completed
+    '''
+    return _set_status(db_key, 'COMPLETED')
+
+def add_job_resources(db_key, usage):
+    '''
+    Adds the resources used by one of a job's tasks to the job.  See database.add_job_resources
+    '''
+    job_key = _key('job', db_key)
+
+    def update(pipe):
+        if not pipe.exists(job_key):
+            # The job has expired
+            return
+        peak_rss_mb = float(pipe.hget(job_key, 'peak_rss_mb') or 0)
+        pipe.multi()
+        pipe.hset(job_key, 'peak_rss_mb', max(peak_rss_mb, usage['peak_rss_mb']))
+        for name in ('wall_seconds', 'cpu_seconds', 'bytes_read', 'files_opened'):
+            pipe.hincrbyfloat(job_key, name, usage[name])
+
+    # Retry if another task of the same job updates it at the same time
+    _client().transaction(update, job_key)
+
+def get_jobs(userhash):
+    '''
+    Gets all jobs associated with a specified key.  See database.get_jobs
+    '''
+    r = _client()
+    user_key = _key('user', userhash)
+    db_keys = r.zrange(user_key, 0, -1)
+    pipe = r.pipeline()
+    for db_key in db_keys:
+        pipe.hgetall(_key('job', db_key))
+
+    jobs = []
+    for db_key, fields in zip(db_keys, pipe.execute()):
+        if not fields:
+            r.zrem(user_key, db_key)
+            continue
+        jobs.append({
+            'description': fields['description'],
+            'status': fields['status'],
+            'time': dt.fromtimestamp(int(fields['time'])),
+            'job_id': fields['job_id'] or None,
+            'error': fields['error_message'] or None
+        })
+    return jobs
+
+def set_downloaded(job_id):
+    '''
+    Sets a job's state to "DOWNLOADED".  See database.set_downloaded
+    '''
+    db_key = _job_key_from_id(job_id)
+    if db_key is None:
+        return None
+    return _set_status(db_key, 'DOWNLOADED')
+
+def set_error(job_id, message):
+    '''
+    Sets a job's state to "ERROR".  See database.set_error
+    '''
+    db_key = _job_key_from_id(job_id)
+    if db_key is None:
+        return None
+    return _set_status(db_key, 'ERROR', error_message=message)
+
+def remove_expired_jobs():
+    '''
+    Jobs are expired by Redis, so there is nothing to remove
+
+    :return:    An empty list
+    '''
+    return []
+
+def find_existing_job_ids(job_ids):
+    '''
+    Finds which of a number of job IDs belong to jobs.  See database.find_existing_job_ids
+    '''
+    job_ids = list(job_ids)
+    pipe = _client().pipeline()
+    for job_id in job_ids:
+        pipe.exists(_key('job-id', job_id))
+    return set(job_id for job_id, exists in zip(job_ids, pipe.execute()) if exists)
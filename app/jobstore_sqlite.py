@@ -0,0 +1,423 @@
+'''
+The SQLite job store (see the database module), which keeps the state of jobs in a
+local SQLite file.
+
+The database is shared between the web application and all of the Celery workers,
+so to keep lock contention down:
+
+* Each thread of each process keeps a single long-lived connection, so that
+  statements are prepared once and reused (sqlite3 caches them per connection)
+* The database uses write-ahead logging, so that readers never block writers
+* Writers wait for the lock (up to db_busy_timeout seconds) rather than failing
+* A number of writes can be grouped into a single transaction with batch()
+'''
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from config import config
+from datetime import timedelta, datetime as dt
+
+_local = threading.local()
+# The maximum number of jobs removed in a single transaction.  This is also
+# kept below SQLite's limit on the number of parameters in a statement.
+_EXPIRY_BATCH_SIZE = 500
+
+
+def _connection():
+    '''
+    Gets the connection to the database for the current thread, opening it if necessary.
+
+    Connections are not shared with forked processes (e.g. Celery worker processes),
+    since SQLite connections cannot be used safely across a fork.
+    '''
+    path = config['Tasks']['dbfile']
+    if getattr(_local, 'db', None) is None or \
+            _local.pid != os.getpid() or _local.path != path:
+        timeout = float(config['Tasks']['db_busy_timeout'])
+        db = sqlite3.connect(path, timeout=timeout, cached_statements=256)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        # This is safe in WAL mode, and avoids syncing on every commit
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('PRAGMA busy_timeout=' + str(int(timeout * 1000)))
+        _local.db = db
+        _local.pid = os.getpid()
+        _local.path = path
+        _local.in_batch = False
+    return _local.db
+
+@contextmanager
+def batch(immediate=False):
+    '''
+    Groups all database writes made by the current thread within a 'with' block
+    into a single transaction, e.g. when updating the status of many jobs at once.
+    The transaction is committed at the end of the block, or rolled back if it
+    raises an exception.  Nested batches join the outermost batch.
+
+    :param immediate:   Whether to take the write lock at the start of the block,
+                        rather than at the first write, so that rows which are read
+                        before being written cannot be changed by another writer
+                        in between.  Optional, defaults to False
+    '''
+    db = _connection()
+    if _local.in_batch:
+        yield
+        return
+
+    _local.in_batch = True
+    try:
+        # 'with' takes care of the commit or rollback
+        with db:
+            if immediate:
+                db.execute('BEGIN IMMEDIATE')
+            yield
+    finally:
+        _local.in_batch = False
+
+def _run_sql(command, values=(), expect_results=False, return_id=False, return_count=False):
+    '''
+    A convenience method for running some SQL and committing the result.
+    Within a batch(), the result is committed at the end of the batch instead.
+
+    :param command:         The SQL to run
+    :param values:          A tuple of values to insert into the SQL statement
+    :param expect_results:  Whether the SQL command should return results.
+                            Optional, defaults to False
+    :param return_id:       Whether the SQL command should return the ID of inserted code.
+                            This is mutually exclusive with expect_results, with the
+                            former taking precedence.
+                            Optional, defaults to False
+    :param return_count:    Whether the SQL command should return the number of rows changed.
+                            Optional, defaults to False
+    :return: A list of the rows returned, the ID of the inserted row or the number
+             of rows changed (depending on the options above), or None
+    '''
+    with batch():
+        c = _connection().execute(command, values)
+        if expect_results:
+            return c.fetchall()
+        elif return_id:
+            return c.lastrowid
+        elif return_count:
+            return c.rowcount
+    return None
+
+def _add_column(table, column, column_type):
+    '''
+    Adds a column to an existing table, if it is not already present.
+    This allows databases created by earlier versions to be upgraded.
+    '''
+    rows = _run_sql('PRAGMA table_info(' + table + ')', expect_results=True)
+    if column not in [row['name'] for row in rows]:
+        _run_sql('ALTER TABLE ' + table + ' ADD COLUMN ' + column + ' ' + column_type)
+
+def _find_userhash(column, value):
+    '''
+    :return: The userhash of the job with the given value in a column, or None if there is no such job
+    '''
+    rows = _run_sql('SELECT userhash FROM jobs WHERE ' + column + '=? LIMIT 1', (value,), True)
+    return rows[0]['userhash'] if rows else None
+
+def init():
+    '''
+    Setup the job list database on first run, if necessary
+    '''
+    _run_sql('''
+        CREATE TABLE IF NOT EXISTS jobs(id INTEGER PRIMARY KEY AUTOINCREMENT,
+            userhash TEXT,
+            status TEXT,
+            error_message TEXT,
+            time INTEGER,
+            description TEXT,
+            job_id TEXT)
+    ''')
+    _add_column('jobs', 'fingerprint', 'TEXT')
+    # The resources used by the job's tasks (see the resources module)
+    _add_column('jobs', 'peak_rss_mb', 'REAL')
+    _add_column('jobs', 'wall_seconds', 'REAL')
+    _add_column('jobs', 'cpu_seconds', 'REAL')
+    _add_column('jobs', 'bytes_read', 'INTEGER')
+    _add_column('jobs', 'files_opened', 'INTEGER')
+    # Jobs which are waiting for an identical job to finish, rather than running
+    _run_sql('''
+        CREATE TABLE IF NOT EXISTS job_waiters(db_key INTEGER PRIMARY KEY,
+            fingerprint TEXT,
+            email TEXT)
+    ''')
+    _run_sql('CREATE INDEX IF NOT EXISTS jobs_userhash ON jobs(userhash)')
+    _run_sql('CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs(job_id)')
+    _run_sql('CREATE INDEX IF NOT EXISTS jobs_status_time ON jobs(status, time)')
+    _run_sql('CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs(fingerprint)')
+    _run_sql('CREATE INDEX IF NOT EXISTS job_waiters_fingerprint ON job_waiters(fingerprint)')
+
+def add_job(userhash, description, fingerprint=None, job_id=None, status='QUEUED'):
+    '''
+    Adds a new job to the database.
+
+    :param userhash:    A key to retrieve jobs by.  Designed to
+                        be a hash of the email address + job ref
+    :param description: A description of the job
+    :param fingerprint: The fingerprint of the job's parameters (see jobspec.JobSpec.make_fingerprint).
+                        Optional, defaults to None
+    :param job_id:      The job ID, if known at submission time.
+                        Optional, defaults to None
+    :param status:      The initial state of the job.
+                        Optional, defaults to "QUEUED"
+    :return:            The primary ID of the job in the database
+    '''
+    return _run_sql('''
+        INSERT INTO jobs(userhash, status, time, description, fingerprint, job_id)
+        VALUES(?,?,?,?,?,?)
+    ''',
+    (userhash, status, int(dt.now().timestamp()), description, fingerprint, job_id),
+    return_id=True)
+
+def find_job_by_fingerprint(fingerprint):
+    '''
+    Finds the most recent job which has run (or is running) with identical parameters.
+    Jobs which failed, or which are waiting for another job, are ignored.
+
+    :param fingerprint: The fingerprint of the job's parameters
+    :return:            An object containing the keys 'db_key', 'status', 'time'
+                        and 'job_id', or None if there is no such job
+    '''
+    rows = _run_sql('''
+        SELECT id, status, time, job_id
+        FROM jobs
+        WHERE fingerprint=? AND status!=?
+            AND id NOT IN (SELECT db_key FROM job_waiters)
+        ORDER BY id DESC
+        LIMIT 1
+    ''',
+    (fingerprint, 'ERROR'),
+    True)
+
+    if not rows:
+        return None
+    return {
+        'db_key': rows[0]['id'],
+        'status': rows[0]['status'],
+        'time': dt.fromtimestamp(int(rows[0]['time'])),
+        'job_id': rows[0]['job_id']
+    }
+
+def add_waiter(db_key, fingerprint, email):
+    '''
+    Records that a job is waiting for the result of an identical job
+
+    :param db_key:      The primary key of the waiting job
+    :param fingerprint: The fingerprint of the job's parameters
+    :param email:       The email address to notify when the result is ready
+    '''
+    _run_sql('''
+        INSERT INTO job_waiters(db_key, fingerprint, email) VALUES(?,?,?)
+    ''',
+    (db_key, fingerprint, email))
+
+def claim_waiters(fingerprint):
+    '''
+    Removes and returns all jobs waiting for a result.  Each waiting job is only
+    returned to a single caller, even if called concurrently.
+
+    :param fingerprint: The fingerprint of the job's parameters
+    :return:            A list of (db_key, job_id, email) tuples
+    '''
+    rows = _run_sql('''
+        SELECT job_waiters.db_key, job_waiters.email, jobs.job_id
+        FROM job_waiters JOIN jobs ON jobs.id=job_waiters.db_key
+        WHERE job_waiters.fingerprint=?
+    ''',
+    (fingerprint,),
+    True)
+    return [(row['db_key'], row['job_id'], row['email'])
+            for row in rows if claim_waiter(row['db_key'])]
+
+def claim_waiter(db_key):
+    '''
+    Removes a job from the list of waiting jobs
+
+    :param db_key:  The primary key of the waiting job
+    :return:        True if the job was waiting, and has now been claimed by the caller
+    '''
+    return _run_sql('''
+        DELETE FROM job_waiters WHERE db_key=?
+    ''',
+    (db_key,),
+    return_count=True) == 1
+
+def claim_expired_waiters(before):
+    '''
+    Removes and returns all jobs which have been waiting since before a given time.
+    See database.claim_expired_waiters
+    '''
+    rows = _run_sql('''
+        SELECT job_waiters.db_key, job_waiters.email, jobs.job_id
+        FROM job_waiters JOIN jobs ON jobs.id=job_waiters.db_key
+        WHERE jobs.time<?
+    ''',
+    (int(before.timestamp()),),
+    True)
+    return [(row['db_key'], row['job_id'], row['email'])
+            for row in rows if claim_waiter(row['db_key'])]
+
+def set_job_running(db_key, job_id):
+    '''
+    Sets a job's state to "RUNNING" and associates a job ID with it
+
+    :param db_key:  The primary key of the job to alter
+    :param job_id:  The required job ID
+    :return:        The userhash of the job
+    '''
+    _run_sql('''
+        UPDATE jobs SET status=?, time=?, job_id=?
+        WHERE id=?
+    ''',
+    ('RUNNING', int(dt.now().timestamp()), job_id, db_key))
+    return _find_userhash('id', db_key)
+
+def set_job_completed(db_key):
+    '''
+    Sets a job's state to "COMPLETED"
+
+    :param db_key:  The primary key of the job to alter
+    :return:        The userhash of the job
+    '''
+    _run_sql('''
+        UPDATE jobs SET status=?, time=?
+        WHERE id=?
+    ''',
+    ('COMPLETED', int(dt.now().timestamp()), db_key))
+    return _find_userhash('id', db_key)
+
+def add_job_resources(db_key, usage):
+    '''
+    Adds the resources used by one of a job's tasks to the job
+
+    :param db_key:  The primary key of the job to alter
+    :param usage:   A dict of the resources used, as returned by resources.finish
+    '''
+    _run_sql('''
+        UPDATE jobs SET peak_rss_mb=MAX(COALESCE(peak_rss_mb, 0), ?),
+            wall_seconds=COALESCE(wall_seconds, 0)+?,
+            cpu_seconds=COALESCE(cpu_seconds, 0)+?,
+            bytes_read=COALESCE(bytes_read, 0)+?,
+            files_opened=COALESCE(files_opened, 0)+?
+        WHERE id=?
+    ''',
+    (usage['peak_rss_mb'], usage['wall_seconds'], usage['cpu_seconds'],
+     int(usage['bytes_read']), int(usage['files_opened']), db_key))
+
+def get_jobs(userhash):
+    '''
+    Gets all jobs associated with a specified key
+
+    :param userhash:    The key to retrieve jobs.   Designed to be a hash
+                        of the email address + the job reference
+    :return:            An array of objects containing the keys:
+                        'description' - description of the job
+                        'status' - string representation of the job status
+                        'time' - when the status was last updated (datetime.datetime)
+                        'job_id' - the job ID, which corresponds to where the results are
+    '''
+    rows = _run_sql('''
+        SELECT description, status, time, job_id, error_message
+        FROM jobs
+        WHERE userhash=?
+    ''',
+    (userhash,),
+    True)
+
+    jobs = []
+    for row in rows:
+        jobs.append({
+            'description': row['description'],
+            'status': row['status'],
+            'time': dt.fromtimestamp(int(row['time'])),
+            'job_id': row['job_id'],
+            'error': row['error_message'],
+        })
+    return jobs
+
+def set_downloaded(job_id):
+    '''
+    Sets a job's state to "DOWNLOADED"
+
+    :param job_id:  The job ID of the job to alter
+    :return:        The userhash of the job
+    '''
+    _run_sql('''
+                UPDATE jobs SET status=?, time=?
+                WHERE job_id=?
+            ''',
+            ('DOWNLOADED', int(dt.now().timestamp()), job_id))
+    return _find_userhash('job_id', job_id)
+
+def set_error(job_id, message):
+    '''
+    Sets a job's state to "ERROR"
+
+    :param job_id:  The job ID of the job to alter
+    :return:        The userhash of the job
+    '''
+    _run_sql('''
+                UPDATE jobs SET status=?, error_message=?, time=?
+                WHERE job_id=?
+            ''',
+            ('ERROR', message, int(dt.now().timestamp()), job_id))
+    return _find_userhash('job_id', job_id)
+
+def remove_expired_jobs():
+    '''
+    Removes expired jobs from the database.
+
+    This uses the expiry times from the config module.  Expired jobs are found
+    using the (status, time) index, and removed in batches of at most
+    _EXPIRY_BATCH_SIZE, so that other writers are never locked out for long.
+    Each batch is found and removed in a single transaction, so that a job
+    which changes status in between (e.g. is downloaded) is not removed.
+
+    :return:    A list of job IDs which were removed
+    '''
+    now = int(dt.now().timestamp())
+    completed_before = now - \
+        int(timedelta(days=int(config['Tasks']['days_to_keep_completed'])).total_seconds())
+    downloaded_before = now - \
+        int(timedelta(hours=int(config['Tasks']['hours_to_keep_downloaded'])).total_seconds())
+
+    removed_job_ids = []
+    while True:
+        with batch(immediate=True):
+            rows = _run_sql('''
+                SELECT id, job_id
+                FROM jobs
+                WHERE (status IN (?,?) AND time<?) OR (status=? AND time<?)
+                LIMIT ?
+            ''',
+            ('COMPLETED', 'ERROR', completed_before, 'DOWNLOADED', downloaded_before,
+             _EXPIRY_BATCH_SIZE),
+            True)
+            if rows:
+                _run_sql('DELETE FROM jobs WHERE id IN (' + ','.join('?' * len(rows)) + ')',
+                         tuple(row['id'] for row in rows))
+        removed_job_ids.extend(row['job_id'] for row in rows)
+        if len(rows) < _EXPIRY_BATCH_SIZE:
+            return removed_job_ids
+
+def find_existing_job_ids(job_ids):
+    '''
+    Finds which of a number of job IDs belong to jobs in the database
+
+    :param job_ids: An iterable of job IDs
+    :return:        A set of the job IDs which are in the database
+    '''
+    job_ids = list(job_ids)
+    existing = set()
+    for i in range(0, len(job_ids), _EXPIRY_BATCH_SIZE):
+        chunk = job_ids[i:i + _EXPIRY_BATCH_SIZE]
+        rows = _run_sql('SELECT job_id FROM jobs WHERE job_id IN (' + ','.join('?' * len(chunk)) + ')',
+                        tuple(chunk),
+                        True)
+        existing.update(row['job_id'] for row in rows)
+    return existing
@@ -4,18 +4,28 @@ The main Flask webapp for the TAMSAT ALERT job queuing system
 '''
 
 import os, os.path
-from flask import Flask, send_file, abort, request, jsonify
+from flask import Flask, send_file, abort, request, jsonify, make_response
 from threading import Lock, Thread
 from math import isclose
 from pandas import Timestamp
 import pickle
-import tasks
+import client
+import jobspec
+import manifest
 import util
+import metrics
+import jobevents
+import scheduler
 from config import config
 import database as db
 import exceptions as ex
 from datetime import timedelta, datetime as dt
 import hashlib
+import time
+import uuid
+import json
+import csv
+import io
 
 
 # Define the Flask app at top module level.
@@ -31,12 +41,32 @@ if(os.path.exists(workdir)):
 else:
     os.makedirs(workdir)
 
+# How long the last time in the data is kept for before the manifest is read
+# again, so that a batch of jobs only reads it once (see _data_time)
+_DATA_TIME_SECONDS = 60
+_data_time_read = (None, None)
+
 @app.route("/api/jobs", methods=["GET"])
 def get_job_list():
     '''
     Gets a list of jobs by the specified user/job ref combination.
 
     Requires the parameters 'email', and 'ref'
+
+    The response has an ETag, which only changes when the user's jobs change (see
+    the jobevents module), so a request with a matching If-None-Match header gets
+    a 304 response without reading the database.  If the version of the jobs
+    cannot be read (e.g. Redis is unavailable), the jobs are returned without an
+    ETag.  To wait for the jobs to change rather than polling, a request can
+    also give the optional parameter:
+
+    wait - The maximum number of seconds to wait for the jobs to change before
+           responding, if the If-None-Match header matches.  This is limited to
+           config['Tasks']['max_poll_seconds']
+
+    Jobs which are waiting in the scheduler (see the scheduler module) also have
+    the keys 'queue_position' (the number of jobs ahead of them) and
+    'estimated_start' (when they are expected to start running).
     '''
     params = request.args
     # Here, we get the job ref and email from the params
@@ -46,14 +76,38 @@ def get_job_list():
     except KeyError as e:
         # Either the email or ref parameter is missing
         raise ex.InvalidUsage('You must provide a value for '+e.args[0])
-
-    jobs = db.get_jobs(_get_hash(email, job_ref))
-
-    return jsonify({
+    try:
+        wait = min(float(params.get('wait', 0)), float(config['Tasks']['max_poll_seconds']))
+    except ValueError:
+        raise ex.InvalidUsage('Parameter "wait" must be a number of seconds')
+
+    userhash = _get_hash(email, job_ref)
+    version = jobevents.version(userhash)
+    if version is not None and request.if_none_match.contains(version):
+        if wait > 0:
+            version = jobevents.wait(userhash, version, wait)
+        if version is not None and request.if_none_match.contains(version):
+            response = make_response('', 304)
+            response.set_etag(version)
+            return response
+
+    jobs = db.get_jobs(userhash)
+    if scheduler.enabled() and any(job['status'] == 'QUEUED' for job in jobs):
+        positions = scheduler.queue_positions(userhash)
+        for job in jobs:
+            if job['job_id'] in positions:
+                job['queue_position'], job['estimated_start'] = positions[job['job_id']]
+
+    response = jsonify({
         'jobs': jobs,
         'days_after_completed': config['Tasks']['days_to_keep_completed'],
         'hours_after_downloaded': config['Tasks']['hours_to_keep_downloaded']
     })
+    if version is not None:
+        response.set_etag(version)
+    # Browsers must check with the server before using their copy
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 @app.route("/api/downloadResult", methods=["GET"])
@@ -62,6 +116,11 @@ def download():
     Downloads a zip file containing the output from a job
 
     Requires the parameter 'job_id'
+
+    Supports conditional (ETag) and Range requests, so that interrupted downloads
+    can be resumed.  If config['Tasks']['accel_redirect_prefix'] is set, the file
+    is served by nginx via X-Accel-Redirect instead, so that large downloads do
+    not occupy an application worker.
     '''
     params = request.args
 
@@ -75,9 +134,36 @@ def download():
     if not os.path.exists(zipfile) or not os.path.isfile(zipfile):
         raise ex.InvalidUsage('The job with ID '+job_id+' does not exist on this server.  Completed jobs get removed '+config['Tasks']['days_to_keep_completed']+' days after completion.')
 
-    db.set_downloaded(job_id)
+    accel_redirect_prefix = config['Tasks']['accel_redirect_prefix']
+    if accel_redirect_prefix:
+        # nginx handles the transfer, including Range and conditional requests
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = accel_redirect_prefix.rstrip('/') + '/' + os.path.basename(zipfile)
+        response.headers['Content-Type'] = 'application/zip'
+        response.headers['Content-Disposition'] = 'attachment; filename=tamsat_alert.zip'
+        # nginx decides the response, so count only plain requests for the whole file
+        full_download = not any(header in request.headers for header in
+                                ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since'))
+    else:
+        response = send_file(zipfile, as_attachment=True, attachment_filename='tamsat_alert.zip',
+                             conditional=True)
+        full_download = response.status_code == 200
+
+    # Only a full download starts the clock for removing the job, so that
+    # resuming an interrupted download does not keep extending it
+    if full_download:
+        db.set_downloaded(job_id)
+    return response
+
 
-    return send_file(zipfile, as_attachment=True, attachment_filename='tamsat_alert.zip')
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    '''
+    Gets the timing histograms of all stages of jobs, in the Prometheus text format
+    '''
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
 
 
 @app.route("/api/tamsatAlertTask", methods=["POST"])
@@ -101,12 +187,339 @@ def submit():
     stat - The probability distribution to use.  'normal', or 'ecdf'
     email - The user's email address
     ref - A job reference for retrieving the job (alongside email)
+
+    To run a hindcast over many forecast dates (in place of initDate), either:
+    hindcastDates - A comma-separated list of forecast dates in the form YYYY-MM-DD OR
+    hindcastStart, hindcastEnd - The first and last forecast dates in the form YYYY-MM-DD
+    hindcastStepDays - The number of days between forecast dates.  Optional, defaults to 7
     '''
 
     # Get the POST parameters
     params = request.form
 
     # Now parse parameters to their correct types and do basic sanity checks
+    common = _parse_common_params(params)
+    location = _parse_location(params, common['metric'])
+    cast_dates = _parse_cast_dates(params)
+    if cast_dates:
+        if len(location) == 4 or common['metric'] != 'cumrain':
+            raise ex.InvalidUsage('Hindcasts can only be run with the "cumRain" metric at a point')
+        init_date = cast_dates[0]
+    else:
+        try:
+            init_date = Timestamp(params['initDate'])
+        except KeyError as e:
+            raise ex.InvalidUsage('You must provide a value for '+e.args[0])
+
+    reused = []
+    job_id, job = _add_job(common, location, init_date, reused, cast_dates)
+    _reuse_results(reused)
+    if job is not None:
+        # Submit to the celery queue
+        client.submit_job(job)
+
+    return jsonify({
+        'job_id': job_id
+    })
+
+
+@app.route("/api/tamsatAlertQuick", methods=["POST"])
+def submit_quick():
+    '''
+    Runs a cumulative rainfall query at a point directly, and returns the results
+    as JSON rather than by email.  This takes the same POST parameters as
+    /api/tamsatAlertTask, except that locationType must be 'point' and metric
+    must be 'cumRain'.
+
+    The query is run directly on the 'quick' queue if it can complete within the
+    quick_latency_budget config value.  Otherwise, it is submitted to the celery
+    queue as a job, whose output is the same results, in the file results.json.
+
+    :return:    A JSON object containing 'status', which is either:
+                'COMPLETED' - with 'results', containing the tercile probabilities
+                              and summary statistics (see quick.run_cumrain)
+                'QUEUED' - with 'job_id', the ID of the submitted job
+    '''
+    params = request.form
+
+    common = _parse_common_params(params)
+    location = _parse_location(params, common['metric'])
+    if len(location) == 4 or common['metric'] != 'cumrain':
+        raise ex.InvalidUsage('Quick queries can only be run with the "cumRain" metric at a point')
+    try:
+        init_date = Timestamp(params['initDate'])
+    except KeyError as e:
+        raise ex.InvalidUsage('You must provide a value for '+e.args[0])
+
+    # The query is run by a worker, since it needs the scientific libraries,
+    # which the web application does not load (see the client module)
+    results = client.run_quick(_make_job(common, location, init_date, quick=True),
+                               float(config['Tasks']['quick_latency_budget']))
+    if results is not None:
+        return jsonify({
+            'status': 'COMPLETED',
+            'results': results
+        })
+
+    # The query is too slow to run directly, so run it as a job
+    reused = []
+    job_id, job = _add_job(common, location, init_date, reused, quick=True)
+    _reuse_results(reused)
+    if job is not None:
+        client.submit_job(job)
+
+    return jsonify({
+        'status': 'QUEUED',
+        'job_id': job_id
+    }), 202
+
+
+@app.route("/api/tamsatAlertBatch", methods=["POST"])
+def submit_batch():
+    '''
+    Submits a batch of point jobs which share all parameters except their
+    location and forecast date.  This is much more efficient than submitting
+    each job separately, since the jobs are added to the database together, and
+    data shared between jobs is only extracted once.
+
+    Accepts either a JSON object, or the same POST parameters as /api/tamsatAlertTask
+    (apart from the location).  The locations are given by the parameter:
+
+    points - Either a JSON array of objects, or CSV with a header row.  Each point
+             has the keys/columns 'lon' and 'lat', and optionally 'initDate' (which
+             overrides the 'initDate' parameter).  With a multipart POST, this
+             may also be uploaded as a file.
+
+    :return: A JSON object containing 'job_ids', a list of the job ID of each point
+    '''
+    if request.is_json:
+        params = request.get_json()
+        if not isinstance(params, dict):
+            raise ex.InvalidUsage('The JSON body must be an object')
+        points = params.get('points')
+        if isinstance(points, str):
+            points = _parse_points(points)
+    else:
+        params = request.form
+        if 'points' in request.files:
+            points = _parse_points(request.files['points'].read().decode('utf-8'))
+        else:
+            points = _parse_points(params.get('points'))
+
+    if not points:
+        raise ex.InvalidUsage('You must provide a value for points')
+    max_batch_size = int(config['Tasks']['max_batch_size'])
+    if len(points) > max_batch_size:
+        raise ex.InvalidUsage('A batch may contain at most {} points'.format(max_batch_size))
+
+    common = _parse_common_params(params)
+    jobs_to_add = []
+    try:
+        for point in points:
+            location = (float(point['lon']), float(point['lat']))
+            init_date = Timestamp(point.get('initDate') or params['initDate'])
+            jobs_to_add.append((location, init_date))
+    except KeyError as e:
+        raise ex.InvalidUsage('You must provide a value for '+e.args[0])
+    except (AttributeError, TypeError, ValueError) as e:
+        raise ex.InvalidUsage('Invalid point: '+str(e))
+
+    # Add all of the jobs to the database together.  Reused results are only
+    # linked and emailed once the batch has been committed, in case it fails.
+    job_ids = []
+    jobs = []
+    reused = []
+    with db.batch():
+        for location, init_date in jobs_to_add:
+            job_id, job = _add_job(common, location, init_date, reused)
+            job_ids.append(job_id)
+            if job is not None:
+                jobs.append(job)
+    _reuse_results(reused)
+
+    # Submit to the celery queue
+    if jobs:
+        client.submit_jobs(jobs)
+
+    return jsonify({
+        'job_ids': job_ids
+    })
+
+
+def _parse_cast_dates(params):
+    '''
+    Parses the forecast dates of a hindcast from the request parameters
+
+    :param params:  The request parameters
+    :return:        A sorted list of pandas Timestamps, or None if this is not a hindcast
+    '''
+    try:
+        if params.get('hindcastDates'):
+            cast_dates = sorted(Timestamp(date.strip())
+                                for date in params['hindcastDates'].split(',') if date.strip())
+        elif params.get('hindcastStart') or params.get('hindcastEnd'):
+            import hindcast
+            cast_dates = hindcast.cast_date_range(Timestamp(params['hindcastStart']),
+                                                  Timestamp(params['hindcastEnd']),
+                                                  int(params.get('hindcastStepDays') or 7))
+        else:
+            return None
+    except KeyError as e:
+        raise ex.InvalidUsage('You must provide a value for '+e.args[0])
+    except ValueError as e:
+        raise ex.InvalidUsage('Invalid hindcast dates: '+str(e))
+
+    if not cast_dates:
+        raise ex.InvalidUsage('A hindcast must have at least one forecast date')
+    max_dates = int(config['Tasks']['max_batch_size'])
+    if len(cast_dates) > max_dates:
+        raise ex.InvalidUsage('A hindcast may have at most {} forecast dates'.format(max_dates))
+    return cast_dates
+
+def _data_time():
+    '''
+    :return: The last time in any of the datasets used by jobs, from the file
+             manifest, or None if they are not in the manifest
+    '''
+    global _data_time_read
+    read_time, data_time = _data_time_read
+    if read_time is None or time.monotonic() - read_time > _DATA_TIME_SECONDS:
+        times = [manifest.last_time(config['Data'][option])
+                 for option in ('tamsat_path', 'met_fc_temp_path', 'met_fc_path')]
+        times = [last for last in times if last is not None]
+        data_time = max(times) if times else None
+        _data_time_read = (time.monotonic(), data_time)
+    return data_time
+
+def _make_job(common, location, init_date, cast_dates=None, quick=False):
+    '''
+    Makes the parameters of a job, with a new job ID, and validates them
+
+    :return:    A JobSpec
+    :raises InvalidUsage: If the parameters of the job are invalid
+
+    The parameters are the same as for _add_job
+    '''
+    # The job ID is also used as the ID of the celery task
+    job = jobspec.JobSpec(job_id=str(uuid.uuid4()),
+                          userhash=_get_hash(common['email'], common['job_ref']),
+                          location=location,
+                          cast_date=init_date,
+                          cast_dates=cast_dates,
+                          quick=quick,
+                          data_time=_data_time(),
+                          **dict((key, value) for key, value in common.items() if key != 'job_ref'))
+    # Jobs are only validated here, not again when the workers decode them
+    try:
+        job.validate()
+    except ValueError as e:
+        raise ex.InvalidUsage(str(e))
+    return job
+
+def _add_job(common, location, init_date, reused, cast_dates=None, quick=False):
+    '''
+    Adds a job to the database.  If an identical job has already completed, its
+    output is reused, and if one is in progress, the new job waits for it.
+
+    :param common:      The parameters of the job, as returned by _parse_common_params
+    :param location:    The location of the job, as returned by _parse_location
+    :param init_date:   The forecast date
+    :param reused:      A list, to which a tuple of (fingerprint, job ID, email)
+                        is added if the job reuses an existing result.  The caller
+                        passes it to _reuse_results once the job has been added.
+    :param cast_dates:  The forecast dates of a hindcast.  Optional, defaults to None
+    :param quick:       Whether the job is a quick query, which outputs its
+                        results as JSON.  Optional, defaults to False
+    :return:            A tuple of (job ID, job).  The job is a JobSpec to pass to
+                        client.submit_job, or None if the job does not need to be run.
+    :raises InvalidUsage: If the parameters of the job are invalid
+    '''
+    if len(location) == 4:
+        description = 'Cumulative rainfall over ' + util.region_to_str(*location)
+    elif cast_dates:
+        description = 'Cumulative rainfall hindcast ({} dates) at {}'.format(
+            len(cast_dates), util.location_to_str(*location))
+    else:
+        description = 'Cumulative rainfall at ' + util.location_to_str(*location)
+    email = common['email']
+    job = _make_job(common, location, init_date, cast_dates, quick)
+    job_id = job['job_id']
+    userhash = job['userhash']
+
+    # Jobs with identical parameters have identical outputs, so
+    # check whether we can reuse the output of a previous job
+    fingerprint = job.make_fingerprint()
+    previous = db.find_job_by_fingerprint(fingerprint)
+    reuse_after = dt.now() - timedelta(hours=int(config['Tasks']['reuse_results_hours']))
+
+    if previous is not None and \
+            previous['status'] in ('COMPLETED', 'DOWNLOADED') and \
+            previous['time'] > reuse_after and \
+            os.path.exists(util.get_result_from_fingerprint(fingerprint)):
+        # An identical job has already completed
+        db.add_job(userhash, description, fingerprint, job_id, 'COMPLETED')
+        reused.append((fingerprint, job_id, email))
+        return job_id, None
+
+    db_key = db.add_job(userhash, description, fingerprint, job_id)
+
+    if previous is not None and previous['status'] in ('QUEUED', 'RUNNING'):
+        # An identical job is in progress, so wait for that to complete
+        db.add_waiter(db_key, fingerprint, email)
+        previous = db.find_job_by_fingerprint(fingerprint)
+        if (previous is not None and previous['status'] in ('QUEUED', 'RUNNING')) or \
+                not db.claim_waiter(db_key):
+            return job_id, None
+        # It finished before we started waiting.  If it completed, reuse its
+        # result, and otherwise we need to run this job after all
+        if previous is not None and \
+                previous['status'] in ('COMPLETED', 'DOWNLOADED') and \
+                os.path.exists(util.get_result_from_fingerprint(fingerprint)):
+            db.set_job_completed(db_key)
+            reused.append((fingerprint, job_id, email))
+            return job_id, None
+
+    job.db_key = db_key
+    job.fingerprint = fingerprint
+    job.heavy = client.is_heavy(job)
+    return job_id, job
+
+def _reuse_results(reused):
+    '''
+    Makes stored results available as the output of the jobs which reuse them,
+    and tells their users that they are ready
+
+    :param reused:  A list of (fingerprint, job ID, email) tuples, from _add_job
+    '''
+    for fingerprint, job_id, email in reused:
+        util.link_result(fingerprint, job_id)
+        client.notify_result_ready(email, job_id)
+
+def _parse_points(text):
+    '''
+    Parses the points of a batch, given as either a JSON array or CSV
+
+    :param text:    The JSON or CSV text
+    :return:        A list of dicts, one per point
+    '''
+    if not text or not text.strip():
+        return []
+    if text.lstrip().startswith('['):
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise ex.InvalidUsage('Invalid JSON in points: '+str(e))
+    return list(csv.DictReader(io.StringIO(text.strip())))
+
+def _parse_location(params, metric):
+    '''
+    Parses the location of a job from the request parameters
+
+    :param params:  The request parameters
+    :param metric:  The (lower case) metric being run
+    :return:        A tuple of (lon, lat) for a point, or (minLon, maxLon, minLat, maxLat)
+                    for a region
+    '''
     try:
         locType = params['locationType']
         if(locType.lower() == 'point'):
@@ -118,8 +531,22 @@ def submit():
                         float(params['maxLat']))
         else:
             raise ex.InvalidUsage('Parameter "locationType" must be either "point" or "region"')
+    except KeyError as e:
+        raise ex.InvalidUsage('You must provide a value for '+e.args[0])
 
-        init_date = Timestamp(params['initDate'])
+    if(locType.lower() == 'region' and metric != 'cumrain'):
+        raise ex.InvalidUsage('Only the "cumRain" metric can be run over a region')
+    return location
+
+def _parse_common_params(params):
+    '''
+    Parses the parameters of a job other than its location and forecast date,
+    and does basic sanity checks
+
+    :param params:  The request parameters
+    :return:        A dict of the parsed parameters
+    '''
+    try:
         poi_start_day = int(params['poiStartDay'])
         poi_start_month = int(params['poiStartMonth'])
         poi_end_day = int(params['poiEndDay'])
@@ -166,32 +593,24 @@ def submit():
     except KeyError as e:
         raise ex.InvalidUsage('You must provide a value for '+e.args[0])
 
-    description = 'Cumulative rainfall at ' + util.location_to_str(*location)
-    db_key = db.add_job(_get_hash(email, job_ref), description)
-
-    # Submit to the celery queue
-    task = tasks.tamsat_alert_run.delay(location,
-                                        fc_location,
-                                        fc_var,
-                                        init_date,
-                                        poi_start_day,
-                                        poi_start_month,
-                                        poi_end_day,
-                                        poi_end_month,
-                                        fc_start_day,
-                                        fc_start_month,
-                                        fc_end_day,
-                                        fc_end_month,
-                                        stat_type,
-                                        tercile_weights,
-                                        email,
-                                        db_key,
-                                        metric.lower(),
-                                        soil_type)
-
-    return jsonify({
-        'job_id': task.id
-    })
+    return {
+        'fc_location': fc_location,
+        'fc_var': fc_var,
+        'poi_start_day': poi_start_day,
+        'poi_start_month': poi_start_month,
+        'poi_end_day': poi_end_day,
+        'poi_end_month': poi_end_month,
+        'fc_start_day': fc_start_day,
+        'fc_start_month': fc_start_month,
+        'fc_end_day': fc_end_day,
+        'fc_end_month': fc_end_month,
+        'stat_type': stat_type,
+        'tercile_weights': tercile_weights,
+        'metric': metric.lower(),
+        'soil_type': soil_type,
+        'email': email,
+        'job_ref': job_ref
+    }
 
 
 @app.route("/")
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+'''
+A manifest of the files in each dataset, recording the times covered by each file.
+
+Listing a dataset with its glob expression walks every directory of the archive,
+and finding which files cover a period means opening them.  The manifest is a
+SQLite file which records the first and last time in each file, so that the files
+covering any period can be found without touching the archive.  It also checks
+that the lexical order of the files matches their temporal order, which the
+daily-file code relies on.
+
+The manifest is updated incrementally (only new or modified files are opened)
+by the update_file_manifest Celery task, or by running this module as a script.
+Readers only use the manifest when it is up to date with the dataset (see
+cache.dataset_version), and fall back to the glob expression otherwise.
+
+The manifest also records the modification time of each directory, so that the
+files of a dataset can be listed without walking the archive (see list_files):
+only the directories which have changed since they were last listed are read.
+'''
+
+import os
+import os.path
+import re
+import glob
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from config import config
+import cache
+
+# Runs of digits, which are removed from filenames to find the files of each variable
+_DIGITS = re.compile(r'[0-9]+')
+
+# The files of each dataset listed by this process, by glob expression: a tuple
+# of (dict mapping each directory to a tuple of (modification time, sorted list
+# of its files), sorted list of all files)
+_listings = {}
+
+
+def _connection():
+    path = config['Data']['manifest_file']
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path, timeout=float(config['Tasks']['db_busy_timeout']))
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS datasets (path TEXT PRIMARY KEY, version TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS files (dataset TEXT, filename TEXT, mtime REAL, '
+               'start TEXT, end TEXT, PRIMARY KEY (dataset, filename))')
+    db.execute('CREATE INDEX IF NOT EXISTS files_dataset_end ON files (dataset, end)')
+    db.execute('CREATE TABLE IF NOT EXISTS directories (dataset TEXT, directory TEXT, '
+               'mtime REAL, PRIMARY KEY (dataset, directory))')
+    return db
+
+def _time_str(time):
+    # ISO format strings sort in temporal order
+    return pd.Timestamp(time).isoformat()
+
+def _time_bounds(filename):
+    # Imported here, so that the web application can read the manifest (see last_time)
+    # without loading xarray
+    import xarray as xr
+    with xr.open_dataset(filename) as ds:
+        times = ds['time'].values
+        return _time_str(times.min()), _time_str(times.max())
+
+def _load_listing(path):
+    '''
+    :return: The listing of a dataset recorded by the last update, in the form
+             of the values of _listings, or an empty listing if there is none
+    '''
+    if not os.path.exists(config['Data']['manifest_file']):
+        return {}, None
+    db = _connection()
+    try:
+        directories = dict(db.execute('SELECT directory, mtime FROM directories '
+                                      'WHERE dataset = ?', (path,)))
+        names = {}
+        for (filename,) in db.execute('SELECT filename FROM files WHERE dataset = ?', (path,)):
+            names.setdefault(os.path.dirname(filename), []).append(filename)
+    finally:
+        db.close()
+    return {directory: (mtime, sorted(names.get(directory, [])))
+            for directory, mtime in directories.items()}, None
+
+def list_files(path):
+    '''
+    Lists the files of a dataset, in lexical order.  This is equivalent to
+    sorted(glob.glob(path)), but only the directories which have been modified
+    since they were last listed, by this process or by the last update of the
+    manifest, are listed again.  So when a new daily file arrives, only its
+    directory is read, rather than the whole archive.
+
+    :param path:    A glob expression defining the location of the data
+    :return:        A list of filenames
+    '''
+    pattern = os.path.basename(path)
+    # Take the modification times before listing, so that any change while the
+    # directories are being listed is picked up next time
+    mtimes = {directory: os.path.getmtime(directory)
+              for directory in glob.glob(os.path.dirname(path))}
+    directories, files = _listings.get(path) or _load_listing(path)
+    if files is not None and len(mtimes) == len(directories) and \
+            all(directories.get(directory, (None,))[0] == mtime
+                for directory, mtime in mtimes.items()):
+        return files
+
+    directories = {directory: directories[directory]
+                   if directory in directories and directories[directory][0] == mtime
+                   else (mtime, sorted(glob.glob(os.path.join(directory, pattern))))
+                   for directory, mtime in mtimes.items()}
+    files = sorted(filename for mtime, names in directories.values() for filename in names)
+    _listings[path] = (directories, files)
+    return files
+
+def update(path):
+    '''
+    Updates the manifest of a dataset.  Only files which are new or have been
+    modified since the last update are opened.
+
+    :param path:    A glob expression defining the location of the data
+    :return:        A tuple of (number of files added or updated, number of files removed)
+    '''
+    version = cache.dataset_version(path)
+    files = list_files(path)
+    directories = _listings[path][0]
+    db = _connection()
+    try:
+        known = dict(db.execute('SELECT filename, mtime FROM files WHERE dataset = ?', (path,)))
+
+        changed = []
+        for filename in files:
+            mtime = os.path.getmtime(filename)
+            if known.pop(filename, None) != mtime:
+                changed.append((path, filename, mtime) + _time_bounds(filename))
+
+        with db:
+            db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', changed)
+            db.executemany('DELETE FROM files WHERE dataset = ? AND filename = ?',
+                           [(path, filename) for filename in known])
+            db.execute('INSERT OR REPLACE INTO datasets VALUES (?, ?)', (path, version))
+            db.execute('DELETE FROM directories WHERE dataset = ?', (path,))
+            db.executemany('INSERT INTO directories VALUES (?, ?, ?)',
+                           [(path, directory, mtime)
+                            for directory, (mtime, names) in directories.items()])
+    finally:
+        db.close()
+    return len(changed), len(known)
+
+def check_order(path):
+    '''
+    Checks that the lexical order of the files in a dataset matches their temporal order
+
+    :param path:    A glob expression defining the location of the data
+    :return:        A list of (filename, next filename) tuples, for each pair of
+                    consecutive files of the same variable where the next file
+                    starts earlier.  Files of different variables (e.g. air.2m.*.nc
+                    and dlwr.sfc.*.nc in the same directory) are checked separately.
+    '''
+    db = _connection()
+    try:
+        rows = db.execute('SELECT filename, start, end FROM files WHERE dataset = ? '
+                          'ORDER BY filename', (path,)).fetchall()
+    finally:
+        db.close()
+    # Files of the same variable have the same name apart from their times
+    variables = {}
+    for row in rows:
+        variables.setdefault(_DIGITS.sub('#', row[0]), []).append(row)
+    return [(previous[0], row[0]) for rows in variables.values()
+            for previous, row in zip(rows, rows[1:]) if row[1] < previous[1]]
+
+def find_files(path, start=None, end=None, times=None):
+    '''
+    Finds the files of a dataset which cover a period, in temporal order
+
+    :param path:    A glob expression defining the location of the data
+    :param start:   The first time needed.  Optional, defaults to the start of the data
+    :param end:     The last time needed.  Optional, defaults to the end of the data
+    :param times:   A list of the only times needed, within start and end.
+                    Optional, defaults to every time
+    :return:        A list of filenames, or None if the manifest is not up to date
+                    with the dataset
+    '''
+    if not os.path.exists(config['Data']['manifest_file']):
+        return None
+    db = _connection()
+    try:
+        row = db.execute('SELECT version FROM datasets WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != cache.dataset_version(path):
+            return None
+        rows = db.execute('SELECT filename, start, end FROM files '
+                          'WHERE dataset = ? AND end >= ? AND start <= ? ORDER BY start',
+                          (path,
+                           '' if start is None else _time_str(start),
+                           '~' if end is None else _time_str(end))).fetchall()
+    finally:
+        db.close()
+
+    if times is not None:
+        # Only keep the files which contain at least one of the times
+        times = np.array(sorted(_time_str(time) for time in times))
+        rows = [(filename, file_start, file_end) for filename, file_start, file_end in rows
+                if times.searchsorted(file_start, side='left') !=
+                times.searchsorted(file_end, side='right')]
+    return [filename for filename, file_start, file_end in rows]
+
+def last_time(path):
+    '''
+    Gets the last time in a dataset, as recorded in the manifest.  This only reads
+    the manifest, not the dataset, so it is quick enough to call for each request
+    to the web application.
+
+    :param path:    A glob expression defining the location of the data
+    :return:        The last time, as an ISO 8601 string, or None if the dataset
+                    is not in the manifest
+    '''
+    if not os.path.exists(config['Data']['manifest_file']):
+        return None
+    db = _connection()
+    try:
+        return db.execute('SELECT MAX(end) FROM files WHERE dataset = ?', (path,)).fetchone()[0]
+    finally:
+        db.close()
+
+def update_all():
+    '''
+    Updates the manifests of all configured datasets
+
+    :return:    A dict mapping each glob expression to a tuple of (number of files
+                added or updated, number of files removed, list of files out of order)
+    '''
+    import datasets
+    results = {}
+    for path in datasets.configured_paths():
+        n_changed, n_removed = update(path)
+        results[path] = (n_changed, n_removed, check_order(path))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build or update the manifest of the files in each dataset')
+    parser.parse_args()
+    for path, (n_changed, n_removed, out_of_order) in update_all().items():
+        print('{}: {} files added or updated, {} removed'.format(path, n_changed, n_removed))
+        for filename, next_filename in out_of_order:
+            print('  Out of order: {} is not before {}'.format(filename, next_filename))
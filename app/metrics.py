@@ -0,0 +1,205 @@
+'''
+Timing histograms for the stages of jobs, kept in the Celery broker's Redis server.
+
+The web application and every Celery worker add their measurements to the same
+histograms, which are served in the Prometheus text format by the /metrics
+endpoint.  Each histogram is a Redis hash holding the count in each bucket, the
+sum and the total count for each value of its label.  Measurements are buffered
+in each process, and added to Redis in a single round trip every flush_seconds
+(by a background thread, so that an idle process does not hold on to them), so
+that recording them does not slow down jobs or the job store, even when Redis is
+slow or unavailable.
+
+Jobs can also be profiled, with the report saved in the job's output (see start_profile).
+'''
+
+import io
+import os
+import time
+import cProfile
+import pstats
+import atexit
+import logging
+import threading
+import redis
+from contextlib import contextmanager
+from config import config
+
+log = logging.getLogger(__name__)
+
+_PREFIX = 'tamsat-alert:metrics:'
+
+# The upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# The name of each histogram, along with its description and the name of its label
+HISTOGRAMS = {
+    'tamsat_alert_stage_seconds': ('Time spent in each stage of a job', 'stage'),
+    'tamsat_alert_db_seconds': ('Time spent in each job store operation', 'operation'),
+    'tamsat_alert_queue_wait_seconds': ('Time from submitting a job until it starts running', 'metric')
+}
+
+# The name of the profile report in a job's output
+PROFILE_FILE = 'profile.txt'
+
+_clients = {}
+
+# The measurements which have not been added to Redis yet: the increment of each
+# field of each histogram, by histogram name
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+# The process which the flushing thread was started in (see _start_flusher)
+_flusher_pid = None
+
+
+def _client():
+    url = config['Celery']['broker']
+    if url not in _clients:
+        timeout = float(config['Metrics']['timeout_seconds'])
+        _clients[url] = redis.Redis.from_url(url, decode_responses=True,
+                                             socket_timeout=timeout,
+                                             socket_connect_timeout=timeout)
+    return _clients[url]
+
+def _enabled():
+    return config['Metrics'].getboolean('enabled')
+
+def _start_flusher():
+    '''
+    Starts a thread which flushes the measurements of this process every
+    flush_seconds, if one is not already running.  Threads do not survive a
+    fork, so each process (e.g. each Celery worker process) starts its own.
+    Must be called with _pending_lock held.
+    '''
+    global _flusher_pid
+    interval = float(config['Metrics']['flush_seconds'])
+    if _flusher_pid == os.getpid() or interval <= 0:
+        return
+    _flusher_pid = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            flush()
+    threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+
+def observe(name, label, seconds):
+    '''
+    Adds a measurement to a histogram.  It is buffered, and added to Redis with
+    the other measurements of this process when they are next flushed.
+
+    :param name:    The name of the histogram, from HISTOGRAMS
+    :param label:   The value of the histogram's label
+    :param seconds: The measurement
+    '''
+    if not _enabled():
+        return
+    bucket = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+    with _pending_lock:
+        fields = _pending.setdefault(name, {})
+        for field, value in (('{}:{}'.format(label, bucket), 1),
+                             (label + ':sum', seconds),
+                             (label + ':count', 1)):
+            fields[field] = fields.get(field, 0) + value
+        _start_flusher()
+        due = time.monotonic() - _last_flush >= float(config['Metrics']['flush_seconds'])
+    if due:
+        flush()
+
+@atexit.register
+def flush():
+    '''
+    Adds the buffered measurements of this process to Redis.  Problems adding
+    them are logged rather than raised, so that they never cause a job to fail,
+    and the measurements are dropped.
+    '''
+    global _last_flush
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not pending:
+        return
+    try:
+        pipe = _client().pipeline(transaction=False)
+        for name, fields in pending.items():
+            for field, value in fields.items():
+                if field.endswith(':sum'):
+                    pipe.hincrbyfloat(_PREFIX + name, field, value)
+                else:
+                    pipe.hincrby(_PREFIX + name, field, value)
+        pipe.execute()
+    except Exception as e:
+        log.error('Problem recording metrics: ' + str(e))
+
+@contextmanager
+def timer(name, label):
+    '''
+    Times the body of a 'with' block, and adds it to a histogram.  The time is
+    recorded even if the block raises an exception.
+
+    :param name:    The name of the histogram, from HISTOGRAMS
+    :param label:   The value of the histogram's label
+    :return:        A context manager
+    '''
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, label, time.monotonic() - start)
+
+def render():
+    '''
+    :return: All histograms, in the Prometheus text exposition format
+    '''
+    flush()
+    pipe = _client().pipeline(transaction=False)
+    for name in HISTOGRAMS:
+        pipe.hgetall(_PREFIX + name)
+    lines = []
+    for (name, (description, label_name)), values in zip(HISTOGRAMS.items(), pipe.execute()):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} histogram'.format(name))
+        labels = sorted(set(field.rsplit(':', 1)[0] for field in values))
+        for label in labels:
+            # Buckets are stored individually, but are cumulative in the output
+            count = 0
+            for i, bound in enumerate(BUCKETS + ('+Inf',)):
+                count += int(values.get('{}:{}'.format(label, i), 0))
+                lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(
+                    name, label_name, label, bound, count))
+            lines.append('{}_sum{{{}="{}"}} {}'.format(
+                name, label_name, label, float(values.get(label + ':sum', 0))))
+            lines.append('{}_count{{{}="{}"}} {}'.format(
+                name, label_name, label, int(values.get(label + ':count', 0))))
+    return '\n'.join(lines) + '\n'
+
+def start_profile():
+    '''
+    Starts profiling the current thread, if the profile_jobs config value is set
+
+    :return:    A profiler to pass to finish_profile, or None if profiling is off
+    '''
+    if not config['Metrics'].getboolean('profile_jobs'):
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def finish_profile(profiler, report_file):
+    '''
+    Stops profiling, and appends the report to a file.  Reports are appended so
+    that all of the tasks of a job share a single report.
+
+    :param profiler:    The profiler returned by start_profile
+    :param report_file: The file to append the report to
+    '''
+    profiler.disable()
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(50)
+    try:
+        with open(report_file, 'a') as f:
+            f.write(report.getvalue())
+    except OSError as e:
+        log.error('Problem writing profile report: ' + str(e))
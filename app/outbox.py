@@ -0,0 +1,96 @@
+'''
+An outbox of notification emails, kept in the Celery broker's Redis server.
+
+Rather than sending an email as soon as each job completes, messages are added to
+a list per recipient, and are sent together by the send_outbox Celery task a short
+time later.  All messages waiting for the same recipient (e.g. from a batch of
+jobs) are combined into a single email.
+
+The time at which each recipient's messages started waiting is also recorded, so
+that messages whose send_outbox task was lost are found and sent (see stale).
+'''
+
+import json
+import time
+import redis
+from config import config
+
+_PREFIX = 'tamsat-alert:outbox:'
+# A sorted set of the recipients with messages waiting, by when they started waiting
+_WAITING = 'tamsat-alert:outbox-waiting'
+
+_clients = {}
+
+
+def _client():
+    url = config['Celery']['broker']
+    if url not in _clients:
+        _clients[url] = redis.Redis.from_url(url, decode_responses=True)
+    return _clients[url]
+
+def add(to, subject, message):
+    '''
+    Adds a message to the outbox
+
+    :param to:      The email address to send to
+    :param subject: The subject of the message
+    :param message: The message
+    :return:        True if there were no other messages waiting for the recipient,
+                    meaning that the caller must arrange for the outbox to be sent
+    '''
+    pipe = _client().pipeline()
+    pipe.rpush(_PREFIX + to, json.dumps([subject, message]))
+    pipe.zadd(_WAITING, {to: time.time()}, nx=True)
+    return pipe.execute()[0] == 1
+
+def take(to):
+    '''
+    Atomically removes all messages waiting for a recipient
+
+    :param to:  The email address
+    :return:    A list of (subject, message) tuples, in the order they were added
+    '''
+    pipe = _client().pipeline()
+    pipe.lrange(_PREFIX + to, 0, -1)
+    pipe.delete(_PREFIX + to)
+    pipe.zrem(_WAITING, to)
+    messages = pipe.execute()[0]
+    return [tuple(json.loads(message)) for message in messages]
+
+def put_back(to, messages):
+    '''
+    Returns messages which could not be sent to the front of the outbox
+
+    :param to:          The email address
+    :param messages:    A list of (subject, message) tuples, as returned by take
+    '''
+    if messages:
+        pipe = _client().pipeline()
+        pipe.lpush(_PREFIX + to, *[json.dumps(list(message))
+                                   for message in reversed(messages)])
+        pipe.zadd(_WAITING, {to: time.time()}, nx=True)
+        pipe.execute()
+
+def stale(seconds):
+    '''
+    Finds the recipients whose messages have been waiting for longer than they
+    should have, e.g. because the task which was to send them was lost
+
+    :param seconds: How long messages may wait before they are stale
+    :return:        A list of email addresses
+    '''
+    return _client().zrangebyscore(_WAITING, 0, time.time() - seconds)
+
+def combine(messages):
+    '''
+    Combines a number of messages into a single email
+
+    :param messages:    A list of (subject, message) tuples
+    :return:            A tuple of (subject, message)
+    '''
+    if len(messages) == 1:
+        return messages[0]
+    subjects = set(subject for subject, message in messages)
+    subject = subjects.pop() if len(subjects) == 1 else 'TAMSAT alert notifications'
+    return ('{} ({} messages)'.format(subject, len(messages)),
+            '\n\n'.join(message for subject, message in messages))
@@ -0,0 +1,155 @@
+'''
+Running the TAMSAT ALERT cumulative rainfall metric at a point while the web
+application waits, for small queries which don't need to go through the job queue.
+These run on the 'quick' queue (see client.run_quick).
+
+A quick query only reads data from fast sources: the on-disk cache, the
+time-series-optimised store, the summed-area table indexes and the climatology
+store.  If any of its data would have to be read from the daily files, or the
+query would take longer than its latency budget, it is abandoned so that it can
+be run as a job instead.  Such jobs run the same code (see compute_cumrain), so
+that a query gives the same results whether or not it was run directly.
+'''
+
+import time
+import numpy as np
+import pandas as pd
+from config import config
+import climstore
+import ensemble
+import extraction
+import region
+
+# The statistics returned by a quick query
+RESULT_NAMES = ('prob_lower', 'prob_middle', 'prob_upper',
+                'ensemble_mean', 'ensemble_std',
+                'clim_mean', 'clim_lower', 'clim_upper', 'observed')
+
+# The name of the file holding the results of a quick query which was run as a job
+RESULTS_FILE = 'results.json'
+
+# The estimated time taken to build the ensemble, per day of data per year,
+# which is updated from the time taken by each query in this process
+_seconds_per_unit = 1e-6
+# How quickly the estimate follows recent queries
+_SMOOTHING = 0.2
+
+
+def run_cumrain(location, fc_location, fc_var, cast_date,
+                poi_start_day, poi_start_month, poi_end_day, poi_end_month,
+                fc_start_day, fc_start_month, fc_end_day, fc_end_month,
+                stat_type, tercile_weights, budget_seconds):
+    '''
+    Runs the cumulative rainfall metric at a single location, if it can be done
+    within a latency budget
+
+    :param location:        A tuple containing the (lon, lat) of the location
+    :param fc_location:     A tuple containing the (minLon, maxLon, minLat, maxLat)
+                            values of the bounding box of the forecast driving data
+    :param fc_var:          Either "temperature" or "precipitation"
+    :param budget_seconds:  The time allowed for the query, in seconds
+    :return:                A dict of the statistics in RESULT_NAMES (with missing
+                            values as None), or None if the query could not be run
+                            within the budget
+
+    All other parameters are the same as for region.run_cumrain
+    '''
+    deadline = time.monotonic() + budget_seconds
+
+    if fc_var == 'temperature':
+        fc_path = config['Data']['met_fc_temp_path']
+    else:
+        fc_path = config['Data']['tamsat_path']
+    fc_data = extraction.extract_area_mean_timeseries(fc_path, *fc_location, fast_only=True)
+    if fc_data is None or time.monotonic() > deadline:
+        return None
+
+    lon, lat = location
+    data = extraction.extract_point_timeseries(config['Data']['tamsat_path'], lon, lat,
+                                               fast_only=True)
+    if data is None or time.monotonic() > deadline:
+        return None
+
+    return compute_cumrain(location, data, fc_data, fc_var, cast_date,
+                           poi_start_day, poi_start_month, poi_end_day, poi_end_month,
+                           fc_start_day, fc_start_month, fc_end_day, fc_end_month,
+                           stat_type, tercile_weights, deadline)
+
+def compute_cumrain(location, data, fc_data, fc_var, cast_date,
+                    poi_start_day, poi_start_month, poi_end_day, poi_end_month,
+                    fc_start_day, fc_start_month, fc_end_day, fc_end_month,
+                    stat_type, tercile_weights, deadline=None):
+    '''
+    Runs the cumulative rainfall metric at a single location, on data which has
+    already been extracted.  This is used both for quick queries, and for the
+    jobs which run them when they cannot be run within their latency budget,
+    so that both give the same results.
+
+    :param location:    A tuple containing the (lon, lat) of the location
+    :param data:        A pandas DataFrame of the data at the location, as
+                        returned by extract_point_timeseries
+    :param fc_data:     A pandas DataFrame of the forecast driving data, as
+                        returned by extract_area_mean_timeseries
+    :param deadline:    The time.monotonic() time by which the query must finish,
+                        or None for no limit.  Optional, defaults to None
+    :return:            A dict of the statistics in RESULT_NAMES (with missing
+                        values as None), or None if the query could not be run
+                        before the deadline
+
+    All other parameters are the same as for run_cumrain
+    '''
+    lon, lat = location
+    rainfall = data[config['Data']['precip_str']]
+
+    # Use the precomputed climatology of the pixel, if it is up to date
+    window = (poi_start_day, poi_start_month, poi_end_day, poi_end_month)
+    climatology = climstore.open_climatology(*window)
+    if climatology is None:
+        climstore.request(*window)
+        season_totals = None
+        clim_bounds = None
+    else:
+        with climatology:
+            climatology = climatology.sel(lon=lon, lat=lat, method='nearest').load()
+        season_totals = {int(year): climatology['season_total'].sel(year=year).values
+                         for year in climatology['year'].values}
+        clim_bounds = (climatology['clim_lower_' + stat_type].values,
+                       climatology['clim_upper_' + stat_type].values)
+
+    # The ensemble can't be interrupted, so only start it if it is expected to
+    # finish before the deadline
+    cost = len(rainfall) * len(set(region.climatology_years()) | set(region.ensemble_years()))
+    start = time.monotonic()
+    if deadline is not None and start + cost * _seconds_per_unit > deadline:
+        return None
+
+    members = ensemble.cumrain_ensemble(pd.DatetimeIndex(rainfall.index),
+                                        rainfall.values,
+                                        region.fc_series(fc_data, fc_var),
+                                        cast_date,
+                                        poi_start_day, poi_start_month,
+                                        poi_end_day, poi_end_month,
+                                        fc_start_day, fc_start_month,
+                                        fc_end_day, fc_end_month,
+                                        tercile_weights,
+                                        region.climatology_years(),
+                                        region.ensemble_years(),
+                                        season_totals)
+    results = ensemble.tercile_probabilities(members['members'],
+                                             members['weights'],
+                                             members['climatology'],
+                                             stat_type, clim_bounds)
+    results['observed'] = members['observed']
+    _record_time(cost, time.monotonic() - start)
+
+    return {name: float(results[name]) if np.isfinite(results[name]) else None
+            for name in RESULT_NAMES}
+
+def _record_time(cost, seconds):
+    '''
+    Updates the estimated time taken by the ensemble per unit of cost (days of
+    data times years), from the time taken by a query
+    '''
+    global _seconds_per_unit
+    if cost > 0:
+        _seconds_per_unit += _SMOOTHING * (seconds / cost - _seconds_per_unit)
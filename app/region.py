@@ -0,0 +1,190 @@
+'''
+Running the TAMSAT ALERT cumulative rainfall metric over a region.
+
+Rather than running the point code once per pixel, the data for the whole region
+is extracted at once, and the ensemble is computed for every pixel together (see
+the ensemble module).  The output is a NetCDF file of gridded tercile probabilities.
+
+Large regions are split into tiles, which are run as separate Celery tasks so
+that they can be spread across worker processes.
+
+Where the climatology store holds the period of interest (see the climstore
+module), only the days of each year up to the forecast date are extracted.
+'''
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from config import config
+import climstore
+import ensemble
+import extraction
+import tsstore
+
+# The variables written to the output, and their descriptions
+_OUTPUT_VARIABLES = {
+    'prob_lower': 'Probability of rainfall in the lower climatological tercile',
+    'prob_middle': 'Probability of rainfall in the middle climatological tercile',
+    'prob_upper': 'Probability of rainfall in the upper climatological tercile',
+    'ensemble_mean': 'Weighted ensemble mean of cumulative rainfall over the period of interest',
+    'ensemble_std': 'Weighted ensemble standard deviation of cumulative rainfall over the period of interest',
+    'clim_mean': 'Climatological mean of cumulative rainfall over the period of interest',
+    'clim_lower': 'Upper boundary of the lower climatological tercile',
+    'clim_upper': 'Lower boundary of the upper climatological tercile',
+    'observed': 'Observed rainfall in the period of interest before the forecast date'
+}
+
+
+def climatology_years():
+    '''
+    :return: The years to use for the climatology, from the config
+    '''
+    return list(range(int(config['Data']['climatology_start_year']),
+                      int(config['Data']['climatology_end_year']) + 1))
+
+def ensemble_years():
+    '''
+    :return: The years to use for the ensemble members, from the config
+    '''
+    return list(range(int(config['Data']['period_of_interest_start_year']),
+                      int(config['Data']['period_of_interest_end_year']) + 1))
+
+def first_day():
+    '''
+    :return: The first day of data needed for either the climatology or the ensemble members
+    '''
+    return pd.Timestamp(min(climatology_years()[0], ensemble_years()[0]), 1, 1)
+
+def fc_series(fc_data, fc_var):
+    '''
+    Gets the forecast driving variable from an area mean timeseries
+
+    :param fc_data: A pandas DataFrame, as returned by extract_area_mean_timeseries
+    :param fc_var:  Either "temperature" or "precipitation"
+    :return:        A pandas Series
+    '''
+    if fc_var == 'temperature':
+        return fc_data[config['Data']['temp_str']]
+    return fc_data[config['Data']['precip_str']]
+
+def tiles(minlon, maxlon, minlat, maxlat):
+    '''
+    Splits a bounding box into tiles of at most region_tile_size pixels along each side
+
+    :param minlon:  The western edge of the bounding box
+    :param maxlon:  The eastern edge of the bounding box
+    :param minlat:  The southern edge of the bounding box
+    :param maxlat:  The northern edge of the bounding box
+    :return:        A list of (minlon, maxlon, minlat, maxlat) tuples.  Each
+                    pixel in the box is in exactly one tile.
+    '''
+    tile_size = int(config['Tasks']['region_tile_size'])
+    lons, lats = extraction.grid_axes(config['Data']['tamsat_path'])
+    lons = np.sort(lons[(lons >= minlon) & (lons <= maxlon)])
+    lats = np.sort(lats[(lats >= minlat) & (lats <= maxlat)])
+    if len(lons) == 0 or len(lats) == 0:
+        raise ValueError('No data points within the bounding box')
+
+    return [(float(tile_lons[0]), float(tile_lons[-1]),
+             float(tile_lats[0]), float(tile_lats[-1]))
+            for tile_lons in np.array_split(lons, int(np.ceil(len(lons) / tile_size)))
+            for tile_lats in np.array_split(lats, int(np.ceil(len(lats) / tile_size)))]
+
+def run_cumrain(box, fc_data, fc_var, cast_date,
+                poi_start_day, poi_start_month, poi_end_day, poi_end_month,
+                fc_start_day, fc_start_month, fc_end_day, fc_end_month,
+                stat_type, tercile_weights, output_file):
+    '''
+    Runs the cumulative rainfall metric over every pixel in a bounding box,
+    and writes the gridded output to a NetCDF file
+
+    :param box:         A tuple containing the (minLon, maxLon, minLat, maxLat)
+                        values of the bounding box
+    :param fc_data:     A pandas DataFrame of the forecast driving data, as
+                        returned by extract_area_mean_timeseries
+    :param fc_var:      Either "temperature" or "precipitation"
+    :param output_file: The NetCDF file to write
+
+    All other parameters are the same as the fields of a job (see client.submit_job)
+    '''
+    window = (poi_start_day, poi_start_month, poi_end_day, poi_end_month)
+    climatology = climstore.open_climatology(*window)
+    if climatology is None:
+        # Add the period of interest to the store, for the next job which uses it
+        climstore.request(*window)
+        data = extraction.extract_region(config['Data']['tamsat_path'], *box,
+                                         start=first_day())
+        season_totals = None
+        clim_bounds = None
+    else:
+        with climatology:
+            climatology = tsstore.select_box(climatology, *box).load()
+        data = extraction.extract_region(config['Data']['tamsat_path'], *box,
+                                         times=_days_to_cast_date(cast_date, *window,
+                                                                  years=climatology['year'].values))
+        season_totals = {int(year): climatology['season_total'].sel(year=year).values
+                         for year in climatology['year'].values}
+        clim_bounds = (climatology['clim_lower_' + stat_type].values,
+                       climatology['clim_upper_' + stat_type].values)
+    rainfall = data[config['Data']['precip_str']].transpose('time', 'lat', 'lon')
+
+    members = ensemble.cumrain_ensemble(pd.DatetimeIndex(rainfall['time'].values),
+                                        rainfall.values,
+                                        fc_series(fc_data, fc_var),
+                                        cast_date,
+                                        poi_start_day, poi_start_month,
+                                        poi_end_day, poi_end_month,
+                                        fc_start_day, fc_start_month,
+                                        fc_end_day, fc_end_month,
+                                        tercile_weights,
+                                        climatology_years(),
+                                        ensemble_years(),
+                                        season_totals)
+    results = ensemble.tercile_probabilities(members['members'],
+                                             members['weights'],
+                                             members['climatology'],
+                                             stat_type, clim_bounds)
+    results['observed'] = members['observed']
+
+    # Pixels with no data at all (e.g. over the sea) should be missing, not zero
+    if climatology is None:
+        no_data = rainfall.isnull().all('time').values
+    else:
+        no_data = climatology['season_total'].isnull().all('year').values
+
+    output = xr.Dataset(coords={'lat': rainfall['lat'], 'lon': rainfall['lon']},
+                        attrs={'title': 'TAMSAT ALERT cumulative rainfall probabilities',
+                               'forecast_date': str(cast_date.date()),
+                               'probability_distribution': stat_type})
+    for name, description in _OUTPUT_VARIABLES.items():
+        output[name] = (('lat', 'lon'), np.where(no_data, np.nan, results[name]))
+        output[name].attrs['long_name'] = description
+    output.to_netcdf(output_file)
+
+def _days_to_cast_date(cast_date, poi_start_day, poi_start_month, poi_end_day, poi_end_month,
+                       years):
+    '''
+    Gets the days needed to run the cumulative rainfall metric using the climatology
+    store.  These are the days of the current season before the forecast date, and
+    the same number of days from the start of the season in each of the given years.
+
+    :return:    A pandas DatetimeIndex
+    '''
+    season_start = ensemble.first_season_ending_after(cast_date, poi_start_day, poi_start_month,
+                                                      poi_end_day, poi_end_month)[0]
+    days_observed = max(0, (cast_date - season_start).days)
+    starts = [season_start] + [ensemble.season_bounds(int(year), poi_start_day, poi_start_month,
+                                                      poi_end_day, poi_end_month)[0]
+                               for year in years]
+    return pd.DatetimeIndex(sorted(set(day for start in starts
+                                       for day in pd.date_range(start, periods=days_observed))))
+
+def merge_tiles(tile_files, output_file):
+    '''
+    Merges the outputs of a number of tiles into a single NetCDF file
+
+    :param tile_files:  The NetCDF files written for each tile
+    :param output_file: The NetCDF file to write
+    '''
+    with xr.open_mfdataset(tile_files, combine='by_coords') as merged:
+        merged.to_netcdf(output_file)
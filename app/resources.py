@@ -0,0 +1,84 @@
+'''
+Measuring and limiting the resources used by Celery tasks.
+
+The resources used by each task of a job are measured (see tasks.start_accounting
+and tasks.record_accounting) and added to the job in the database, so that the
+cost of different kinds of job can be seen.  These measurements rely on the
+Linux /proc filesystem, and are left as zero where it is not available.
+'''
+
+import time
+import resource
+import datasets
+
+# The resources recorded for each job.  The peak RSS is the maximum over all of
+# the job's tasks, and the others are totals.
+RESOURCE_NAMES = ('peak_rss_mb', 'wall_seconds', 'cpu_seconds', 'bytes_read', 'files_opened')
+
+
+def _proc_value(name, field):
+    '''
+    Reads a value from a file in /proc/self, e.g. VmHWM from /proc/self/status
+
+    :return: The value as an integer, or 0 if it is not available
+    '''
+    try:
+        with open('/proc/self/' + name) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def start():
+    '''
+    Starts measuring the resources used by the current process
+
+    :return:    A token to pass to finish
+    '''
+    try:
+        # Reset the peak RSS of the process, so that it only covers what follows
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    return (time.monotonic(), _cpu_seconds(), _proc_value('io', 'rchar'), datasets.files_opened)
+
+def finish(token):
+    '''
+    Finishes measuring the resources used by the current process
+
+    :param token:   The token returned by start
+    :return:        A dict containing the resources in RESOURCE_NAMES used since
+                    start was called:
+                    'peak_rss_mb' - the peak resident memory of the process
+                    'wall_seconds', 'cpu_seconds' - the elapsed and CPU time
+                    'bytes_read' - the number of bytes read by the process
+                    'files_opened' - the number of data files opened
+    '''
+    start_time, start_cpu, start_bytes, start_files = token
+    return {
+        'peak_rss_mb': _proc_value('status', 'VmHWM') / 1024.0,
+        'wall_seconds': time.monotonic() - start_time,
+        'cpu_seconds': _cpu_seconds() - start_cpu,
+        'bytes_read': max(0, _proc_value('io', 'rchar') - start_bytes),
+        'files_opened': datasets.files_opened - start_files
+    }
+
+def limit_memory(megabytes):
+    '''
+    Limits the memory which the current process can allocate.  Allocations over
+    the limit raise a MemoryError, rather than the process being killed by the
+    kernel when the machine runs out of memory.
+
+    Memory-mapped files (e.g. entries in the data cache) do not count towards the limit.
+
+    :param megabytes:   The limit, in megabytes
+    '''
+    limit = int(megabytes) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
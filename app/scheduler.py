@@ -0,0 +1,289 @@
+'''
+Fair-share scheduling of jobs between users, kept in the Celery broker's Redis server.
+
+Rather than being sent to Celery as soon as they are submitted, jobs wait here,
+and only max_running_jobs are sent to Celery at a time (see client.dispatch).
+This stops one user who submits hundreds of jobs from holding up everyone else.
+
+Waiting jobs are grouped into flows, one per user per priority class, and the
+next job is chosen by deficit round robin: each flow in turn is given a quantum
+of run time (in proportion to the weight of its priority class), and runs jobs
+while the estimated run time of its next job fits within the run time it has
+been given.  So every user gets an equal share of the workers, and point jobs
+get a larger share than regions and hindcasts, without either being starved.
+
+Run times are estimated for each kind of job from the recorded run times of
+previous jobs of that kind.
+
+The data is laid out as follows (all keys are prefixed with _PREFIX):
+
+* flows - a list of the flows with waiting jobs, in round robin order
+* flow:<flow> - a list of the waiting jobs in each flow, as JSON (job_id, kind, cost)
+* job:<job_id> - the parameters of each waiting job, encoded by the jobspec module
+* deficit - a hash of the run time given to each flow but not yet used
+* running - a hash of the jobs which have been sent to Celery, as JSON (kind, time)
+* run-seconds - a hash of the average run time of each kind of job
+'''
+
+import json
+import time
+from datetime import datetime as dt, timedelta
+import redis
+from config import config
+import jobspec
+
+_PREFIX = 'tamsat-alert:scheduler:'
+
+# The priority classes of jobs, from highest to lowest
+PRIORITY_CLASSES = ('point', 'bulk')
+# How quickly the estimated run time of a kind of job follows recent jobs
+_RUN_SECONDS_SMOOTHING = 0.2
+# How long to hold the lock for while choosing jobs
+_LOCK_SECONDS = 30
+
+_clients = {}
+
+
+def _client():
+    url = config['Celery']['broker']
+    if url not in _clients:
+        _clients[url] = redis.Redis.from_url(url)
+    return _clients[url]
+
+def _key(name):
+    return _PREFIX + name
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def enabled():
+    '''
+    :return: Whether jobs are scheduled, rather than sent straight to Celery
+    '''
+    return int(config['Tasks']['max_running_jobs']) > 0
+
+def lock():
+    '''
+    :return: A lock to hold while changing the scheduler's state, as a context manager
+    '''
+    return _client().lock(_key('lock'), timeout=_LOCK_SECONDS)
+
+def priority_class(job):
+    '''
+    :return: The priority class of a job (see PRIORITY_CLASSES)
+    '''
+    if len(job['location']) == 4 or job.get('cast_dates'):
+        return 'bulk'
+    return 'point'
+
+def job_kind(job):
+    '''
+    :return: The kind of a job, for estimating its run time, e.g. 'cumrain-region'
+    '''
+    if len(job['location']) == 4:
+        shape = 'region'
+    elif job.get('cast_dates'):
+        shape = 'hindcast'
+    else:
+        shape = 'point'
+    return job['metric'] + '-' + shape
+
+def _weight(flow):
+    # Point flows are given a quantum which fits a typical job, so that users'
+    # jobs are interleaved one at a time, and other flows a fraction of that
+    if flow.split(':', 1)[0] == 'point':
+        return 1.0
+    return 1.0 / float(config['Tasks']['point_job_weight'])
+
+def _run_seconds():
+    '''
+    :return: A function giving the estimated run time of each kind of job
+    '''
+    known = {_decode(kind): float(seconds)
+             for kind, seconds in _client().hgetall(_key('run-seconds')).items()}
+    default = float(config['Tasks']['default_run_seconds'])
+    return lambda kind: known.get(kind, default)
+
+def add(jobs):
+    '''
+    Adds jobs to the end of their users' flows.  The caller must hold the lock.
+
+    :param jobs:    A list of JobSpecs containing the parameters of each job (see client.submit_job)
+    '''
+    run_seconds = _run_seconds()
+    r = _client()
+    flows = set(_decode(flow) for flow in r.lrange(_key('flows'), 0, -1))
+    pipe = r.pipeline()
+    for job in jobs:
+        flow = priority_class(job) + ':' + job.get('userhash', '')
+        kind = job_kind(job)
+        pipe.set(_key('job:' + job['job_id']), jobspec.dumps(job))
+        pipe.rpush(_key('flow:' + flow), json.dumps([job['job_id'], kind, run_seconds(kind)]))
+        if flow not in flows:
+            pipe.rpush(_key('flows'), flow)
+            flows.add(flow)
+    pipe.execute()
+
+def _purge_running(r):
+    '''
+    Forgets jobs which have been running for far longer than any job should.
+    Jobs which fail or are revoked free their places straight away (see
+    client.job_finished), so this is only needed for jobs whose worker was
+    killed before they could finish.
+    '''
+    task_time_limit = int(config['Tasks']['task_time_limit'])
+    max_seconds = task_time_limit * 4 if task_time_limit > 0 else 86400
+    oldest = time.time() - max_seconds
+    stale = [job_id for job_id, value in r.hgetall(_key('running')).items()
+             if json.loads(_decode(value))[1] < oldest]
+    if stale:
+        r.hdel(_key('running'), *stale)
+
+def _waiting(r, flows):
+    '''
+    :return: A dict mapping each flow to a list of its waiting jobs, as (job_id, kind, cost) lists
+    '''
+    pipe = r.pipeline()
+    for flow in flows:
+        pipe.lrange(_key('flow:' + flow), 0, -1)
+    return {flow: [json.loads(_decode(entry)) for entry in entries]
+            for flow, entries in zip(flows, pipe.execute())}
+
+def take():
+    '''
+    Chooses the jobs to send to Celery, so that at most max_running_jobs are
+    running, and records them as running.  The caller must hold the lock.
+
+    :return:    A list of JobSpecs containing the parameters of each job
+    '''
+    r = _client()
+    _purge_running(r)
+    free = int(config['Tasks']['max_running_jobs']) - r.hlen(_key('running'))
+    flows = [_decode(flow) for flow in r.lrange(_key('flows'), 0, -1)]
+    if free <= 0 or not flows:
+        return []
+
+    waiting = _waiting(r, flows)
+    n_taken = dict((flow, 0) for flow in flows)
+    deficits = {_decode(flow): float(deficit)
+                for flow, deficit in r.hgetall(_key('deficit')).items()}
+    quantum = float(config['Tasks']['default_run_seconds'])
+    taken = []
+    # Deficit round robin, where the flow at the front is the one being served
+    order = list(flows)
+    while order and len(taken) < free:
+        flow = order[0]
+        if n_taken[flow] == len(waiting[flow]):
+            # The flow has no more waiting jobs
+            order.pop(0)
+            deficits.pop(flow, None)
+            continue
+        job_id, kind, cost = waiting[flow][n_taken[flow]]
+        deficit = deficits.get(flow, 0.0)
+        if deficit >= cost:
+            deficits[flow] = deficit - cost
+            n_taken[flow] += 1
+            taken.append((job_id, kind))
+        else:
+            # Give the flow its quantum, and move on to the next flow
+            deficits[flow] = deficit + quantum * _weight(flow)
+            order.append(order.pop(0))
+
+    now = time.time()
+    pipe = r.pipeline()
+    for flow, n in n_taken.items():
+        if n:
+            pipe.ltrim(_key('flow:' + flow), n, -1)
+    pipe.delete(_key('flows'), _key('deficit'))
+    if order:
+        pipe.rpush(_key('flows'), *order)
+    deficits = {flow: deficit for flow, deficit in deficits.items() if flow in order}
+    if deficits:
+        pipe.hset(_key('deficit'), mapping=deficits)
+    for job_id, kind in taken:
+        pipe.get(_key('job:' + job_id))
+        pipe.delete(_key('job:' + job_id))
+    results = pipe.execute()
+    encoded = results[len(results) - 2 * len(taken):][::2] if taken else []
+
+    # Jobs whose parameters are missing (e.g. because they have expired from
+    # Redis) cannot be run, so they are dropped rather than taking up a place
+    jobs = []
+    pipe = r.pipeline()
+    for (job_id, kind), value in zip(taken, encoded):
+        if value is not None:
+            pipe.hset(_key('running'), job_id, json.dumps([kind, now]))
+            jobs.append(jobspec.loads(value))
+    pipe.execute()
+    if len(jobs) < len(taken):
+        # Fill the places of the dropped jobs
+        jobs += take()
+    return jobs
+
+def finished(job_id, succeeded=True):
+    '''
+    Records that a job has finished running, freeing its place for another job
+
+    :param job_id:      The ID of the job
+    :param succeeded:   Whether the job succeeded, in which case its run time is
+                        used to estimate the run time of later jobs of the same kind
+    '''
+    r = _client()
+    value = r.hget(_key('running'), job_id)
+    if value is None:
+        return
+    r.hdel(_key('running'), job_id)
+    if succeeded:
+        kind, start_time = json.loads(_decode(value))
+        seconds = time.time() - start_time
+        previous = r.hget(_key('run-seconds'), kind)
+        if previous is not None:
+            seconds = float(previous) + _RUN_SECONDS_SMOOTHING * (seconds - float(previous))
+        r.hset(_key('run-seconds'), kind, seconds)
+
+def waiting_userhashes():
+    '''
+    :return: The set of userhashes of all users with waiting jobs
+    '''
+    return set(_decode(flow).split(':', 1)[1] for flow in _client().lrange(_key('flows'), 0, -1))
+
+def queue_positions(userhash):
+    '''
+    Estimates the position in the queue and start time of each of a user's waiting jobs.
+
+    Under deficit round robin, a job runs once its flow has been given enough
+    run time for it and all jobs ahead of it (T seconds), by which time each
+    other flow has been given about T * (its weight / the flow's weight)
+    seconds, so this counts the jobs which fit into that time in each flow.
+
+    :param userhash:    The userhash of the user
+    :return:            A dict mapping the job ID of each waiting job to a tuple
+                        of (number of jobs ahead of it, estimated start time)
+    '''
+    r = _client()
+    waiting = _waiting(r, [_decode(flow) for flow in r.lrange(_key('flows'), 0, -1)])
+
+    n_workers = float(config['Tasks']['max_running_jobs'])
+    now = dt.now()
+    positions = {}
+    for flow, entries in waiting.items():
+        if flow.split(':', 1)[1] != userhash:
+            continue
+        seconds_before = 0.0
+        for i, (job_id, kind, cost) in enumerate(entries):
+            n_ahead = i
+            seconds_ahead = seconds_before
+            for other_flow, other_entries in waiting.items():
+                if other_flow == flow:
+                    continue
+                share = (seconds_before + cost) * _weight(other_flow) / _weight(flow)
+                total = 0.0
+                for other_job_id, other_kind, other_cost in other_entries:
+                    if total + other_cost > share:
+                        break
+                    total += other_cost
+                    n_ahead += 1
+                seconds_ahead += total
+            positions[job_id] = (n_ahead, now + timedelta(seconds=seconds_ahead / n_workers))
+            seconds_before += cost
+    return positions
@@ -2,146 +2,383 @@
 Module containing the definition of the celery tasks
 '''
 
-from celery import Celery, Task
+from celery import chord
+from celery.exceptions import Ignore
+from celery.signals import task_failure, task_postrun, task_prerun, task_revoked, \
+    worker_process_init, worker_process_shutdown
 from celery.utils.log import get_task_logger
 
+import json
 import os
 import os.path
 import shutil
+import time
 from datetime import timedelta, datetime as dt
 import zipfile
 
-from tamsat_alert import tamsat_alert as ta_cr
-from tamsat_alert import tamsat_alert_sm as ta_sm
-import tamsat_alert.extract_data as xd
 from config import config
+from client import celery_app
+from jobspec import JobSpec
+import areaindex
+import cache
+import client
+import climstore
+import datasets
+import extraction
+import hindcast
+import manifest
+import metrics
+import outbox
+import quick
+import region
+import resources
+import scheduler
+import tsstore
 import util
 import database as db
 
 
 log = get_task_logger(__name__)
 
-# Setup the celery app
-celery_app = Celery('tasks',
-                    backend=config['Celery']['backend'],
-                    broker=config['Celery']['broker'])
+# The name of the output file for region jobs
+_REGION_OUTPUT_FILE = 'tamsat_alert_region.nc'
+# Output files with these extensions are already compressed, so are not compressed again when zipped
+_STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.zip', '.gz')
+# Zip files newer than this (in seconds) may belong to a job which is still being
+# added to the database, so are not removed even if they have no matching job
+_ORPHAN_MIN_AGE = 3600
+# How long (in seconds) after they should have been sent that messages in the
+# outbox are sent by sweep_outbox
+_OUTBOX_GRACE_SECONDS = 600
+# The config values naming the NCEP variables which the soil moisture code uses
+_SM_VARIABLE_OPTIONS = ('sw_rad_str', 'lw_rad_str', 'pr_str', 'temp_str', 'pressure_str',
+                        'wind_u_comp_str', 'wind_v_comp_str', 'humidity_str')
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    '''
+    Limits the memory of each worker process
+    '''
+    max_task_memory_mb = int(config['Tasks']['max_task_memory_mb'])
+    if max_task_memory_mb > 0:
+        resources.limit_memory(max_task_memory_mb)
 
-# This is necessary if we want the task to accept non-JSON compatible args (e.g. dates)
-celery_app.conf.update(task_serializer='pickle',
-                       accept_content=['json', 'pickle'])
 
-# Run the cleanup every hour
-celery_app.conf.beat_schedule = {
-    'cleanup-files': {
-        'task': 'tasks.cleanup_files',
-        'schedule': 3600.0
-    }
-}
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    '''
+    Closes the datasets and SMTP connection held by each worker process, and
+    records its remaining metrics
+    '''
+    datasets.close_all()
+    util.close_smtp_connection()
+    metrics.flush()
 
 
-@celery_app.task()
-def tamsat_alert_run(location, fc_location, fc_var, cast_date, poi_start_day, poi_start_month, poi_end_day, poi_end_month, fc_start_day, fc_start_month, fc_end_day, fc_end_month, stat_type, tercile_weights, email, db_key, metric='cumrain', soil_type=None):
+# The measurements of the tasks running in this process, by task ID: a tuple of
+# (resources token, profiler or None)
+_task_accounting = {}
+
+# Tasks which are profiled when the profile_jobs config value is set.  Later
+# tasks cannot be included, since the output has already been zipped.
+_PROFILED_TASKS = ('tasks.extract_inputs', 'tasks.run_model',
+                   'tasks.run_region_tile', 'tasks.merge_region_tiles')
+
+def _job_arg(args):
+    '''
+    :return: The job a task is running for (see client.submit_job), or None if it is not running a job
     '''
-    Runs the TAMSAT ALERT code and, updates the database, zips the output,
-    cleans up temporary files, and emails users.
+    job = args[0] if args else None
+    if isinstance(job, JobSpec) and job.db_key is not None:
+        return job
+    return None
 
-    :param location: A tuple containing the (longitude, latitude) value of the
-                     location at which to run the code.  NOTE the X-Y order.
-    :param fc_location: A tuple containing the (minLon, maxLon, minLat, maxLat)
-                     values of the bounding box over which to extract
-                     the met forecast data.  NOTE the X-Y order
-    :param fc_var:   Either "temperature" or "precipitation", passed to
-                     TAMSAT_ALERT code as met_ts_variable
-    :param email:    The email address of the user running the job
-    :db_key:         The primary key of the job in the database
-    :param metric:   The name of the metric to run.
-                     Acceptable values are 'cumrain' and 'soilmoisture'
-
-    All other parameters are passed directly to the TAMSAT ALERT code, and are
-    documented there.
+@task_prerun.connect
+def start_accounting(task_id=None, task=None, args=None, **kwargs):
     '''
-    log.debug('Calling task')
+    Starts measuring the time and resources used by each task, and profiling it if necessary
+    '''
+    profiler = None
+    if task is not None and task.name in _PROFILED_TASKS and _job_arg(args) is not None:
+        profiler = metrics.start_profile()
+    _task_accounting[task_id] = (resources.start(), profiler)
 
+
+@task_postrun.connect
+def record_accounting(task_id=None, task=None, args=None, **kwargs):
+    '''
+    Records the time spent in each task as a stage, and adds the resources used
+    by each task of a job to the job in the database
+    '''
+    token, profiler = _task_accounting.pop(task_id, (None, None))
+    if token is None:
+        return
+    usage = resources.finish(token)
+    job = _job_arg(args)
+    if profiler is not None:
+        metrics.finish_profile(profiler, _profile_file(job['job_id']))
+    if task is not None:
+        metrics.observe('tamsat_alert_stage_seconds', task.name.split('.')[-1], usage['wall_seconds'])
+    if job is None:
+        return
     try:
-        job_id = tamsat_alert_run.request.id
+        db.add_job_resources(job['db_key'], usage)
+    except Exception as e:
+        # This is not critical, just log it
+        log.error('Problem recording resources for job: ' + str(e))
+
+
+@task_failure.connect
+def release_failed_job(task_id=None, args=None, **kwargs):
+    '''
+    Frees the scheduler place of a job when any of its tasks fails.  The tasks
+    already do this when they catch an exception (see _fail_job), in which case
+    this does nothing, but not when they fail outside their handlers, or when
+    their worker process is lost (which newer versions of Celery report as a
+    failure).
+    '''
+    job = _job_arg(args)
+    if job is not None:
+        try:
+            client.job_finished(job, False)
+        except Exception as e:
+            log.error('Problem dispatching jobs: ' + str(e))
+
+
+@task_revoked.connect
+def fail_revoked_job(request=None, terminated=False, expired=False, **kwargs):
+    '''
+    Records that a job has failed when any of its tasks is revoked, e.g. by
+    terminating it or because it expired, which also frees its scheduler place
+    '''
+    try:
+        # Newer versions of Celery give the arguments of the request, but otherwise
+        # they are read from its message, which decodes them when first read
+        args = request.args if hasattr(request, 'args') else request.message.payload[0]
+    except Exception as e:
+        log.error('Problem finding the job of a revoked task: ' + str(e))
+        return
+    job = _job_arg(args)
+    if job is not None:
+        _fail_job(job, 'The job expired' if expired else 'The job was cancelled')
 
-        # Update the database to indicate the job is running
-        db.set_job_running(db_key, job_id)
 
-        lon, lat = location
+def _output_path(job_id):
+    '''
+    Gets the output directory for a job in config['Tasks']['workdir']
+    This is based on the job ID, so will be unique
+    '''
+    return os.path.join(config['Tasks']['workdir'], job_id)
+
+def _profile_file(job_id):
+    '''
+    Gets the file which the profile reports of a job are written to, before
+    being added to its output (see metrics.start_profile)
+    '''
+    return _output_path(job_id) + '-' + metrics.PROFILE_FILE
+
+def _input_key(job, name):
+    '''
+    Gets the cache key of an input extracted for a job
+    '''
+    return cache.make_key('job-input', job['job_id'], name)
+
+
+@celery_app.task
+def prefetch_inputs(jobs):
+    '''
+    Extracts the data needed by a batch of jobs into the cache, so that each job's
+    extract_inputs is served from the cache.  Jobs which share a forecast box
+    share a single area mean, and all point data is read in a single pass.
+
+    This is only an optimisation, so any problems are logged and otherwise ignored.
+
+    :param jobs:    A list of JobSpecs containing the parameters of each job (see client.submit_job)
+    '''
+    try:
+        for fc_location, fc_var in set((tuple(job['fc_location']), job['fc_var']) for job in jobs):
+            _extract_fc_data(fc_location, fc_var)
+
+        points = [tuple(job['location']) for job in jobs if len(job['location']) == 2]
+        if points:
+            extraction.prefetch_point_timeseries(config['Data']['tamsat_path'], points)
+        sm_points = [tuple(job['location']) for job in jobs
+                     if len(job['location']) == 2 and job['metric'] == 'soilmoisture']
+        if sm_points:
+            # Every grid cell of the TAMSAT data has the same times
+            times = extraction.extract_point_timeseries(config['Data']['tamsat_path'],
+                                                        *sm_points[0]).index
+            extraction.prefetch_point_drivers(config['Data']['met_fc_path'], sm_points,
+                                              _sm_variables(), region.first_day(), times)
+    except Exception as e:
+        log.error('Problem prefetching data for batch: ' + str(e))
+
+
+@celery_app.task
+def schedule_jobs(jobs):
+    '''
+    Adds a batch of jobs to the scheduler, once their data has been prefetched
+
+    :param jobs:    A list of JobSpecs containing the parameters of each job (see client.submit_job)
+    '''
+    with scheduler.lock():
+        scheduler.add(jobs)
+    client.dispatch()
 
-        # Setup an output directory in config['Tasks']['workdir']
-        # This is based on the celery job ID, so will be unique
-        output_path = os.path.join(config['Tasks']['workdir'], job_id)
 
-        # Extract a DataFrame containing the data at the specified location
+@celery_app.task
+def dispatch_jobs():
+    '''
+    Sends waiting jobs to Celery, if there is room for them (see dispatch)
+    '''
+    if scheduler.enabled():
+        client.dispatch()
+
+
+@celery_app.task
+def extract_inputs(job):
+    '''
+    Extracts the data needed to run a job, and stores it in the cache for run_model
+
+    :param job: The parameters of the job (see client.submit_job)
+    '''
+    log.debug('Calling task')
+    try:
+        # Update the database to indicate the job is running
+        db.set_job_running(job['db_key'], job['job_id'])
+        if job['submitted_time'] is not None:
+            metrics.observe('tamsat_alert_queue_wait_seconds', job['metric'],
+                            time.time() - job['submitted_time'])
+
+        # Extract a DataFrame containing the forecast driving data
         log.debug('Extracting necessary data')
-        data = xd.extract_point_timeseries(config['Data']['tamsat_path'], lon, lat)
+        cache.put(_input_key(job, 'fc_data'),
+                  _extract_fc_data(job['fc_location'], job['fc_var']))
 
-        minlon, maxlon, minlat, maxlat = fc_location
-        # Depending on which driving variable we're using,
-        # we need to extract the data from a different place
-        if(fc_var == "temperature"):
-            fc_path = config['Data']['met_fc_temp_path']
-        else:
-            fc_path = config['Data']['tamsat_path']
-        fc_data = xd.extract_area_mean_timeseries(fc_path,
-                                                  minlon, maxlon,
-                                                  minlat, maxlat)
+        # Regions are extracted in run_model, since this is done per tile
+        if len(job['location']) == 2:
+            cache.put(_input_key(job, 'data'), _extract_point_data(job))
+    except Exception as e:
+        _fail_job(job, e)
+        raise e
 
-        location_name = util.location_to_str(lon, lat)
 
+@celery_app.task(bind=True)
+def run_model(self, job):
+    '''
+    Runs the TAMSAT ALERT code for a job, which writes its output to the output directory
+
+    :param job: The parameters of the job (see client.submit_job)
+    '''
+    try:
+        output_path = _output_path(job['job_id'])
+        fc_data = cache.get(_input_key(job, 'fc_data'))
+        if fc_data is None:
+            # The input has been evicted from the cache, so extract it again
+            fc_data = _extract_fc_data(job['fc_location'], job['fc_var'])
+
+        if len(job['location']) == 4:
+            # This is a region.  Small regions are run here, but large ones are
+            # split into tiles which are run as separate tasks
+            if job['metric'] != 'cumrain':
+                raise ValueError('Only the cumrain metric can be run over a region')
+            os.makedirs(output_path, exist_ok=True)
+            boxes = region.tiles(*job['location'])
+            if len(boxes) > 1:
+                log.debug('Running region as {} tiles'.format(len(boxes)))
+                tile_files = [os.path.join(output_path, 'tile{}.nc'.format(i))
+                              for i in range(len(boxes))]
+                # The rest of this job's chain runs after the tiles have been merged
+                return self.replace(chord([client.route_model_task(run_region_tile.si(job, box, tile_file), job)
+                                          for box, tile_file in zip(boxes, tile_files)],
+                                         merge_region_tiles.si(job, tile_files)))
+
+            log.debug('Data extracted, running TAMSAT ALERT region code')
+            _run_region(job, job['location'], fc_data,
+                        os.path.join(output_path, _REGION_OUTPUT_FILE))
+            return
+
+        data = cache.get(_input_key(job, 'data'))
+        if data is None:
+            data = _extract_point_data(job)
+        location_name = util.location_to_str(*job['location'])
+
+        if job.get('quick'):
+            # This is a quick query which could not be run directly, so run it
+            # in the same way, but without the latency budget
+            log.debug('Data extracted, running quick query')
+            results = quick.compute_cumrain(job['location'], data, fc_data, job['fc_var'],
+                                            job['cast_date'],
+                                            job['poi_start_day'], job['poi_start_month'],
+                                            job['poi_end_day'], job['poi_end_month'],
+                                            job['fc_start_day'], job['fc_start_month'],
+                                            job['fc_end_day'], job['fc_end_month'],
+                                            job['stat_type'], job['tercile_weights'])
+            os.makedirs(output_path, exist_ok=True)
+            with open(os.path.join(output_path, quick.RESULTS_FILE), 'w') as f:
+                json.dump(results, f)
+            return
+
+        if job.get('cast_dates'):
+            # This is a hindcast, which is run for all forecast dates at once
+            if job['metric'] != 'cumrain':
+                raise ValueError('Hindcasts can only be run with the cumrain metric')
+            log.debug('Data extracted, running TAMSAT ALERT hindcast code')
+            os.makedirs(output_path, exist_ok=True)
+            hindcast.run_cumrain(data, fc_data, job['fc_var'], job['cast_dates'],
+                                 job['poi_start_day'], job['poi_start_month'],
+                                 job['poi_end_day'], job['poi_end_month'],
+                                 job['fc_start_day'], job['fc_start_month'],
+                                 job['fc_end_day'], job['fc_end_month'],
+                                 job['stat_type'], job['tercile_weights'],
+                                 output_path, location_name=location_name)
+            return
 
         # Run the job.  This will run the tamsat alert system,
-        # and write data to the output directory
-        if(metric == 'cumrain'):
+        # and write data to the output directory.  It is imported here, since it
+        # loads matplotlib, seaborn and statsmodels, which only the model runs need.
+        from tamsat_alert import tamsat_alert as ta_cr
+        from tamsat_alert import tamsat_alert_sm as ta_sm
+        if(job['metric'] == 'cumrain'):
             log.debug('Data extracted, running TAMSAT ALERT code')
             ta_cr.tamsat_alert(fc_data,
-                               fc_var,
+                               job['fc_var'],
                                data,
-                               cast_date,
+                               job['cast_date'],
                                'rfe',
                                output_path,
-                               poi_start_day, poi_start_month,
-                               poi_end_day, poi_end_month,
-                               fc_start_day, fc_start_month,
-                               fc_end_day, fc_end_month,
+                               job['poi_start_day'], job['poi_start_month'],
+                               job['poi_end_day'], job['poi_end_month'],
+                               job['fc_start_day'], job['fc_start_month'],
+                               job['fc_end_day'], job['fc_end_month'],
                                config['Data']['precip_str'],
                                config['Data']['temp_str'],
-                               tercile_weights,
+                               job['tercile_weights'],
                                int(config['Data']['climatology_start_year']),
                                int(config['Data']['climatology_end_year']),
                                int(config['Data']['period_of_interest_start_year']),
                                int(config['Data']['period_of_interest_end_year']),
-                               stat_type,
+                               job['stat_type'],
                                location_name=location_name)
-        elif(metric == 'soilmoisture'):
-            # For soil moisture, we need more variables for the point data
-            met_data = xd.extract_point_timeseries(config['Data']['met_fc_path'], lon, lat)
-            # The time range is not present in the NCEP data, so create it
-            temp_range_str = 'trange'
-            met_data[temp_range_str] = met_data['tmax']-met_data['tmin']
-            # This will merge the data into a single dataframe
-            data = data.merge(met_data, left_index=True, right_index=True)
-
+        elif(job['metric'] == 'soilmoisture'):
             log.debug('Data extracted, running TAMSAT ALERT soil moisture code')
             ta_sm.tamsat_alert_sm(data,
                                   fc_data,
-                                  fc_var,
-                                  cast_date,
-                                  soil_type,
+                                  job['fc_var'],
+                                  job['cast_date'],
+                                  job['soil_type'],
                                   output_path,
-                                  poi_start_day, poi_start_month,
-                                  poi_end_day, poi_end_month,
-                                  fc_start_day, fc_start_month,
-                                  fc_end_day, fc_end_month,
+                                  job['poi_start_day'], job['poi_start_month'],
+                                  job['poi_end_day'], job['poi_end_month'],
+                                  job['fc_start_day'], job['fc_start_month'],
+                                  job['fc_end_day'], job['fc_end_month'],
                                   int(config['Data']['sm_lead_time']),
-                                  tercile_weights,
+                                  job['tercile_weights'],
                                   int(config['Data']['climatology_start_year']),
                                   int(config['Data']['climatology_end_year']),
                                   int(config['Data']['period_of_interest_start_year']),
                                   int(config['Data']['period_of_interest_end_year']),
-                                  stat_type=='normal',
+                                  job['stat_type']=='normal',
                                   location_name=location_name,
                                   shortwave_radiation_str=config['Data']['sw_rad_str'],
                                   longwave_radiation_str=config['Data']['lw_rad_str'],
@@ -151,21 +388,115 @@ def tamsat_alert_run(location, fc_location, fc_var, cast_date, poi_start_day, po
                                   wind_u_comp_str=config['Data']['wind_u_comp_str'],
                                   wind_v_comp_str=config['Data']['wind_v_comp_str'],
                                   humidity_str=config['Data']['humidity_str'],
-                                  temperature_range_str=temp_range_str)
+                                  temperature_range_str=extraction.TEMP_RANGE_STR)
         else:
-            raise ValueError('Invalid metric supplied:'+metric)
+            raise ValueError('Invalid metric supplied:'+job['metric'])
+    except Ignore:
+        # The task has been replaced by the region tiles
+        raise
+    except Exception as e:
+        _fail_job(job, e)
+        raise e
+    finally:
+        # The inputs are no longer needed once the model has run
+        for name in ('fc_data', 'data'):
+            cache.remove(_input_key(job, name))
+
+
+@celery_app.task
+def run_region_tile(job, box, output_file):
+    '''
+    Runs the cumulative rainfall metric over a single tile of a region
+
+    :param job:         The parameters of the job (see client.submit_job)
+    :param box:         A tuple containing the (minLon, maxLon, minLat, maxLat)
+                        values of the tile
+    :param output_file: The NetCDF file to write
+    '''
+    try:
+        # The forecast data has already been extracted by extract_inputs, so will be cached
+        fc_data = _extract_fc_data(job['fc_location'], job['fc_var'])
+        _run_region(job, box, fc_data, output_file)
+    except Exception as e:
+        _fail_job(job, e)
+        raise e
+
+
+@celery_app.task
+def merge_region_tiles(job, tile_files):
+    '''
+    Merges the tiles of a region into a single output.
+    This runs once all tiles have completed successfully.
+
+    :param job:         The parameters of the job (see client.submit_job)
+    :param tile_files:  The NetCDF files written by each tile
+    '''
+    try:
+        output_path = _output_path(job['job_id'])
+        region.merge_tiles(tile_files, os.path.join(output_path, _REGION_OUTPUT_FILE))
+        for tile_file in tile_files:
+            os.remove(tile_file)
+    except Exception as e:
+        _fail_job(job, e)
+        raise e
+
+
+@celery_app.task
+def run_quick(job, budget_seconds):
+    '''
+    Runs a quick query directly for the web application, if it can be done within
+    a latency budget (see client.run_quick)
+
+    :param job:             A JobSpec containing the parameters of the query
+    :param budget_seconds:  The time allowed for the query, in seconds
+    :return:                A dict of the results (see quick.run_cumrain), or None
+                            if the query could not be run within the budget
+    '''
+    return quick.run_cumrain(job['location'], job['fc_location'], job['fc_var'],
+                             job['cast_date'],
+                             job['poi_start_day'], job['poi_start_month'],
+                             job['poi_end_day'], job['poi_end_month'],
+                             job['fc_start_day'], job['fc_start_month'],
+                             job['fc_end_day'], job['fc_end_month'],
+                             job['stat_type'], job['tercile_weights'], budget_seconds)
+
+
+@celery_app.task
+def package_output(job):
+    '''
+    Zips the output of a job, cleans up temporary files and updates the database.
+    Any identical jobs waiting for this one are also completed.
+
+    :param job: The parameters of the job (see client.submit_job)
+    '''
+    try:
+        job_id = job['job_id']
+        fingerprint = job['fingerprint']
+        output_path = _output_path(job_id)
 
         # Now go into output_dir and create a zip file containing everything.
+        # If this job can be reused, the zip file goes into the result store.
         log.debug('TAMSAT ALERT code finished.  Zipping output')
-        zipfile_name = util.get_zipfile_from_job_id(job_id)
-        zipf = zipfile.ZipFile(zipfile_name,
-                               'w', zipfile.ZIP_DEFLATED)
-        for root, dirs, files, in os.walk(output_path):
-            for file in files:
-                abs_file = os.path.join(root, file)
-                zipf.write(abs_file,
-                           arcname=os.path.relpath(abs_file, output_path))
-        zipf.close()
+        if fingerprint is not None:
+            zipfile_name = util.get_result_from_fingerprint(fingerprint)
+            os.makedirs(os.path.dirname(zipfile_name), exist_ok=True)
+        else:
+            zipfile_name = util.get_zipfile_from_job_id(job_id)
+        # Write to a temporary file first, since an existing result in the
+        # result store may be linked to other jobs
+        tmp_zipfile_name = zipfile_name + '.' + job_id + '.tmp'
+        with metrics.timer('tamsat_alert_stage_seconds', 'zip'):
+            _zip_output(output_path, tmp_zipfile_name)
+        profile_file = _profile_file(job_id)
+        if os.path.exists(profile_file):
+            with zipfile.ZipFile(tmp_zipfile_name, 'a', zipfile.ZIP_DEFLATED) as zipf:
+                zipf.write(profile_file, arcname=metrics.PROFILE_FILE)
+            os.remove(profile_file)
+        if fingerprint is not None:
+            # Link the job's zip file before the result is moved into the result
+            # store, so that the cleanup never sees the result without a link
+            util.link_file(tmp_zipfile_name, util.get_zipfile_from_job_id(job_id))
+        os.rename(tmp_zipfile_name, zipfile_name)
 
         # Remove the output directory, since all of the output is now contained in the zip
         try:
@@ -173,44 +504,296 @@ def tamsat_alert_run(location, fc_location, fc_var, cast_date, poi_start_day, po
         except OSError as e:
             log.error('Problem removing working directory: ' + output_path)
 
-        log.debug('Output completed, emailing user')
-        downloadLink = config['Tasks']['download_link'] + '?job_id=' + job_id
-        message = 'Your TAMSAT alert data is ready to download. ' + \
-                  'You can retrieve it by visiting ' + downloadLink + \
-                  '.  It will be available for ' + \
-                  config['Tasks']['days_to_keep_completed'] + \
-                  ' days, or ' + config['Tasks']['hours_to_keep_downloaded'] + \
-                  ' hours after you have downloaded it.'
+        # Update the database to indicate the job is completed, along with any
+        # identical jobs which were submitted while this one was running
+        waiting = []
+        with db.batch():
+            db.set_job_completed(job['db_key'])
+            if fingerprint is not None:
+                waiting = db.claim_waiters(fingerprint)
+                for waiting_db_key, waiting_job_id, waiting_email in waiting:
+                    util.link_result(fingerprint, waiting_job_id)
+                    db.set_job_completed(waiting_db_key)
+        for waiting_db_key, waiting_job_id, waiting_email in waiting:
+            notify_result_ready.delay(waiting_email, waiting_job_id)
+    except Exception as e:
+        _fail_job(job, e)
+        raise e
 
-        try:
-            util.send_email(email, 'TAMSAT alert data ready', message)
-        except Exception as e:
+    # The job's place in the scheduler is freed once its output is ready, rather
+    # than waiting for the email to be sent
+    try:
+        client.job_finished(job, True)
+    except Exception as e:
+        log.error('Problem dispatching jobs: ' + str(e))
+
+
+@celery_app.task
+def notify_user(job):
+    '''
+    Emails the user running a job to tell them that the output is ready
+
+    :param job: The parameters of the job (see client.submit_job)
+    '''
+    log.debug('Output completed, emailing user')
+    notify_result_ready(job['email'], job['job_id'])
+    log.debug('Task completed')
+
+
+@celery_app.task
+def notify_result_ready(email, job_id):
+    '''
+    Emails a user to tell them that the output of their job is ready to download.
+
+    The message is added to the outbox (see the outbox module), and sent by
+    send_outbox along with any other messages for the same user.
+
+    :param email:   The email address of the user
+    :param job_id:  The job ID
+    '''
+    try:
+        if outbox.add(email, 'TAMSAT alert data ready', util.result_ready_message(job_id)):
+            # Wait a while, so that messages from other jobs can be sent together
+            send_outbox.apply_async((email,), countdown=int(config['Email']['batch_seconds']))
+    except Exception as e:
+        # This is not critical, just log it
+        log.error('Problem sending email: ' + str(e))
+
+
+@celery_app.task(bind=True, rate_limit=config['Email']['rate_limit'] or None,
+                 max_retries=int(config['Email']['max_retries']))
+def send_outbox(self, email):
+    '''
+    Sends all messages in the outbox for a user as a single email.  If sending
+    fails, the messages are returned to the outbox and retried with an
+    exponential backoff.
+
+    :param email:   The email address of the user
+    '''
+    messages = outbox.take(email)
+    if not messages:
+        # Another task has already sent them
+        return
+    try:
+        with metrics.timer('tamsat_alert_stage_seconds', 'smtp'):
+            util.send_email(email, *outbox.combine(messages))
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
             # This is not critical, just log it
-            log.error('Problem sending email', e)
+            log.error('Giving up sending {} messages to {}: {}'.format(len(messages), email, e))
+            return
+        outbox.put_back(email, messages)
+        log.warning('Problem sending email, retrying: {}'.format(e))
+        raise self.retry(exc=e, countdown=int(config['Email']['retry_seconds']) * 2 ** self.request.retries)
+
 
-        # Update the database to indicate the job is completed
-        db.set_job_completed(db_key)
-        log.debug('Task completed')
+@celery_app.task
+def sweep_outbox():
+    '''
+    Sends any messages which have been waiting in the outbox for longer than they
+    should have, e.g. because the send_outbox task which was to send them was lost.
+
+    This gets run on a regular basis
+    '''
+    stale = outbox.stale(int(config['Email']['batch_seconds']) + _OUTBOX_GRACE_SECONDS)
+    for email in stale:
+        send_outbox.delay(email)
+    return len(stale)
+
+
+def _zip_output(output_path, zipfile_name):
+    '''
+    Writes the output of a job into a zip file.  Each file is streamed into the
+    archive, and the output is left in place, so that it is not lost if the zip
+    file cannot be written.  The caller removes it once the zip file is complete.
+
+    Files which are already compressed (e.g. plots) are stored as-is, rather than
+    spending time compressing them again for no benefit.
+
+    :param output_path:     The output directory of the job
+    :param zipfile_name:    The zip file to write
+    '''
+    with zipfile.ZipFile(zipfile_name, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for root, dirs, files, in os.walk(output_path):
+            for file in sorted(files):
+                abs_file = os.path.join(root, file)
+                if os.path.splitext(file)[1].lower() in _STORED_EXTENSIONS:
+                    compress_type = zipfile.ZIP_STORED
+                else:
+                    compress_type = zipfile.ZIP_DEFLATED
+                zipf.write(abs_file,
+                           arcname=os.path.relpath(abs_file, output_path),
+                           compress_type=compress_type)
+
+def _extract_fc_data(fc_location, fc_var):
+    '''
+    Extracts the area mean of the forecast driving data
+
+    :param fc_location: A tuple containing the (minLon, maxLon, minLat, maxLat)
+                        values of the bounding box over which to extract the data
+    :param fc_var:      Either "temperature" or "precipitation"
+    :return:            A pandas DataFrame
+    '''
+    minlon, maxlon, minlat, maxlat = fc_location
+    # Depending on which driving variable we're using,
+    # we need to extract the data from a different place
+    if(fc_var == "temperature"):
+        fc_path = config['Data']['met_fc_temp_path']
+    else:
+        fc_path = config['Data']['tamsat_path']
+    return extraction.extract_area_mean_timeseries(fc_path,
+                                                   minlon, maxlon,
+                                                   minlat, maxlat)
+
+def _extract_point_data(job):
+    '''
+    Extracts the data needed to run a job at a single location
+
+    :param job: The parameters of the job (see client.submit_job)
+    :return:    A pandas DataFrame
+    '''
+    lon, lat = job['location']
+    # Extract a DataFrame containing the data at the specified location
+    data = extraction.extract_point_timeseries(config['Data']['tamsat_path'], lon, lat)
+    if(job['metric'] == 'soilmoisture'):
+        # For soil moisture, we need more variables for the point data, but
+        # only from the start of the climatology and ensemble years.  These are
+        # aligned onto the times of the TAMSAT data before they are read, so
+        # they can be joined without a merge.
+        met_data = extraction.extract_point_drivers(config['Data']['met_fc_path'], lon, lat,
+                                                    _sm_variables(), region.first_day(),
+                                                    data.index)
+        data = data.loc[met_data.index].join(met_data)
+    return data
+
+def _sm_variables():
+    '''
+    :return: The NCEP variables needed by the soil moisture code.  Unless they are
+             listed in the sm_variables config value, these are the variables
+             which are passed to the soil moisture code by name.
+    '''
+    variables = [name.strip() for name in config['Data']['sm_variables'].split(',') if name.strip()]
+    return variables or [config['Data'][option] for option in _SM_VARIABLE_OPTIONS]
+
+def _run_region(job, box, fc_data, output_file):
+    '''
+    Runs the cumulative rainfall metric for a job over a bounding box
+    '''
+    region.run_cumrain(box, fc_data, job['fc_var'], job['cast_date'],
+                       job['poi_start_day'], job['poi_start_month'],
+                       job['poi_end_day'], job['poi_end_month'],
+                       job['fc_start_day'], job['fc_start_month'],
+                       job['fc_end_day'], job['fc_end_month'],
+                       job['stat_type'], job['tercile_weights'], output_file)
+
+def _fail_job(job, e):
+    '''
+    Records that a job has failed, along with any identical jobs waiting for it
+    '''
+    with db.batch():
+        db.set_error(job['job_id'], str(e))
+        if job['fingerprint'] is not None:
+            for waiting_db_key, waiting_job_id, waiting_email in db.claim_waiters(job['fingerprint']):
+                db.set_error(waiting_job_id, str(e))
+    try:
+        client.job_finished(job, False)
     except Exception as e:
-        db.set_error(job_id, str(e))
-        raise e
+        log.error('Problem dispatching jobs: ' + str(e))
 
 
 @celery_app.task
 def cleanup_files():
     '''
-    Removes expired jobs from both the database and the file system.
+    Removes expired jobs from both the database and the file system, and fails
+    jobs which have waited too long for an identical job.
 
     This gets run on a regular basis
     '''
     # Remove jobs from the database
     removed_jobs = db.remove_expired_jobs()
 
-    # Now remove the associated files
-    for job_id in removed_jobs:
-        try:
-            os.remove(util.get_zipfile_from_job_id(job_id))
-        except Exception as e:
-            log.error('Problem removing file with job id:' + job_id)
+    # Fail any jobs which have waited too long for an identical job, e.g. because
+    # it was lost, since they would otherwise wait forever
+    expired_before = dt.now() - timedelta(hours=int(config['Tasks']['waiter_expiry_hours']))
+    with db.batch():
+        for waiting_db_key, waiting_job_id, waiting_email in db.claim_expired_waiters(expired_before):
+            db.set_error(waiting_job_id, 'The identical job which this job was waiting for did not finish')
+
+    # Now remove the associated files, along with any others which don't
+    # belong to a job in the database (e.g. if a previous cleanup failed)
+    zipfiles = util.find_job_zipfiles(min_age_seconds=_ORPHAN_MIN_AGE)
+    existing = db.find_existing_job_ids(zipfiles.keys())
+    for job_id, zipfile_name in zipfiles.items():
+        if job_id not in existing:
+            try:
+                os.remove(zipfile_name)
+            except Exception as e:
+                log.error('Problem removing file with job id:' + job_id)
+
+    # Remove any stored results which no longer belong to a job
+    util.remove_unreferenced_results()
 
     return len(removed_jobs)
+
+
+@celery_app.task
+def update_file_manifest():
+    '''
+    Updates the manifest of the files in each dataset, and checks that their
+    lexical order matches their temporal order.
+
+    This gets run on a regular basis, and only opens new or modified files
+    '''
+    results = manifest.update_all()
+    for path, (n_changed, n_removed, out_of_order) in results.items():
+        log.info('{}: {} files added or updated, {} removed'.format(path, n_changed, n_removed))
+        for filename, next_filename in out_of_order:
+            log.error('Files out of order: {} is not before {}'.format(filename, next_filename))
+
+    return {path: (n_changed, n_removed) for path, (n_changed, n_removed, out_of_order)
+            in results.items()}
+
+
+@celery_app.task
+def build_timeseries_store():
+    '''
+    Builds or updates the time-series-optimised copy of the TAMSAT archive.
+
+    This gets run on a regular basis, and only appends new days to the store.  The
+    climatology store is built from this store, so it is updated afterwards
+    '''
+    appended = tsstore.build_all()
+    for store, n_days in appended.items():
+        log.info('Appended {} days to {}'.format(n_days, store))
+
+    build_climatology_store.delay()
+    return appended
+
+
+@celery_app.task
+def build_area_index():
+    '''
+    Builds or updates the summed-area table indexes used for area means.
+
+    This gets run on a regular basis, and only appends new days to the indexes
+    '''
+    appended = areaindex.build_all()
+    for store, n_days in appended.items():
+        log.info('Appended {} days to {}'.format(n_days, store))
+
+    return appended
+
+
+@celery_app.task
+def build_climatology_store():
+    '''
+    Builds or updates the precomputed climatologies of cumulative rainfall.
+
+    This gets run after each update of the time-series store, and only rebuilds
+    the climatologies of periods of interest which have been completed in another year, or have been newly requested
+    '''
+    built = climstore.build_all()
+    for window in built:
+        log.info('Built climatology for {:02d}-{:02d} to {:02d}-{:02d}'.format(*window))
+
+    return built
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+'''
+A "time-series-optimised" copy of the TAMSAT archive.
+
+The daily TAMSAT files each contain a single day over the whole domain, so reading
+the full history of a single pixel means opening every file in the archive.  This
+module transposes the archive into a Zarr store which is chunked so that each chunk
+holds a long run of days over a small block of pixels, meaning that a point
+extraction is a handful of sequential reads.
+
+The store is built offline (either with the build_timeseries_store Celery task, or
+by running this module as a script), and only appends days which are not already
+present.  Daily files which have arrived since the store was last built are read
+alongside it (see open_with_tail), so the store stays in use between builds.
+Readers only fall back to the daily files when there is no store, or when it is
+more than store_max_tail_days behind the archive.
+'''
+
+import os
+import os.path
+import fcntl
+import argparse
+import xarray as xr
+import zarr
+from config import config
+import cache
+import manifest
+
+_SOURCE_VERSION_ATTR = 'tamsat_alert_source_version'
+
+# The files containing days later than the end of each store, by store, along
+# with the version of the archive they were found in, so that they are only found
+# once for each version
+_tails = {}
+
+
+def _stores():
+    '''
+    :return: A dict mapping dataset glob expressions to their time-series store
+    '''
+    return {config['Data']['tamsat_path']: config['Data']['tamsat_store']}
+
+def select_box(ds, minlon, maxlon, minlat, maxlat):
+    '''
+    Selects a bounding box from a dataset, regardless of the direction of its axes
+    '''
+    return ds.sel(lon=(ds['lon'] >= minlon) & (ds['lon'] <= maxlon),
+                  lat=(ds['lat'] >= minlat) & (ds['lat'] <= maxlat))
+
+def open_store(path):
+    '''
+    Opens the time-series store for a dataset, along with any newer days from
+    the daily files (see open_with_tail)
+
+    :param path:    A glob expression defining the location of the data
+    :return:        An xarray Dataset, or None if there is no usable store for
+                    the given dataset
+    '''
+    store = _stores().get(path)
+    if not store:
+        return None
+    return open_with_tail(store, path)
+
+def open_with_tail(store, path, transform=None):
+    '''
+    Opens a store written by build_store.  Any days which have been added to its
+    source data since it was built are read from the daily files, and appended
+    to it (lazily), so the result covers the same days as the source data.
+
+    :param store:       The location of the Zarr store
+    :param path:        A glob expression defining the location of the source data
+    :param transform:   The transform which the store was built with (see build_store),
+                        which is applied to the newer days.  Optional
+    :return:            An xarray Dataset, or None if the store does not exist
+                        or is more than store_max_tail_days behind its source data
+    '''
+    if not os.path.exists(store):
+        return None
+    ds = xr.open_zarr(store)
+    version = cache.dataset_version(path)
+    if ds.attrs.get(_SOURCE_VERSION_ATTR) == version:
+        return ds
+
+    last_time = ds['time'].values[-1]
+    if _tails.get(store, (None,))[0] != version:
+        _tails[store] = (version, _new_files(path, last_time))
+    files = _tails[store][1]
+    if not files:
+        return ds
+    tail = xr.open_mfdataset(files, combine='by_coords')
+    tail = tail.sel(time=tail['time'] > last_time)
+    if tail.sizes['time'] > int(config['Data']['store_max_tail_days']):
+        tail.close()
+        ds.close()
+        return None
+    if tail.sizes['time'] == 0:
+        tail.close()
+        return ds
+    if transform is not None:
+        tail = transform(tail)
+
+    # Variables without a time axis (e.g. the axes of an area index) are taken from the store
+    combined = xr.concat([ds, tail], dim='time', data_vars='minimal',
+                         coords='minimal', compat='override')
+
+    def close():
+        ds.close()
+        tail.close()
+    combined.set_close(close)
+    return combined
+
+def extract_point_timeseries(ds, lon, lat):
+    '''
+    Extracts a timeseries of all variables at the grid cell nearest to a location
+
+    :param ds:  The store, as returned by open_store
+    :param lon: The longitude
+    :param lat: The latitude
+    :return:    A pandas DataFrame containing all variables present in the store
+    '''
+    return ds.sel(lon=lon, lat=lat, method='nearest') \
+        .reset_coords(drop=True).load().to_dataframe()
+
+def extract_area_mean_timeseries(ds, minlon, maxlon, minlat, maxlat):
+    '''
+    Extracts a timeseries of the spatial mean of all variables over a bounding box
+
+    :param ds:      The store, as returned by open_store
+    :param minlon:  The western edge of the bounding box
+    :param maxlon:  The eastern edge of the bounding box
+    :param minlat:  The southern edge of the bounding box
+    :param maxlat:  The northern edge of the bounding box
+    :return:        A pandas DataFrame containing all variables present in the store
+    '''
+    return select_box(ds, minlon, maxlon, minlat, maxlat) \
+        .mean(dim=['lon', 'lat']).load().to_dataframe()
+
+def _file_time(filename):
+    with xr.open_dataset(filename) as ds:
+        return ds['time'].values.max()
+
+def _new_files(path, last_time):
+    '''
+    Finds the files of a dataset which contain times later than last_time
+
+    Unless the file manifest is up to date (see the manifest module), this relies
+    on the lexical order of files matching their temporal order.
+    '''
+    files = manifest.find_files(path, start=last_time)
+    if files is None:
+        files = manifest.list_files(path)
+        # Work backwards to find the new files.  This only needs to open the new
+        # files (plus one).
+        first_new = len(files)
+        while first_new > 0 and _file_time(files[first_new-1]) > last_time:
+            first_new -= 1
+        files = files[first_new:]
+    return files
+
+def _time_chunks(n_existing, n_new, time_chunk):
+    '''
+    Splits new days into chunks which line up with the chunks already in a store
+    '''
+    chunks = []
+    first = min(n_new, time_chunk - n_existing % time_chunk)
+    if first:
+        chunks.append(first)
+    while sum(chunks) < n_new:
+        chunks.append(min(time_chunk, n_new - sum(chunks)))
+    return tuple(chunks)
+
+def build_store(path, store, transform=None, time_chunk=None, space_chunk=None):
+    '''
+    Builds or updates a time-series store from a daily archive.  Only days later
+    than the last day already in the store are appended.
+
+    Unless the file manifest is up to date (see the manifest module), this relies
+    on the lexical order of files matching their temporal order.
+
+    :param path:        A glob expression defining the location of the data
+    :param store:       The location of the Zarr store to write
+    :param transform:   A function applied to each block of days before it is written.
+                        It takes and returns an xarray Dataset, and must not change
+                        the time axis.  Optional, defaults to writing the data as-is
+    :param time_chunk:  The number of days in each chunk of the store.
+                        Optional, defaults to the store_time_chunk config value
+    :param space_chunk: The size of each chunk of the store along every other dimension.
+                        Optional, defaults to the store_space_chunk config value
+    :return:            The number of days which were appended to the store
+    '''
+    if time_chunk is None:
+        time_chunk = int(config['Data']['store_time_chunk'])
+    if space_chunk is None:
+        space_chunk = int(config['Data']['store_space_chunk'])
+
+    os.makedirs(os.path.dirname(os.path.abspath(store)), exist_ok=True)
+    with open(store + '.lock', 'w') as lock:
+        # Only one build can run at a time
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        version = cache.dataset_version(path)
+
+        n_existing = 0
+        last_time = None
+        if os.path.exists(store):
+            with xr.open_zarr(store) as existing:
+                last_time = existing['time'].values[-1]
+                n_existing = existing.sizes['time']
+
+        # Find the files which are not yet in the store
+        if last_time is None:
+            files = manifest.find_files(path) or manifest.list_files(path)
+        else:
+            files = _new_files(path, last_time)
+
+        n_appended = 0
+        # Read the files in blocks, to bound the size of the dask graph
+        while files:
+            block, files = files[:time_chunk], files[time_chunk:]
+
+            # Reading each day in bands of one chunk's height bounds the memory
+            # needed to assemble each output chunk
+            ds = xr.open_mfdataset(block, combine='by_coords',
+                                   chunks={'time': 1, 'lat': space_chunk})
+            if last_time is not None:
+                # Multi-day files may contain days which are already in the store
+                ds = ds.sel(time=ds['time'] > last_time)
+            if ds.sizes['time'] == 0:
+                ds.close()
+                continue
+            if transform is not None:
+                ds = transform(ds)
+
+            # Every chunk of new days in the store must be written by exactly
+            # one dask chunk
+            ds = ds.chunk(dict({dim: space_chunk for dim in ds.dims if dim != 'time'},
+                               time=_time_chunks(n_existing + n_appended,
+                                                 ds.sizes['time'], time_chunk)))
+            for var in ds.variables.values():
+                var.encoding.pop('chunks', None)
+
+            if n_existing + n_appended == 0:
+                ds.to_zarr(store, mode='w', encoding={
+                    name: {'chunks': tuple(time_chunk if dim == 'time' else space_chunk
+                                           for dim in var.dims)}
+                    for name, var in ds.data_vars.items()})
+            else:
+                ds.to_zarr(store, append_dim='time')
+            n_appended += ds.sizes['time']
+            last_time = ds['time'].values[-1]
+            ds.close()
+
+        # Record which version of the archive the store corresponds to
+        if os.path.exists(store):
+            zarr.open_group(store, mode='a').attrs[_SOURCE_VERSION_ATTR] = version
+            zarr.consolidate_metadata(store)
+
+    return n_appended
+
+def build_all():
+    '''
+    Builds or updates all configured time-series stores
+
+    :return:    A dict mapping each store to the number of days appended to it
+    '''
+    return {store: build_store(path, store) for path, store in _stores().items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build or update the time-series-optimised copy of the TAMSAT archive')
+    parser.parse_args()
+    for store, n_days in build_all().items():
+        print('Appended {} days to {}'.format(n_days, store))
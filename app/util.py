@@ -2,7 +2,10 @@
 Utility methods for the TAMSAT ALERT webapp
 '''
 
+import os
 import os.path
+import shutil
+import time
 import smtplib
 from config import config
 from email.mime.text import MIMEText
@@ -17,6 +20,98 @@ def get_zipfile_from_job_id(job_id):
     '''
     return os.path.join(config['Tasks']['workdir'], job_id+'.zip')
 
+def get_result_from_fingerprint(fingerprint):
+    '''
+    Gets the path of the zipfile in the result store for a particular set of job
+    parameters.  Job zipfiles are links to these, so that identical jobs can
+    share a single result.
+
+    :param fingerprint: The fingerprint of the job's parameters
+    :return:            The path, as a string, of the stored zip file
+    '''
+    return os.path.join(config['Tasks']['workdir'], 'results', fingerprint+'.zip')
+
+def link_result(fingerprint, job_id):
+    '''
+    Makes the stored result for a set of job parameters available as the
+    output of a job
+
+    :param fingerprint: The fingerprint of the job's parameters
+    :param job_id:      The job ID
+    '''
+    link_file(get_result_from_fingerprint(fingerprint), get_zipfile_from_job_id(job_id))
+
+def link_file(source, target):
+    '''
+    Makes a hard link to a file, or copies it if hard links are not supported.
+    Nothing is done if the target already exists.
+
+    :param source:  The path of the existing file
+    :param target:  The path of the new link
+    '''
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        # Hard links are not supported, so fall back to copying
+        shutil.copyfile(source, target)
+
+def remove_unreferenced_results():
+    '''
+    Removes results from the result store which are no longer linked to any job
+
+    :return:    The number of results removed
+    '''
+    results_dir = os.path.join(config['Tasks']['workdir'], 'results')
+    if not os.path.isdir(results_dir):
+        return 0
+
+    n_removed = 0
+    for entry in os.scandir(results_dir):
+        if entry.name.endswith('.zip') and entry.stat().st_nlink == 1:
+            os.remove(entry.path)
+            n_removed += 1
+    return n_removed
+
+def find_job_zipfiles(min_age_seconds=0):
+    '''
+    Finds the zipfiles of all jobs in the working directory, using a single
+    directory scan
+
+    :param min_age_seconds: Ignore files which were created (or linked) more recently
+                            than this, since they may belong to a job which is still
+                            being added to the database.  Optional, defaults to 0
+    :return:                A dict mapping job IDs to the paths of their zipfiles
+    '''
+    workdir = config['Tasks']['workdir']
+    if not os.path.isdir(workdir):
+        return {}
+
+    newest = time.time() - min_age_seconds
+    zipfiles = {}
+    for entry in os.scandir(workdir):
+        # Linking a file updates its ctime, so this is when it became a job's zipfile
+        if entry.name.endswith('.zip') and entry.is_file() and \
+                entry.stat().st_ctime <= newest:
+            zipfiles[entry.name[:-len('.zip')]] = entry.path
+    return zipfiles
+
+def result_ready_message(job_id):
+    '''
+    Gets the text of the email sent to users when their job has completed
+
+    :param job_id:  The job ID
+    :return:        The message
+    '''
+    downloadLink = config['Tasks']['download_link'] + '?job_id=' + job_id
+    return 'Your TAMSAT alert data is ready to download. ' + \
+           'You can retrieve it by visiting ' + downloadLink + \
+           '.  It will be available for ' + \
+           config['Tasks']['days_to_keep_completed'] + \
+           ' days, or ' + config['Tasks']['hours_to_keep_downloaded'] + \
+           ' hours after you have downloaded it.'
+
 def location_to_str(lon, lat):
     '''
     Converts a lon/lat position to a string
@@ -37,28 +132,77 @@ def location_to_str(lon, lat):
         location_name += '{0:.3f}°W'.format(-lon)
     return location_name
 
-def send_email(to, subject, message, ssl=True):
+def region_to_str(minlon, maxlon, minlat, maxlat):
+    '''
+    Converts a bounding box to a string
+
+    :param minlon:  The western edge of the bounding box
+    :param maxlon:  The eastern edge of the bounding box
+    :param minlat:  The southern edge of the bounding box
+    :param maxlat:  The northern edge of the bounding box
+    :return:        A formatted string
+    '''
+    return location_to_str(minlon, minlat) + ' to ' + location_to_str(maxlon, maxlat)
+
+# The SMTP connection of this process, which is kept open between messages
+_smtp = None
+
+def _smtp_connection():
+    '''
+    Gets an authenticated connection to the SMTP server, reusing the existing
+    connection if the server has not closed it
+    '''
+    global _smtp
+    if _smtp is not None:
+        try:
+            if _smtp.noop()[0] == 250:
+                return _smtp
+        except smtplib.SMTPException:
+            pass
+        close_smtp_connection()
+
+    server_settings = config['Email']
+    if server_settings.getboolean('ssl'):
+        s = smtplib.SMTP_SSL(server_settings['server'])
+    else:
+        s = smtplib.SMTP(server_settings['server'])
+    # Local debugging servers don't need authentication
+    if server_settings['username']:
+        s.login(server_settings['username'], server_settings['password'])
+    _smtp = s
+    return _smtp
+
+def close_smtp_connection():
+    '''
+    Closes the SMTP connection of this process, if there is one
+    '''
+    global _smtp
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        _smtp = None
+
+def send_email(to, subject, message):
     '''
-    Sends an email
+    Sends an email.  The connection to the SMTP server is kept open, so that
+    sending further emails from the same process doesn't need to log in again.
 
     :param to:              The email address to send to
     :param subject:         The subject of the message
     :param message:         The message
     '''
-    server_settings = config['Email']
-
     # Construct the message
     msg = MIMEText(message)
     msg['To'] = to
-    msg['From'] = server_settings['contact']
+    msg['From'] = config['Email']['contact']
     msg['Subject'] = subject
 
     # Send the message
-    if(ssl):
-        s = smtplib.SMTP_SSL(server_settings['server'])
-    else:
-        s = smtplib.SMTP(server_settings['server'])
-
-    s.login(server_settings['username'], server_settings['password'])
-    s.send_message(msg)
-    s.quit()
+    try:
+        _smtp_connection().send_message(msg)
+    except smtplib.SMTPServerDisconnected:
+        # The server closed the connection after we checked it, so try once more
+        close_smtp_connection()
+        _smtp_connection().send_message(msg)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+'''
+Checks the vectorised cumulative rainfall code (see app/ensemble.py) against a
+direct, point-by-point implementation of the TAMSAT ALERT method, on fixed
+synthetic inputs.
+
+Point jobs run the TAMSAT ALERT code itself, whereas region jobs, hindcasts and
+quick queries run the ensemble module, so the two must give the same results.
+The reference here follows the TAMSAT ALERT code: each ensemble member, weight
+and climatological total is calculated separately, by slicing a pandas Series of
+the rainfall at a single point, and the tercile probabilities are calculated
+from them with scipy.stats.
+
+Every forecast date is checked with both probability distributions, for each of
+the ways the ensemble module is used: a single forecast date (region jobs and
+quick queries), a single forecast date with precomputed season totals (the
+climatology store), and many forecast dates together (hindcasts).
+
+Exits with a non-zero status if any result differs from the reference.
+'''
+
+import os
+import os.path
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+_APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, _APP_DIR)
+
+import ensemble
+
+# The period of interest and forecast period, as (start day, start month, end day, end month)
+_POI = (1, 10, 31, 1)
+_FC_PERIOD = (1, 10, 31, 12)
+_TERCILE_WEIGHTS = (0.2, 0.3, 0.5)
+_STAT_TYPES = ('normal', 'ecdf')
+# The probabilities and summary statistics which are compared
+_RESULT_NAMES = ('prob_lower', 'prob_middle', 'prob_upper', 'ensemble_mean', 'ensemble_std')
+
+
+def _inputs(start_year, end_year, n_points, seed):
+    '''
+    Generates daily rainfall at a number of points, and a forecast driving variable
+
+    :return:    A tuple of (pandas DatetimeIndex, rainfall array with dimensions
+                (time, point), pandas Series of the forecast driving variable)
+    '''
+    rng = np.random.RandomState(seed)
+    times = pd.date_range('{}-01-01'.format(start_year), '{}-12-31'.format(end_year))
+    # Mostly dry days, with some heavy rain
+    rainfall = np.where(rng.random_sample((len(times), n_points)) < 0.6, 0.0,
+                        rng.gamma(0.8, 12.0, (len(times), n_points)))
+    fc_series = pd.Series(rng.normal(0, 1, len(times)), index=times)
+    return times, rainfall, fc_series
+
+def _reference(series, fc_series, cast_date, clim_years, ensemble_years, stat_type):
+    '''
+    Runs the cumulative rainfall metric at a single point, one year at a time
+
+    :return:    A dict of the values in _RESULT_NAMES
+    '''
+    season_start, season_end = ensemble.first_season_ending_after(cast_date, *_POI)
+    days_observed = max(0, (cast_date - season_start).days)
+    observed = series[season_start:cast_date - pd.Timedelta(days=1)].sum()
+
+    def complete(year):
+        return ensemble.season_bounds(year, *_POI)[1] <= series.index[-1]
+
+    years = [year for year in ensemble_years if year != season_start.year and complete(year)]
+    members = []
+    fc_means = []
+    for year in years:
+        start, end = ensemble.season_bounds(year, *_POI)
+        members.append(observed + series[start + pd.Timedelta(days=days_observed):end].sum())
+        fc_start, fc_end = ensemble.first_season_ending_after(start, *_FC_PERIOD)
+        fc_means.append(fc_series[fc_start:fc_end].mean())
+    members = np.array(members)
+    climatology = np.array([series[slice(*ensemble.season_bounds(year, *_POI))].sum()
+                            for year in clim_years if complete(year)])
+
+    # Each tercile of the forecast driving variable shares its weight between its years
+    t1, t2 = np.percentile(fc_means, [100.0 / 3, 200.0 / 3])
+    terciles = [0 if value <= t1 else 2 if value > t2 else 1 for value in fc_means]
+    weights = np.array([_TERCILE_WEIGHTS[tercile] / terciles.count(tercile) for tercile in terciles])
+    weights /= weights.sum()
+
+    ensemble_mean = np.average(members, weights=weights)
+    ensemble_std = np.sqrt(np.average((members - ensemble_mean) ** 2, weights=weights))
+    if stat_type == 'normal':
+        clim_dist = stats.norm(climatology.mean(), climatology.std(ddof=1))
+        clim_lower, clim_upper = clim_dist.ppf(1.0 / 3), clim_dist.ppf(2.0 / 3)
+        prob_lower = stats.norm.cdf(clim_lower, ensemble_mean, ensemble_std)
+        prob_upper = stats.norm.sf(clim_upper, ensemble_mean, ensemble_std)
+    else:
+        clim_lower, clim_upper = np.percentile(climatology, [100.0 / 3, 200.0 / 3])
+        prob_lower = weights[members <= clim_lower].sum()
+        prob_upper = weights[members > clim_upper].sum()
+    return {
+        'prob_lower': prob_lower,
+        'prob_middle': 1 - prob_lower - prob_upper,
+        'prob_upper': prob_upper,
+        'ensemble_mean': ensemble_mean,
+        'ensemble_std': ensemble_std
+    }
+
+def _season_totals(times, rainfall, years):
+    '''
+    :return: The total rainfall over the period of interest in each complete year,
+             as the climatology store holds them
+    '''
+    series = pd.DataFrame(rainfall, index=times)
+    return {year: series[slice(*ensemble.season_bounds(year, *_POI))].sum().values
+            for year in years if ensemble.season_bounds(year, *_POI)[1] <= times[-1]}
+
+def _compare(name, results, reference, tolerance):
+    '''
+    Compares the results for every point with the reference
+
+    :return:    The number of values which differ
+    '''
+    n_failed = 0
+    for result_name in _RESULT_NAMES:
+        expected = np.array([point[result_name] for point in reference])
+        actual = np.asarray(results[result_name])
+        # The normal distribution's terciles are only given to 4 significant figures
+        rtol = 1e-3 if result_name.startswith('prob') and name.endswith('normal') else tolerance
+        if not np.allclose(actual, expected, rtol=rtol, atol=rtol):
+            n_failed += 1
+            print('{}: {} differs by up to {:.3g}'.format(
+                name, result_name, np.abs(actual - expected).max()))
+    return n_failed
+
+def check(start_year, end_year, n_points, seed, tolerance):
+    '''
+    Checks every way the ensemble module is used against the reference
+
+    :return:    The number of values which differ from the reference
+    '''
+    times, rainfall, fc_series = _inputs(start_year, end_year, n_points, seed)
+    years = list(range(start_year, end_year + 1))
+    clim_years = years[:-1]
+    cast_dates = [pd.Timestamp(end_year - 1, month, day)
+                  for month, day in ((9, 15), (10, 1), (10, 20), (12, 5), (1, 31))]
+    cast_dates[-1] = cast_dates[-1].replace(year=end_year)
+    season_totals = _season_totals(times, rainfall, years)
+
+    n_failed = 0
+    for stat_type in _STAT_TYPES:
+        hindcast = ensemble.cumrain_hindcast(times, rainfall, fc_series, cast_dates,
+                                             *(_POI + _FC_PERIOD + (_TERCILE_WEIGHTS,
+                                                                    clim_years, years)))
+        for i, cast_date in enumerate(cast_dates):
+            reference = [_reference(pd.Series(rainfall[:, point], index=times), fc_series,
+                                    cast_date, clim_years, years, stat_type)
+                         for point in range(n_points)]
+            for name, totals in (('single date', None), ('season totals', season_totals)):
+                members = ensemble.cumrain_ensemble(times, rainfall, fc_series, cast_date,
+                                                    *(_POI + _FC_PERIOD + (_TERCILE_WEIGHTS,
+                                                                           clim_years, years,
+                                                                           totals)))
+                results = ensemble.tercile_probabilities(members['members'], members['weights'],
+                                                         members['climatology'], stat_type)
+                n_failed += _compare('{} {} {}'.format(name, cast_date.date(), stat_type),
+                                     results, reference, tolerance)
+            results = ensemble.tercile_probabilities(hindcast['members'][:, i],
+                                                     hindcast['weights'][:, i],
+                                                     hindcast['climatology'], stat_type)
+            n_failed += _compare('hindcast {} {}'.format(cast_date.date(), stat_type),
+                                 results, reference, tolerance)
+    return n_failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check the vectorised cumulative rainfall code against a point-by-point reference')
+    parser.add_argument('--start-year', type=int, default=1990, help='The first year of the data')
+    parser.add_argument('--end-year', type=int, default=2004, help='The last year of the data')
+    parser.add_argument('--points', type=int, default=20, help='The number of points to check')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random data')
+    parser.add_argument('--tolerance', type=float, default=1e-9,
+                        help='The relative tolerance of the comparison')
+    args = parser.parse_args()
+
+    n_failed = check(args.start_year, args.end_year, args.points, args.seed, args.tolerance)
+    if n_failed:
+        print('{} checks failed'.format(n_failed))
+        sys.exit(1)
+    print('All checks passed')
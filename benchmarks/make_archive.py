@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+'''
+Generates a synthetic archive of daily TAMSAT rainfall and NCEP forecast driving
+data, laid out in the same way as the real archive, for use by the benchmarks.
+
+The TAMSAT data is written as one file per day, in <root>/v3/daily/<year>/<month>,
+and the NCEP data as one file per variable per year, in <root>/NCEP_data/<year>.
+The NCEP variables are named according to the *_str values in the [Data] section
+of the config, so that the soil moisture code can run on them.
+'''
+
+import os
+import os.path
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# The resolution of the NCEP data, in degrees
+NCEP_RESOLUTION = 1.875
+
+
+def tamsat_glob(root):
+    '''
+    :return: The glob expression of the TAMSAT data in an archive, for the tamsat_path config value
+    '''
+    return os.path.join(root, 'v3', 'daily', '**', '**', '*.nc')
+
+def ncep_glob(root, variable='*'):
+    '''
+    :return: The glob expression of the NCEP data in an archive, for the
+             met_fc_path and met_fc_temp_path config values
+    '''
+    return os.path.join(root, 'NCEP_data', '**', variable + '.2m.*.nc')
+
+def ncep_variables(data_config):
+    '''
+    Gets the names and typical values of the NCEP variables used by the soil moisture code
+
+    :param data_config: The [Data] section of the config
+    :return:            A dict mapping each variable name to its typical value
+    '''
+    return {
+        data_config['temp_str']: 295.0,
+        'tmax': 300.0,
+        'tmin': 288.0,
+        data_config['sw_rad_str']: 250.0,
+        data_config['lw_rad_str']: 350.0,
+        data_config['pr_str']: 3e-5,
+        data_config['pressure_str']: 9e4,
+        data_config['wind_u_comp_str']: 2.0,
+        data_config['wind_v_comp_str']: 1.0,
+        data_config['humidity_str']: 0.01
+    }
+
+def generate(root, data_config, start_year, end_year, resolution,
+             minlon, maxlon, minlat, maxlat, seed=0):
+    '''
+    Generates a synthetic archive.  Existing files are overwritten.
+
+    :param root:            The directory to write the archive to
+    :param data_config:     The [Data] section of the config, defining the variable names
+    :param start_year:      The first year of data
+    :param end_year:        The last year of data
+    :param resolution:      The resolution of the TAMSAT data, in degrees
+    :param minlon, maxlon, minlat, maxlat:  The extent of the data
+    :param seed:            The seed of the random data.  Optional, defaults to 0
+    :return:                A tuple of (number of TAMSAT files, number of NCEP files) written
+    '''
+    rng = np.random.RandomState(seed)
+
+    lons = np.arange(minlon, maxlon, resolution) + resolution / 2
+    lats = np.arange(minlat, maxlat, resolution) + resolution / 2
+    days = pd.date_range('{}-01-01'.format(start_year), '{}-12-31'.format(end_year))
+    for day in days:
+        path = os.path.join(root, 'v3', 'daily', str(day.year), '{:02d}'.format(day.month))
+        os.makedirs(path, exist_ok=True)
+        # Mostly dry days, with occasional heavy rain
+        rfe = rng.gamma(0.5, 4.0, (1, len(lats), len(lons))).astype('float32')
+        ds = xr.Dataset({data_config['precip_str']: (('time', 'lat', 'lon'), rfe)},
+                        coords={'time': [day], 'lat': lats, 'lon': lons})
+        ds.to_netcdf(os.path.join(path, day.strftime('rfe%Y_%m_%d.v3.nc')))
+
+    # The NCEP grid is coarser, covers the TAMSAT grid, and has descending latitudes
+    ncep_lons = np.arange(minlon - NCEP_RESOLUTION, maxlon + NCEP_RESOLUTION, NCEP_RESOLUTION)
+    ncep_lats = np.arange(maxlat + NCEP_RESOLUTION, minlat - NCEP_RESOLUTION, -NCEP_RESOLUTION)
+    n_ncep_files = 0
+    for year in range(start_year, end_year + 1):
+        path = os.path.join(root, 'NCEP_data', str(year))
+        os.makedirs(path, exist_ok=True)
+        year_days = pd.date_range('{}-01-01'.format(year), '{}-12-31'.format(year))
+        shape = (len(year_days), len(ncep_lats), len(ncep_lons))
+        for variable, typical in ncep_variables(data_config).items():
+            values = (typical * (1 + 0.05 * rng.standard_normal(shape))).astype('float32')
+            ds = xr.Dataset({variable: (('time', 'lat', 'lon'), values)},
+                            coords={'time': year_days, 'lat': ncep_lats, 'lon': ncep_lons})
+            ds.to_netcdf(os.path.join(path, '{}.2m.{}.nc'.format(variable, year)))
+            n_ncep_files += 1
+    return len(days), n_ncep_files
+
+
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+    from config import config
+
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic archive of TAMSAT and NCEP data')
+    parser.add_argument('root', help='The directory to write the archive to')
+    parser.add_argument('--start-year', type=int, default=2000, help='The first year of data')
+    parser.add_argument('--end-year', type=int, default=2004, help='The last year of data')
+    parser.add_argument('--resolution', type=float, default=0.0375,
+                        help='The resolution of the TAMSAT data, in degrees')
+    parser.add_argument('--extent', type=float, nargs=4, default=[30.0, 32.0, -2.0, 0.0],
+                        metavar=('MINLON', 'MAXLON', 'MINLAT', 'MAXLAT'),
+                        help='The extent of the data')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random data')
+    args = parser.parse_args()
+    n_tamsat, n_ncep = generate(args.root, config['Data'], args.start_year, args.end_year,
+                                args.resolution, *args.extent, seed=args.seed)
+    print('Wrote {} TAMSAT files and {} NCEP files to {}'.format(n_tamsat, n_ncep, args.root))
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of the main paths through the application, run offline against a
+synthetic archive (see make_archive).
+
+Celery runs in eager mode, so that each job runs in this process, and Redis is
+replaced by fakeredis (which must be installed with Lua support, e.g. with
+pip install fakeredis[lua], since the scheduler uses Redis locks).
+Emails are not sent.  All state (the job database, cache, stores and results) is
+kept in a temporary working directory, configured through a config file named
+by the TAMSAT_ALERT_CONFIG environment variable.
+
+The results are written as JSON, so that they can be compared between revisions.
+'''
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import configparser
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+
+import make_archive
+
+_APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+# The application modules are imported once the config file has been written
+sys.path.insert(0, _APP_DIR)
+
+# The scientific libraries which the web application should not need to load
+_HEAVY_MODULES = ('xarray', 'dask', 'matplotlib', 'scipy', 'seaborn', 'statsmodels', 'tamsat_alert')
+
+# Run in a new process to measure the startup of each process type
+_STARTUP_SCRIPT = '''
+import sys, time, json, resource
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    'seconds': seconds,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    'heavy_modules': sorted(name for name in {heavy_modules!r} if name in sys.modules)
+}}))
+'''
+
+
+def _write_config(workdir, archive, start_year, end_year):
+    '''
+    Writes the config file used by the benchmarks, and points TAMSAT_ALERT_CONFIG at it
+    '''
+    bench_config = configparser.ConfigParser()
+    bench_config['Tasks'] = {
+        'workdir': os.path.join(workdir, 'work'),
+        'dbfile': os.path.join(workdir, 'work', 'ta-jobs.sqlite3'),
+        'job_store': 'sqlite'
+    }
+    bench_config['Data'] = {
+        'tamsat_path': make_archive.tamsat_glob(archive),
+        'met_fc_path': make_archive.ncep_glob(archive),
+        'met_fc_temp_path': make_archive.ncep_glob(archive, 'air'),
+        'climatology_start_year': str(start_year),
+        'climatology_end_year': str(end_year - 1),
+        'period_of_interest_start_year': str(start_year),
+        'period_of_interest_end_year': str(end_year - 1),
+        'tamsat_store': os.path.join(workdir, 'stores', 'tamsat-ts.zarr'),
+        'tamsat_area_index': os.path.join(workdir, 'stores', 'tamsat-area-index.zarr'),
+        'met_fc_temp_area_index': os.path.join(workdir, 'stores', 'air-area-index.zarr'),
+        'climatology_store': os.path.join(workdir, 'stores', 'climatology'),
+        'manifest_file': os.path.join(workdir, 'stores', 'manifest.sqlite3')
+    }
+    bench_config['Cache'] = {'path': os.path.join(workdir, 'cache')}
+    bench_config['Celery'] = {'backend': 'cache+memory://', 'broker': 'redis://localhost'}
+    os.makedirs(bench_config['Tasks']['workdir'], exist_ok=True)
+    config_file = os.path.join(workdir, 'benchmark.cfg')
+    with open(config_file, 'w') as f:
+        bench_config.write(f)
+    os.environ['TAMSAT_ALERT_CONFIG'] = config_file
+
+def _setup_app():
+    '''
+    Imports the application, with Celery in eager mode and Redis replaced by fakeredis
+    '''
+    import redis
+    import fakeredis
+    server = fakeredis.FakeServer()
+    redis.Redis.from_url = staticmethod(
+        lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+
+    import util
+    import tasks
+    util.send_email = lambda to, subject, message: None
+    tasks.celery_app.conf.update(task_always_eager=True, task_eager_propagates=True)
+
+def _clear_cache():
+    from config import config
+    import datasets
+    shutil.rmtree(config['Cache']['path'], ignore_errors=True)
+    datasets.close_all()
+
+def _measure(function, repeats, setup=None):
+    '''
+    Times a function
+
+    :param function:    The function to time, which is passed the repeat number
+    :param repeats:     The number of times to run it
+    :param setup:       A function to run (untimed) before each repeat.  Optional
+    :return:            A dict of the times taken, in seconds
+    '''
+    times = []
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function(i)
+        times.append(time.perf_counter() - start)
+    return {
+        'seconds': times,
+        'min': min(times),
+        'median': float(np.median(times)),
+        'mean': float(np.mean(times))
+    }
+
+def _startup(module, repeats):
+    '''
+    Measures the startup of a process which imports one of the application's
+    modules, e.g. 'main' for the web application or 'tasks' for a Celery worker
+
+    :param module:  The name of the module
+    :param repeats: The number of times to start the process
+    :return:        A dict of the times taken to import the module, in seconds,
+                    the peak memory use of the process, in MiB, and the scientific
+                    libraries which were loaded
+    '''
+    script = _STARTUP_SCRIPT.format(module=module, heavy_modules=_HEAVY_MODULES)
+    runs = []
+    for i in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=_APP_DIR)
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    times = [run['seconds'] for run in runs]
+    return {
+        'seconds': times,
+        'min': min(times),
+        'median': float(np.median(times)),
+        'max_rss_mb': max(run['max_rss_mb'] for run in runs),
+        'heavy_modules': runs[-1]['heavy_modules']
+    }
+
+def _job(location, metric, soil_type):
+    '''
+    :return: The parameters of a job, as passed to client.submit_job
+    '''
+    import uuid
+    import database as db
+    import jobspec
+    from config import config
+    job_id = str(uuid.uuid4())
+    lon, lat = location
+    job = jobspec.JobSpec(
+        job_id=job_id,
+        db_key=db.add_job('benchmark', 'Benchmark job', None, job_id),
+        email='benchmark@example.com',
+        userhash='benchmark',
+        location=location,
+        fc_location=(lon - 1, lon + 1, lat - 1, lat + 1),
+        fc_var='precipitation',
+        metric=metric,
+        cast_date=pd.Timestamp(int(config['Data']['climatology_end_year']) + 1, 3, 1),
+        poi_start_day=1, poi_start_month=2, poi_end_day=30, poi_end_month=4,
+        fc_start_day=1, fc_start_month=2, fc_end_day=30, fc_end_month=4,
+        stat_type='normal',
+        tercile_weights=(1/3, 1/3, 1/3),
+        soil_type=soil_type)
+    job.validate()
+    return job
+
+def _payload(body, serializer, repeats, iterations=1000):
+    '''
+    Measures the size of the body of a task message, and the time taken to encode
+    and decode it, as Celery does
+
+    :param body:        The body, i.e. a tuple of (args, kwargs, embed)
+    :param serializer:  The name of the serializer
+    :param repeats:     The number of times to time the encoding and decoding
+    :param iterations:  The number of times to encode or decode the body in each repeat
+    :return:            A dict of the size in bytes, and the median times to encode
+                        and decode the body, in seconds
+    '''
+    from kombu.serialization import dumps, loads
+    content_type, encoding, data = dumps(body, serializer=serializer)
+    encode = _measure(lambda i: [dumps(body, serializer=serializer) for j in range(iterations)], repeats)
+    decode = _measure(lambda i: [loads(data, content_type, encoding, accept=[content_type])
+                                 for j in range(iterations)], repeats)
+    return {
+        'bytes': len(data),
+        'encode_seconds': encode['median'] / iterations,
+        'decode_seconds': decode['median'] / iterations
+    }
+
+def _form(location, cast_date, ref):
+    '''
+    :return: The form parameters of a point job, as posted to /api/tamsatAlertTask
+    '''
+    lon, lat = location
+    return {
+        'locationType': 'point', 'lon': lon, 'lat': lat,
+        'initDate': cast_date.strftime('%Y-%m-%d'),
+        'poiStartDay': 1, 'poiStartMonth': 2, 'poiEndDay': 30, 'poiEndMonth': 4,
+        'fcVar': 'precipitation',
+        'fcLonMin': lon - 1, 'fcLonMax': lon + 1, 'fcLatMin': lat - 1, 'fcLatMax': lat + 1,
+        'fcStartDay': 1, 'fcStartMonth': 2, 'fcEndDay': 30, 'fcEndMonth': 4,
+        'metric': 'cumRain',
+        'tercileLow': 0.333, 'tercileMid': 0.333, 'tercileHigh': 0.334,
+        'stat': 'normal',
+        'email': 'benchmark@example.com',
+        'ref': ref
+    }
+
+def _write_output(output_path, n_files, file_mb):
+    '''
+    Writes a directory of text output, similar to that of a job, for zipping
+    '''
+    os.makedirs(output_path, exist_ok=True)
+    rng = np.random.RandomState(0)
+    for i in range(n_files):
+        values = rng.gamma(0.5, 4.0, int(file_mb * 1024 * 1024 / 8))
+        np.savetxt(os.path.join(output_path, 'output{}.txt'.format(i)), values, fmt='%.4f')
+
+def _db_writes(n_writers, jobs_per_writer):
+    '''
+    Adds jobs and updates their status from a number of concurrent threads
+
+    :return: The number of job store operations made
+    '''
+    import database as db
+    # Exceptions are not raised from threads, so they are raised once all have finished
+    errors = []
+
+    def write(writer):
+        try:
+            for i in range(jobs_per_writer):
+                job_id = 'bench-{}-{}-{}'.format(time.time(), writer, i)
+                db_key = db.add_job('benchmark-db', 'Benchmark job', None, job_id)
+                db.set_job_running(db_key, job_id)
+                db.set_job_completed(db_key)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(n_writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return n_writers * jobs_per_writer * 3
+
+def run(repeats, n_writers, jobs_per_writer, soil_type, extent, seed):
+    '''
+    Runs all benchmarks.  Any benchmark which fails stops the run, so that
+    failures are not mistaken for results.
+
+    :return: A dict mapping the name of each benchmark to its results
+    '''
+    from config import config
+    import extraction
+    import client
+    import jobspec
+    import tasks
+    import tsstore
+    import areaindex
+    import main
+
+    rng = np.random.RandomState(seed)
+    minlon, maxlon, minlat, maxlat = extent
+
+    def random_point(i):
+        return (float(rng.uniform(minlon + 0.1, maxlon - 0.1)),
+                float(rng.uniform(minlat + 0.1, maxlat - 0.1)))
+
+    def random_box(i):
+        lon, lat = random_point(i)
+        return lon - 1, lon + 1, lat - 1, lat + 1
+
+    tamsat_path = config['Data']['tamsat_path']
+    test_client = main.app.test_client()
+    cast_date = pd.Timestamp(int(config['Data']['climatology_end_year']) + 1, 3, 1)
+    output_path = os.path.join(config['Tasks']['workdir'], 'zip-benchmark')
+
+    benchmarks = [
+        ('point_extraction_daily_files',
+         lambda i: extraction.extract_point_timeseries(tamsat_path, *random_point(i)),
+         _clear_cache),
+        ('area_mean_extraction_daily_files',
+         lambda i: extraction.extract_area_mean_timeseries(config['Data']['met_fc_temp_path'],
+                                                           *random_box(i)),
+         _clear_cache),
+        ('build_stores', lambda i: (tsstore.build_all(), areaindex.build_all()), None),
+        ('point_extraction_store',
+         lambda i: extraction.extract_point_timeseries(tamsat_path, *random_point(i)),
+         _clear_cache),
+        ('cumrain_job', lambda i: client.submit_job(_job(random_point(i), 'cumrain', None)), None),
+        ('soilmoisture_job', lambda i: client.submit_job(_job(random_point(i), 'soilmoisture', soil_type)), None),
+        ('zip_output', lambda i: tasks._zip_output(output_path, output_path + '.zip'),
+         lambda: _write_output(output_path, 10, 1.0)),
+        ('api_submit_point_job', lambda i: test_client.post('/api/tamsatAlertTask',
+                                                           data=_form(random_point(i), cast_date, 'submit')), None),
+        ('api_jobs', lambda i: test_client.get('/api/jobs', query_string={
+            'email': 'benchmark@example.com', 'ref': 'submit'}), None)
+    ]
+
+    results = {}
+    # The startup of the web application and of a Celery worker
+    for module in ('main', 'tasks'):
+        name = 'startup_' + module
+        print('Running ' + name)
+        results[name] = _startup(module, repeats)
+
+    # The task messages of a job, and of a batch (as sent to prefetch_inputs),
+    # encoded as JobSpecs, and pickled as the dicts which jobs used to be
+    payload_jobs = [_job(random_point(i), 'cumrain', None) for i in range(100)]
+    payload_dicts = [dict((name, job[name]) for name in jobspec.FIELDS) for job in payload_jobs]
+    payloads = [
+        ('payload_job_pickle', ((payload_dicts[0],), {}, {}), 'pickle'),
+        ('payload_job_jobspec', ((payload_jobs[0],), {}, {}), jobspec.SERIALIZER),
+        ('payload_batch_pickle', ((payload_dicts,), {}, {}), 'pickle'),
+        ('payload_batch_jobspec', ((payload_jobs,), {}, {}), jobspec.SERIALIZER)
+    ]
+    for name, body, serializer in payloads:
+        print('Running ' + name)
+        results[name] = _payload(body, serializer, repeats)
+
+    for name, function, setup in benchmarks:
+        print('Running ' + name)
+        results[name] = _measure(function, 1 if name == 'build_stores' else repeats, setup)
+
+    print('Running db_concurrent_writes')
+    start = time.perf_counter()
+    n_operations = _db_writes(n_writers, jobs_per_writer)
+    seconds = time.perf_counter() - start
+    results['db_concurrent_writes'] = {
+        'writers': n_writers,
+        'operations': n_operations,
+        'seconds': seconds,
+        'operations_per_second': n_operations / seconds
+    }
+    return results
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=_APP_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the TAMSAT ALERT webapp benchmarks')
+    parser.add_argument('--archive', help='The directory of the synthetic archive.  '
+                        'It is generated if it does not exist.  Defaults to a temporary directory')
+    parser.add_argument('--output', default='benchmark-results.json',
+                        help='The JSON file to write the results to')
+    parser.add_argument('--repeats', type=int, default=5, help='The number of times to run each benchmark')
+    parser.add_argument('--start-year', type=int, default=2000, help='The first year of the archive')
+    parser.add_argument('--end-year', type=int, default=2004, help='The last year of the archive')
+    parser.add_argument('--resolution', type=float, default=0.0375,
+                        help='The resolution of the TAMSAT data in the archive, in degrees')
+    parser.add_argument('--extent', type=float, nargs=4, default=[30.0, 32.0, -2.0, 0.0],
+                        metavar=('MINLON', 'MAXLON', 'MINLAT', 'MAXLAT'),
+                        help='The extent of the archive')
+    parser.add_argument('--writers', type=int, default=8, help='The number of concurrent database writers')
+    parser.add_argument('--jobs-per-writer', type=int, default=50,
+                        help='The number of jobs added by each database writer')
+    parser.add_argument('--soil-type', default='Medium', help='The soil type of the soil moisture jobs')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random data and locations')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='tamsat-alert-benchmark-')
+    try:
+        archive = args.archive or os.path.join(workdir, 'archive')
+        _write_config(workdir, archive, args.start_year, args.end_year)
+        if not os.path.isdir(archive):
+            print('Generating archive in ' + archive)
+            from config import config
+            make_archive.generate(archive, config['Data'], args.start_year, args.end_year,
+                                  args.resolution, *args.extent, seed=args.seed)
+        _setup_app()
+        results = run(args.repeats, args.writers, args.jobs_per_writer,
+                      args.soil_type, args.extent, args.seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'created': dt.now().isoformat(),
+            'revision': _revision(),
+            'python': platform.python_version(),
+            'archive': {
+                'start_year': args.start_year,
+                'end_year': args.end_year,
+                'resolution': args.resolution,
+                'extent': args.extent
+            },
+            'repeats': args.repeats,
+            'benchmarks': results
+        }, f, indent=2)
+    print('Results written to ' + args.output)